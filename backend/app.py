@@ -1,155 +1,122 @@
-from flask import Flask, request, jsonify, Response, send_from_directory
+from flask import Flask, request, jsonify, Response, send_file, abort
 from flask_cors import CORS
-import json
-import html
-from pathlib import Path
-from llm_handler import LLMHandler
-from conversation import ConversationManager
+import signal
+import sys
+import time
+import metrics
+from routes import ROUTES, ApiError, ApiRequest, ChatAPI
+from sse import SSEEncoder
 from config import HOST, PORT
 
 # Initialize Flask app
-app = Flask(__name__, static_folder='../frontend')
+app = Flask(__name__, static_folder=None)
 CORS(app)
 
 # Initialize LLM and conversation manager
 print("Initializing LLM Chat Application...")
-llm = LLMHandler()
-conversation = ConversationManager()
-print("✓ Application ready!")
+api = ChatAPI()
+llm, conversation = api.llm, api.conversation
+print("✓ Server ready; loading model in the background")
+
+
+def _api_request() -> ApiRequest:
+    return ApiRequest(json=request.get_json(silent=True), args=request.args,
+                      text=request.get_data(as_text=True), is_json=request.is_json)
+
+
+def _respond(reply):
+    body, status, headers = reply
+    return jsonify(body), status, headers
+
+
+def _view(handler):
+    """A Flask view running a shared JSON handler."""
+    def view(**params):
+        return _respond(api.call(handler, _api_request(), **params))
+    view.__doc__ = handler.__doc__
+    return view
+
+
+for rule, methods, name in ROUTES:
+    app.add_url_rule(rule, name, _view(getattr(api, name)), methods=methods)
 
 # Serve frontend
 @app.route('/')
 def index():
     """Serve the main chat interface."""
-    return send_from_directory(app.static_folder, 'index.html')
+    return serve_static('')
 
 @app.route('/<path:path>')
 def serve_static(path):
-    """Serve static files (CSS, JS)."""
-    return send_from_directory(app.static_folder, path)
+    """Serve static files (CSS, JS, images) from memory, precompressed."""
+    found = api.assets.respond(path, request.headers)
+    if found is None:
+        abort(404)
+    return found
 
-@app.route('/health', methods=['GET'])
-def health():
-    """Health check endpoint."""
-    return jsonify({
-        "status": "healthy",
-        "model_loaded": llm.is_loaded()
-    })
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """Latency histograms and load gauges in the Prometheus text format."""
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
 
 @app.route('/chat', methods=['POST'])
 def chat():
     """Handle chat messages (non-streaming)."""
     try:
-        data = request.get_json()
-        if not data or 'message' not in data:
-            return jsonify({"error": "No message provided"}), 400
-        
-        user_message = data['message'].strip()
-        conversation_id = data.get('conversation_id')
-        
-        if conversation_id:
-            conversation.set_conversation(conversation_id)
-        
-        if not user_message:
-            return jsonify({"error": "Empty message"}), 400
-            
-        if len(user_message) > 4000:
-            return jsonify({"error": "Message too long"}), 400
-        
-        user_message = html.escape(user_message)
-        prompt = conversation.get_prompt(user_message)
-        response = llm.generate(prompt, stream=False)
-        
-        conversation.add_message('user', user_message)
-        conversation.add_message('assistant', response)
-        
-        return jsonify({
-            "response": response,
-            "conversation_id": conversation.current_conversation_id,
-            "history": conversation.get_history()
-        })
+        turn = api.begin_turn(_api_request(), "chat")
+        response = llm.generate(
+            turn.prompt, stream=False, conversation_id=turn.conversation_id, model=turn.model
+        )
+        return _respond(api.finish_chat(turn, response))
     except Exception as e:
-        print(f"Error in /chat: {e}")
-        return jsonify({"error": str(e)}), 500
+        return _respond(api.generation_failed("chat", e))
 
 @app.route('/stream', methods=['POST'])
 def stream():
     """Stream response with Server-Sent Events."""
     try:
-        data = request.get_json()
-        if not data or 'message' not in data:
-            return jsonify({"error": "No message provided"}), 400
-        
-        user_message = data['message'].strip()
-        conversation_id = data.get('conversation_id')
-        
-        if conversation_id:
-            conversation.set_conversation(conversation_id)
-            
-        if not user_message:
-            return jsonify({"error": "Empty message"}), 400
-
-        if len(user_message) > 4000:
-            return jsonify({"error": "Message too long"}), 400
-            
-        user_message = html.escape(user_message)
-        prompt = conversation.get_prompt(user_message)
-        
-        def generate_stream():
-            full_response = ""
-            try:
-                for token in llm.generate(prompt, stream=True):
-                    full_response += token
-                    yield f"data: {json.dumps({'token': token})}\n\n"
-                
-                # Save to database after completion
-                conversation.add_message('user', user_message)
-                conversation.add_message('assistant', full_response)
-                
-                yield f"data: {json.dumps({
-                    'done': True, 
-                    'conversation_id': conversation.current_conversation_id
-                })}\n\n"
-            except Exception as e:
-                yield f"data: {json.dumps({'error': str(e)})}\n\n"
-        
-        return Response(generate_stream(), mimetype='text/event-stream')
+        turn = api.begin_turn(_api_request(), "stream")
+        # Queue before streaming so a full scheduler can still answer with 503
+        tokens = llm.generate(
+            turn.prompt, stream=True, conversation_id=turn.conversation_id, model=turn.model
+        )
     except Exception as e:
-        print(f"Error in /stream: {e}")
-        return jsonify({"error": str(e)}), 500
-
-@app.route('/conversations', methods=['GET'])
-def list_conversations():
-    """Get list of conversations."""
-    return jsonify(conversation.get_conversations())
-
-@app.route('/conversations', methods=['POST'])
-def create_conversation():
-    """Create a new conversation."""
-    cid = conversation.create_conversation()
-    return jsonify({"id": cid})
-
-@app.route('/conversations/<cid>', methods=['GET'])
-def get_conversation(cid):
-    """Get specific conversation history."""
-    if conversation.set_conversation(cid):
-        return jsonify({
-            "id": cid,
-            "history": conversation.get_history()
-        })
-    return jsonify({"error": "Conversation not found"}), 404
-
-@app.route('/conversations/<cid>', methods=['DELETE'])
-def delete_conversation(cid):
-    """Delete a conversation."""
-    conversation.delete_conversation(cid)
-    return jsonify({"status": "deleted"})
-
-@app.route('/clear', methods=['POST'])
-def clear_history():
-    """Clear current conversation history."""
-    conversation.clear_history()
-    return jsonify({"status": "cleared"})
+        return _respond(api.generation_failed("stream", e))
+
+    encoder = SSEEncoder(compact=turn.compact)
+
+    def generate_stream():
+        first = True
+        try:
+            for frame in encoder.frames(tokens):
+                if first:
+                    metrics.TIME_TO_FIRST_TOKEN.observe(time.perf_counter() - turn.started)
+                    first = False
+                sent = time.perf_counter()
+                yield frame
+                metrics.SSE_WRITE_SECONDS.observe(time.perf_counter() - sent)
+
+            # Save to database after completion
+            api.save_turn(turn, encoder.text)
+
+            yield encoder.done({'conversation_id': turn.conversation_id})
+            turn.finished()
+        except Exception as e:
+            metrics.REQUEST_ERRORS.inc(route="stream", status="stream")
+            yield encoder.error(str(e))
+        # encoder.frames() closes tokens, freeing the decode slot, when the
+        # stream ends or a client disconnect closes this generator
+
+    return Response(generate_stream(), mimetype='text/event-stream')
+
+@app.route('/jobs/<job_id>/output', methods=['GET'])
+def get_job_output(job_id):
+    """Results so far, one JSON object per line."""
+    try:
+        path = api.job_output_path(job_id)
+    except ApiError as e:
+        return _respond(e.reply())
+    return send_file(path, mimetype='application/x-ndjson')
 
 
 if __name__ == '__main__':
@@ -160,4 +127,12 @@ if __name__ == '__main__':
     print(f"💬 Open your browser and start chatting!")
     print(f"{'='*60}\n")
     
+    problem = conversation.db.check()
+    if problem:
+        print(f"✗ {problem}")
+    
+    # Exit through SystemExit on SIGTERM so queued conversation writes are
+    # flushed (or spooled) by their atexit hook
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    
     app.run(host=HOST, port=PORT, debug=False, threaded=True)
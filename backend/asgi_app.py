@@ -0,0 +1,164 @@
+"""
+ASGI version of the chat server, for many concurrent or slow streaming clients.
+
+Serves the same routes as app.py, but on an asyncio event loop: SSE clients
+wait on async queues fed by the inference scheduler instead of each holding
+an OS thread, and a client that disconnects mid-stream has its generation
+cancelled. The handlers in routes.py block on the database, so they run in
+a thread pool.
+
+Run with `python asgi_app.py`, or `hypercorn asgi_app:app` from `backend/`.
+"""
+import asyncio
+import signal
+import time
+
+from quart import Quart, request, jsonify, Response, send_file, abort
+from quart_cors import cors
+from hypercorn.asyncio import serve
+from hypercorn.config import Config
+
+import metrics
+from routes import ROUTES, ApiError, ApiRequest, ChatAPI
+from sse import SSEEncoder
+from config import HOST, PORT
+
+app = Quart(__name__, static_folder=None)
+app = cors(app)
+# Generations can outlast Quart's default 60s response timeout
+app.config["RESPONSE_TIMEOUT"] = None
+
+print("Initializing LLM Chat Application (ASGI)...")
+api = ChatAPI()
+llm, conversation = api.llm, api.conversation
+print("✓ Server ready; loading model in the background")
+
+
+async def _api_request() -> ApiRequest:
+    return ApiRequest(json=await request.get_json(silent=True), args=request.args,
+                      text=await request.get_data(as_text=True), is_json=request.is_json)
+
+
+def _respond(reply):
+    body, status, headers = reply
+    return jsonify(body), status, headers
+
+
+def _view(handler):
+    """A Quart view running a shared JSON handler in a thread."""
+    async def view(**params):
+        return _respond(await asyncio.to_thread(api.call, handler, await _api_request(), **params))
+    view.__doc__ = handler.__doc__
+    return view
+
+
+for rule, methods, name in ROUTES:
+    app.add_url_rule(rule, name, _view(getattr(api, name)), methods=methods)
+
+
+@app.route('/')
+async def index():
+    """Serve the main chat interface."""
+    return await serve_static('')
+
+@app.route('/<path:path>')
+async def serve_static(path):
+    """Serve static files (CSS, JS, images) from memory, precompressed."""
+    found = api.assets.respond(path, request.headers)
+    if found is None:
+        abort(404)
+    return found
+
+@app.route('/metrics', methods=['GET'])
+async def prometheus_metrics():
+    """Latency histograms and load gauges in the Prometheus text format."""
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+@app.route('/chat', methods=['POST'])
+async def chat():
+    """Handle chat messages (non-streaming)."""
+    try:
+        turn = await asyncio.to_thread(api.begin_turn, await _api_request(), "chat")
+        tokens = await llm.stream_async(
+            turn.prompt, conversation_id=turn.conversation_id, model=turn.model
+        )
+        response = "".join([token async for token in tokens]).strip()
+        return _respond(await asyncio.to_thread(api.finish_chat, turn, response))
+    except Exception as e:
+        return _respond(api.generation_failed("chat", e))
+
+@app.route('/stream', methods=['POST'])
+async def stream():
+    """Stream response with Server-Sent Events."""
+    try:
+        turn = await asyncio.to_thread(api.begin_turn, await _api_request(), "stream")
+        # Queue before streaming so a full scheduler can still answer with 503
+        tokens = await llm.stream_async(
+            turn.prompt, conversation_id=turn.conversation_id, model=turn.model
+        )
+    except Exception as e:
+        return _respond(api.generation_failed("stream", e))
+
+    encoder = SSEEncoder(compact=turn.compact)
+
+    async def generate_stream():
+        first = True
+        try:
+            async for frame in encoder.aframes(tokens):
+                if first:
+                    metrics.TIME_TO_FIRST_TOKEN.observe(time.perf_counter() - turn.started)
+                    first = False
+                sent = time.perf_counter()
+                yield frame.encode()
+                metrics.SSE_WRITE_SECONDS.observe(time.perf_counter() - sent)
+
+            await asyncio.to_thread(api.save_turn, turn, encoder.text)
+
+            yield encoder.done({'conversation_id': turn.conversation_id}).encode()
+            turn.finished()
+        except Exception as e:
+            metrics.REQUEST_ERRORS.inc(route="stream", status="stream")
+            yield encoder.error(str(e)).encode()
+        finally:
+            # A client disconnect cancels this task; free the decode slot
+            await tokens.aclose()
+
+    return Response(generate_stream(), mimetype='text/event-stream')
+
+@app.route('/jobs/<job_id>/output', methods=['GET'])
+async def get_job_output(job_id):
+    """Results so far, one JSON object per line."""
+    try:
+        path = api.job_output_path(job_id)
+    except ApiError as e:
+        return _respond(e.reply())
+    return await send_file(path, mimetype='application/x-ndjson')
+
+
+async def _serve():
+    config = Config()
+    config.bind = [f"{HOST}:{PORT}"]
+
+    # Stop accepting connections on Ctrl+C or SIGTERM; queued conversation
+    # writes are then flushed (or spooled) by their atexit hook
+    shutdown = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, shutdown.set)
+
+    await serve(app, config, shutdown_trigger=shutdown.wait)
+
+
+if __name__ == '__main__':
+    print(f"\n{'='*60}")
+    print(f"🚀 Starting Vamsify LLM Chat Server (ASGI)")
+    print(f"{'='*60}")
+    print(f"📍 URL: http://localhost:{PORT}")
+    print(f"💬 Open your browser and start chatting!")
+    print(f"{'='*60}\n")
+
+    problem = conversation.db.check()
+    if problem:
+        print(f"✗ {problem}")
+
+    asyncio.run(_serve())
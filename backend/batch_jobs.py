@@ -0,0 +1,414 @@
+"""
+Offline batch generation jobs.
+
+A job is a list of items, each either a standalone message or a stored
+conversation plus an instruction about it (e.g. "Summarize this
+conversation"). Jobs run one at a time on a background thread that keeps
+up to BATCH_CONCURRENCY items queued on the model's scheduler, so they are
+decoded in the same batches instead of one HTTP request at a time. That is
+half the slots by default, and no new item starts while live requests are
+waiting for one, so /chat and /stream aren't held up behind a job. Items
+are taken a window at a time and ordered by prompt prefix and length, so
+sequences decoded together start alike and finish at about the same time.
+
+Each job lives in BATCH_JOBS_DIR/<id>/: input.jsonl, output.jsonl (one line
+per finished item, in completion order) and job.json (its state). Finished
+items are read back from output.jsonl, so a paused, interrupted or
+restarted job carries on with the items it hasn't done.
+"""
+import json
+import os
+import shutil
+import threading
+import uuid
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+from config import BATCH_JOBS_DIR, BATCH_CONCURRENCY, CONVERSATION_PAGE_MAX, MAX_BATCH_SLOTS
+from model_registry import ModelNotReadyError
+from scheduler import SchedulerFullError
+
+# Items whose prompts are built and sorted together
+SORT_WINDOW = 256
+
+# Characters of the prompt that decide which items are grouped together
+PREFIX_KEY_CHARS = 512
+
+# Seconds to wait before retrying an item the model couldn't take yet
+BUSY_RETRY_DELAY = 1.0
+LOADING_RETRY_DELAY = 5.0
+
+# Seconds an item waits while live requests are queued for the model
+YIELD_DELAY = 0.05
+
+MAX_MESSAGE_CHARS = 4000
+
+
+class JobStateError(RuntimeError):
+    """Raised when a job can't make the requested change in its current state."""
+
+
+def parse_items(lines: Iterable[str]) -> List[Dict]:
+    """
+    Validate JSONL job input; each line is an object with either `message`
+    or `conversation_id` and `instruction`, and optionally an `id` (default:
+    its line number).
+
+    Raises:
+        ValueError: Naming the first bad line
+    """
+    items = []
+    ids: Set[str] = set()
+    for number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            data = json.loads(line)
+        except ValueError as e:
+            raise ValueError(f"Line {number}: invalid JSON ({e})") from e
+        if not isinstance(data, dict):
+            raise ValueError(f"Line {number}: expected an object")
+        item = {"id": str(data.get("id", number))}
+        if data.get("conversation_id"):
+            item["conversation_id"] = str(data["conversation_id"])
+            text_field = "instruction"
+        else:
+            text_field = "message"
+        text = data.get(text_field)
+        if not isinstance(text, str) or not text.strip():
+            raise ValueError(f"Line {number}: no {text_field} provided")
+        if len(text) > MAX_MESSAGE_CHARS:
+            raise ValueError(f"Line {number}: {text_field} too long")
+        item[text_field] = text.strip()
+        if item["id"] in ids:
+            raise ValueError(f"Line {number}: duplicate id {item['id']}")
+        ids.add(item["id"])
+        items.append(item)
+    if not items:
+        raise ValueError("No items provided")
+    return items
+
+
+class BatchJob:
+    """A job's state, as saved in its job.json."""
+
+    def __init__(self, job_id: str, total: int, model: Optional[str] = None,
+                 state: str = "queued", done: int = 0, failed: int = 0,
+                 created_at: Optional[str] = None, updated_at: Optional[str] = None):
+        self.id = job_id
+        self.total = total
+        self.model = model
+        self.state = state
+        self.done = done
+        self.failed = failed
+        self.created_at = created_at or datetime.now().isoformat()
+        self.updated_at = updated_at or self.created_at
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> "BatchJob":
+        return cls(data["id"], data["total"], data.get("model"), data.get("state", "queued"),
+                   data.get("done", 0), data.get("failed", 0),
+                   data.get("created_at"), data.get("updated_at"))
+
+    def to_dict(self) -> Dict:
+        return {
+            "id": self.id,
+            "state": self.state,
+            "model": self.model,
+            "total": self.total,
+            "done": self.done,
+            "failed": self.failed,
+            "progress": round(self.done / self.total, 4) if self.total else 1.0,
+            "created_at": self.created_at,
+            "updated_at": self.updated_at,
+        }
+
+
+class BatchJobManager:
+    """Stores batch jobs and runs them, oldest first, on a background thread."""
+
+    def __init__(self, llm, conversations, jobs_dir: Path = BATCH_JOBS_DIR,
+                 concurrency: int = BATCH_CONCURRENCY):
+        """
+        Args:
+            llm: LLMHandler that generates the answers
+            conversations: ConversationManager to read stored conversations from
+            jobs_dir: Where jobs' files are kept
+            concurrency: Items generated at once (0 = half of MAX_BATCH_SLOTS)
+        """
+        self.llm = llm
+        self.conversations = conversations
+        self.jobs_dir = Path(jobs_dir)
+        # Leave slots free for /chat and /stream by default
+        self.concurrency = concurrency or max(1, MAX_BATCH_SLOTS // 2)
+        self._jobs: Dict[str, BatchJob] = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Condition(self._lock)
+        self._stop = threading.Event()
+
+        self.jobs_dir.mkdir(parents=True, exist_ok=True)
+        self._load_jobs()
+        self._thread = threading.Thread(target=self._run, name="batch-jobs", daemon=True)
+        self._thread.start()
+
+    def _load_jobs(self) -> None:
+        """Pick up jobs from an earlier run; unfinished ones carry on."""
+        for path in self.jobs_dir.glob("*/job.json"):
+            try:
+                job = BatchJob.from_dict(json.loads(path.read_text()))
+            except (OSError, ValueError, KeyError) as e:
+                print(f"✗ Skipping batch job {path.parent.name}: {e}")
+                continue
+            self._jobs[job.id] = job
+        resumed = sum(job.state in ("queued", "running") for job in self._jobs.values())
+        if resumed:
+            print(f"✓ Resuming {resumed} batch job(s)")
+
+    def _job_dir(self, job_id: str) -> Path:
+        return self.jobs_dir / job_id
+
+    def _save(self, job: BatchJob) -> None:
+        """Write a job's state; call with the lock held."""
+        job.updated_at = datetime.now().isoformat()
+        path = self._job_dir(job.id) / "job.json"
+        tmp = path.with_name("job.json.tmp")
+        tmp.write_text(json.dumps(job.to_dict()))
+        os.replace(tmp, path)
+
+    def submit(self, items: List[Dict], model: Optional[str] = None) -> Dict:
+        """Queue a job over items from parse_items(); returns its state."""
+        job = BatchJob(uuid.uuid4().hex, len(items), model)
+        job_dir = self._job_dir(job.id)
+        job_dir.mkdir(parents=True)
+        with open(job_dir / "input.jsonl", "w", encoding="utf-8") as f:
+            for item in items:
+                f.write(json.dumps(item) + "\n")
+        (job_dir / "output.jsonl").touch()
+        with self._wake:
+            self._save(job)
+            self._jobs[job.id] = job
+            self._wake.notify_all()
+        print(f"✓ Batch job {job.id} queued with {job.total} item(s)")
+        return job.to_dict()
+
+    def submit_conversations(self, instruction: str, conversation_ids: Optional[List[str]] = None,
+                             model: Optional[str] = None) -> Dict:
+        """Queue `instruction` over the given conversations (default: all of them)."""
+        if conversation_ids is None:
+            conversation_ids = list(self._all_conversation_ids())
+        lines = (json.dumps({"id": cid, "conversation_id": cid, "instruction": instruction})
+                 for cid in conversation_ids)
+        return self.submit(parse_items(lines), model)
+
+    def _all_conversation_ids(self) -> Iterator[str]:
+        cursor = None
+        while True:
+            page = self.conversations.get_conversations(CONVERSATION_PAGE_MAX, cursor)
+            for row in page["conversations"]:
+                yield row["id"]
+            cursor = page["next_cursor"]
+            if cursor is None:
+                return
+
+    def list(self) -> List[Dict]:
+        """Every job, newest first."""
+        with self._lock:
+            jobs = sorted(self._jobs.values(), key=lambda job: job.created_at, reverse=True)
+            return [job.to_dict() for job in jobs]
+
+    def get(self, job_id: str) -> Optional[Dict]:
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return job.to_dict() if job else None
+
+    def output_path(self, job_id: str) -> Optional[Path]:
+        """The job's results file, or None for an unknown job."""
+        with self._lock:
+            if job_id not in self._jobs:
+                return None
+        return self._job_dir(job_id) / "output.jsonl"
+
+    def pause(self, job_id: str) -> Optional[Dict]:
+        """
+        Stop starting new items; those already running still finish.
+
+        Raises:
+            JobStateError: If the job has already finished
+        """
+        return self._transition(job_id, ("queued", "running"), "paused")
+
+    def resume(self, job_id: str) -> Optional[Dict]:
+        """
+        Queue a paused job again.
+
+        Raises:
+            JobStateError: If the job isn't paused
+        """
+        return self._transition(job_id, ("paused",), "queued")
+
+    def _transition(self, job_id: str, allowed: tuple, state: str) -> Optional[Dict]:
+        with self._wake:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            if job.state not in allowed:
+                raise JobStateError(f"Job {job_id} is {job.state}")
+            job.state = state
+            self._save(job)
+            self._wake.notify_all()
+            return job.to_dict()
+
+    def delete(self, job_id: str) -> bool:
+        """Cancel a job and remove its files; False if there is no such job."""
+        with self._wake:
+            job = self._jobs.pop(job_id, None)
+            if job is None:
+                return False
+            job.state = "cancelled"
+            shutil.rmtree(self._job_dir(job_id), ignore_errors=True)
+            self._wake.notify_all()
+        return True
+
+    def close(self) -> None:
+        """Stop the worker; jobs in progress carry on after a restart."""
+        with self._wake:
+            self._stop.set()
+            self._wake.notify_all()
+        self._thread.join(timeout=5)
+
+    def _next_job(self) -> Optional[BatchJob]:
+        """Wait for the oldest runnable job (None once stopped)."""
+        with self._wake:
+            while not self._stop.is_set():
+                runnable = [job for job in self._jobs.values() if job.state in ("queued", "running")]
+                if runnable:
+                    job = min(runnable, key=lambda job: job.created_at)
+                    job.state = "running"
+                    self._save(job)
+                    return job
+                self._wake.wait()
+            return None
+
+    def _run(self) -> None:
+        while True:
+            job = self._next_job()
+            if job is None:
+                return
+            try:
+                self._process(job)
+            except Exception as e:
+                # Left running: it is retried, resuming after its finished items
+                print(f"✗ Batch job {job.id} stopped: {e}")
+                self._stop.wait(LOADING_RETRY_DELAY)
+
+    def _active(self, job: BatchJob) -> bool:
+        return job.state == "running" and not self._stop.is_set()
+
+    def _process(self, job: BatchJob) -> None:
+        # Prompts are packed with the default model's tokenizer
+        while not self.llm.is_loaded() and self._active(job):
+            self._stop.wait(LOADING_RETRY_DELAY)
+        job_dir = self._job_dir(job.id)
+        finished, failed = self._finished(job_dir / "output.jsonl")
+        with self._lock:
+            # The file is the record; job.json may lag it after a crash
+            job.done, job.failed = len(finished), failed
+        with open(job_dir / "input.jsonl", encoding="utf-8") as f:
+            todo = [item for item in map(json.loads, f) if item["id"] not in finished]
+
+        with ThreadPoolExecutor(max_workers=self.concurrency,
+                                thread_name_prefix="batch-item") as pool:
+            in_flight = set()
+            for start in range(0, len(todo), SORT_WINDOW):
+                if not self._active(job):
+                    break
+                for item in self._prepared(todo[start:start + SORT_WINDOW]):
+                    if len(in_flight) >= self.concurrency:
+                        _, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                    if not self._active(job):
+                        break
+                    in_flight.add(pool.submit(self._run_item, job, item))
+            wait(in_flight)
+
+        with self._lock:
+            if job.state == "running" and not self._stop.is_set():
+                job.state = "completed"
+                self._save(job)
+                print(f"✓ Batch job {job.id} completed: {job.done} done, {job.failed} failed")
+
+    @staticmethod
+    def _finished(path: Path) -> Tuple[Set[str], int]:
+        """Ids of the items in an output file, and how many of them failed."""
+        finished, failed = set(), 0
+        with open(path, "rb+") as f:
+            data = f.read()
+            # Drop a line cut short by a crash; that item runs again
+            complete = data.rfind(b"\n") + 1
+            if complete < len(data):
+                f.truncate(complete)
+        for line in data[:complete].decode("utf-8").splitlines():
+            try:
+                result = json.loads(line)
+                finished.add(result["id"])
+            except (ValueError, KeyError):
+                continue
+            failed += "error" in result
+        return finished, failed
+
+    def _prepared(self, items: List[Dict]) -> List[Dict]:
+        """Items with their prompts, ordered so similar ones run together."""
+        for item in items:
+            cid = item.get("conversation_id")
+            if cid is None:
+                item["prompt"] = self.conversations.get_batch_prompt(None, item["message"])
+            elif self.conversations.conversation_exists(cid):
+                item["prompt"] = self.conversations.get_batch_prompt(cid, item["instruction"])
+            else:
+                item["prompt"] = None
+        return sorted(items, key=lambda item: (
+            (item["prompt"] or "")[:PREFIX_KEY_CHARS], len(item["prompt"] or "")
+        ))
+
+    def _run_item(self, job: BatchJob, item: Dict) -> None:
+        result = {"id": item["id"]}
+        if "conversation_id" in item:
+            result["conversation_id"] = item["conversation_id"]
+        if item["prompt"] is None:
+            self._record(job, {**result, "error": "Conversation not found"})
+            return
+        while self._active(job):
+            if self._live_requests_waiting():
+                # Interactive requests go first; take a slot once they have one
+                self._stop.wait(YIELD_DELAY)
+                continue
+            try:
+                # Offline answers stay out of the cache users are answered from
+                response = self.llm.generate(item["prompt"], model=job.model, use_cache=False)
+            except SchedulerFullError:
+                self._stop.wait(BUSY_RETRY_DELAY)
+            except ModelNotReadyError:
+                self._stop.wait(LOADING_RETRY_DELAY)
+            except Exception as e:
+                self._record(job, {**result, "error": str(e)})
+                return
+            else:
+                self._record(job, {**result, "response": response})
+                return
+        # Paused or stopped before it ran: left for when the job resumes
+
+    def _live_requests_waiting(self) -> bool:
+        """Whether requests are waiting for a scheduler slot, which batch items then leave them."""
+        return self.llm.stats().get("queue_depth", 0) > 0
+
+    def _record(self, job: BatchJob, result: Dict) -> None:
+        with self._lock:
+            if self._jobs.get(job.id) is not job:
+                return  # Deleted meanwhile
+            with open(self._job_dir(job.id) / "output.jsonl", "a", encoding="utf-8") as f:
+                f.write(json.dumps(result) + "\n")
+            job.done += 1
+            if "error" in result:
+                job.failed += 1
+            self._save(job)
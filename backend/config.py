@@ -9,6 +9,8 @@ load_dotenv()
 BASE_DIR = Path(__file__).parent.parent
 MODELS_DIR = BASE_DIR / "models"
 MODELS_DIR.mkdir(exist_ok=True)
+DATA_DIR = BASE_DIR / "data"
+FRONTEND_DIR = BASE_DIR / "frontend"
 
 # Model configuration
 MODEL_NAME = os.getenv("MODEL_NAME", "llama-3.2-1b-instruct-q4_k_m.gguf")
@@ -17,6 +19,17 @@ MODEL_URL = os.getenv(
     "MODEL_URL",
     "https://huggingface.co/bartowski/Llama-3.2-1B-Instruct-GGUF/resolve/main/Llama-3.2-1B-Instruct-Q4_K_M.gguf"
 )
+MODEL_SHA256 = os.getenv("MODEL_SHA256", "")  # Expected checksum of the download (empty = size check only)
+MODEL_MIRROR = os.getenv("MODEL_MIRROR", "")  # Base URL or directory tried before MODEL_URL
+DOWNLOAD_CONNECTIONS = int(os.getenv("DOWNLOAD_CONNECTIONS", "4"))  # Parallel range requests
+DOWNLOAD_CHUNK_MB = int(os.getenv("DOWNLOAD_CHUNK_MB", "16"))  # Size of each range request
+
+# Model registry (several models in one server)
+MODELS_CONFIG = Path(os.getenv("MODELS_CONFIG") or BASE_DIR / "models.json")  # Named models; if missing, MODEL_NAME is the only one
+DEFAULT_MODEL = os.getenv("DEFAULT_MODEL", "")  # Model used when a request names none (empty = first in MODELS_CONFIG)
+MODEL_MEMORY_MB = int(os.getenv("MODEL_MEMORY_MB", "0"))  # RAM budget for resident models; least recently used are unloaded (0 = no limit)
+MODEL_EVICT_WAIT = float(os.getenv("MODEL_EVICT_WAIT", "60"))  # Seconds a load waits for busy models to go idle before failing
+MODEL_SWAP_URLS = [p.strip() for p in os.getenv("MODEL_SWAP_URLS", "").split(",") if p.strip()]  # URL prefixes PUT /models may download from, besides URLs already configured
 
 # System prompt
 SYSTEM_PROMPT = os.getenv(
@@ -25,15 +38,64 @@ SYSTEM_PROMPT = os.getenv(
 )
 
 # Conversation settings
-MAX_HISTORY_MESSAGES = int(os.getenv("MAX_HISTORY_MESSAGES", "10"))
+MAX_HISTORY_MESSAGES = int(os.getenv("MAX_HISTORY_MESSAGES", "0"))  # Optional cap on history messages (0 = token budget only)
 MAX_TOKENS = int(os.getenv("MAX_TOKENS", "512"))
 TEMPERATURE = float(os.getenv("TEMPERATURE", "0.7"))
+CONTEXT_EVICT_BLOCK = int(os.getenv("CONTEXT_EVICT_BLOCK", "4"))  # Old messages dropped together once history outgrows the window
+CONTEXT_SUMMARY = os.getenv("CONTEXT_SUMMARY", "false").lower() == "true"  # Replace dropped messages with a rolling summary
+CONTEXT_SUMMARY_TOKENS = int(os.getenv("CONTEXT_SUMMARY_TOKENS", "256"))  # Max length of that summary
+CONVERSATION_PAGE_SIZE = int(os.getenv("CONVERSATION_PAGE_SIZE", "50"))  # Conversations per /conversations page by default
+CONVERSATION_PAGE_MAX = int(os.getenv("CONVERSATION_PAGE_MAX", "200"))  # Largest page a client may ask for
+
+# Search settings
+SEARCH_BACKEND = os.getenv("SEARCH_BACKEND", "mysql").lower()  # mysql (FULLTEXT), sqlite (local FTS5 index) or off
+SEARCH_INDEX_PATH = DATA_DIR / "search_index.sqlite"  # Index file for SEARCH_BACKEND=sqlite
+SEARCH_PAGE_SIZE = int(os.getenv("SEARCH_PAGE_SIZE", "20"))  # Hits per /search page by default
+
+# Persistence settings
+WRITE_BEHIND = os.getenv("WRITE_BEHIND", "true").lower() == "true"  # Save turns in the background
+WRITE_QUEUE_SIZE = int(os.getenv("WRITE_QUEUE_SIZE", "1000"))  # Turns buffered in memory
+WRITE_BATCH_SIZE = int(os.getenv("WRITE_BATCH_SIZE", "50"))  # Turns per database transaction
+WRITE_SPOOL_PATH = DATA_DIR / "write_spool.jsonl"  # Turns kept here while MySQL is unavailable
+HISTORY_CACHE_MB = int(os.getenv("HISTORY_CACHE_MB", "64"))  # In-process conversation history cache
+HISTORY_CACHE_TTL = int(os.getenv("HISTORY_CACHE_TTL", "600"))  # Seconds before a cached history is reloaded
 
 # Server settings
 PORT = int(os.getenv("PORT", "5000"))
 HOST = os.getenv("HOST", "0.0.0.0")
+SSE_COALESCE_MS = int(os.getenv("SSE_COALESCE_MS", "20"))  # Tokens streamed together within this many ms (0 = one frame per token)
+SSE_COALESCE_BYTES = int(os.getenv("SSE_COALESCE_BYTES", "64"))  # Send a frame early once this much text is waiting
+STATIC_RELOAD = os.getenv("STATIC_RELOAD", "false").lower() == "true"  # Re-read frontend/ when it changes (development)
+STATIC_COMPRESS_MIN_BYTES = int(os.getenv("STATIC_COMPRESS_MIN_BYTES", "256"))  # Smaller assets are served uncompressed
 
 # LLM settings
 N_CTX = 2048  # Context window size
 N_THREADS = None  # Auto-detect CPU threads
 N_GPU_LAYERS = 0  # CPU only (set to -1 for GPU)
+
+# Scheduler settings
+MAX_BATCH_SLOTS = int(os.getenv("MAX_BATCH_SLOTS", "4"))  # Sequences decoded together per batch
+MAX_QUEUE_DEPTH = int(os.getenv("MAX_QUEUE_DEPTH", "32"))  # Waiting requests before new ones get 503
+KV_CACHE_MB = int(os.getenv("KV_CACHE_MB", "512"))  # Per-conversation KV state kept between turns (0 = off)
+PERSIST_PREFIX_STATE = os.getenv("PERSIST_PREFIX_STATE", "true").lower() == "true"  # Save system prompt state in MODELS_DIR
+PROMPT_LOOKUP_TOKENS = int(os.getenv("PROMPT_LOOKUP_TOKENS", "0"))  # Tokens drafted from the context per decode step (0 = off)
+PROMPT_LOOKUP_NGRAM = int(os.getenv("PROMPT_LOOKUP_NGRAM", "3"))  # Longest run of recent tokens looked up in the context
+
+# Response cache settings
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "1000"))  # Answers kept in memory (0 = off)
+RESPONSE_CACHE_TTL = int(os.getenv("RESPONSE_CACHE_TTL", "86400"))  # Seconds an answer stays valid
+RESPONSE_CACHE_DISK = os.getenv("RESPONSE_CACHE_DISK", "true").lower() == "true"  # Keep answers across restarts
+RESPONSE_CACHE_DISK_PATH = DATA_DIR / "response_cache.sqlite" if RESPONSE_CACHE_DISK else None
+RESPONSE_CACHE_IGNORE_CASE = os.getenv("RESPONSE_CACHE_IGNORE_CASE", "false").lower() == "true"  # Treat prompts differing only in case as the same
+RESPONSE_CACHE_SEMANTIC = os.getenv("RESPONSE_CACHE_SEMANTIC", "false").lower() == "true"  # Also match reworded first questions
+RESPONSE_CACHE_SIMILARITY = float(os.getenv("RESPONSE_CACHE_SIMILARITY", "0.95"))  # Cosine similarity for a semantic match
+RESPONSE_REPLAY_DELAY = float(os.getenv("RESPONSE_REPLAY_DELAY", "0.01"))  # Seconds between words when streaming a cached answer
+
+# Batch job settings
+BATCH_JOBS_DIR = DATA_DIR / "jobs"  # Job input, output and state files
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "0"))  # Batch items generated at once (0 = half of MAX_BATCH_SLOTS)
+
+# Worker pool settings
+MODEL_WORKERS = int(os.getenv("MODEL_WORKERS", "0"))  # Model worker processes (0 = run the model in the web process)
+WORKER_THREADS = int(os.getenv("WORKER_THREADS", "0"))  # Threads per worker (0 = split physical cores evenly)
+PIN_WORKER_CPUS = os.getenv("PIN_WORKER_CPUS", "true").lower() == "true"  # Pin each worker to its own cores
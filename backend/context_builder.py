@@ -0,0 +1,92 @@
+from typing import Callable, Dict, List, Optional
+
+# Headroom for tokens that merge across message boundaries and the BOS token
+SAFETY_MARGIN = 16
+
+
+def format_message(message: Dict) -> str:
+    """Render one history message the way it appears in the prompt."""
+    return f"{message['role'].capitalize()}: {message['content']}\n\n"
+
+
+class ContextBuilder:
+    """
+    Packs conversation history into the model's context window by token count.
+
+    The newest messages are kept until the budget left after the system
+    prompt, the new user message and the reply (`max_tokens`) runs out.
+    Older messages are dropped in blocks of `evict_block` so the start of
+    the prompt, and with it the conversation's cached KV state, stays the
+    same for several turns instead of shifting every turn.
+
+    Token counts are memoized on the message dicts under "token_count",
+    which ConversationManager also stores with each message.
+    """
+
+    def __init__(self, count_tokens: Callable[[str], int], n_ctx: int,
+                 max_tokens: int, max_messages: int = 0, evict_block: int = 1):
+        self.count_tokens = count_tokens
+        self.n_ctx = n_ctx
+        self.max_tokens = max_tokens
+        self.max_messages = max_messages
+        self.evict_block = max(1, evict_block)
+        self._text_counts: Dict[str, int] = {}
+
+    def message_tokens(self, message: Dict) -> int:
+        """Token count of a rendered message, computed once per message."""
+        count = message.get("token_count")
+        if count is None:
+            count = self.count_tokens(format_message(message))
+            message["token_count"] = count
+        return count
+
+    def text_tokens(self, text: str) -> int:
+        """Token count of a fixed prompt part such as the system header."""
+        count = self._text_counts.get(text)
+        if count is None:
+            count = self.count_tokens(text)
+            # Only a handful of distinct headers exist; don't grow without bound
+            if len(self._text_counts) < 64:
+                self._text_counts[text] = count
+        return count
+
+    def budget(self, reserved: int) -> int:
+        """Tokens available for history once `reserved` prompt tokens are placed."""
+        return max(0, self.n_ctx - self.max_tokens - reserved - SAFETY_MARGIN)
+
+    def window_start(self, history: List[Dict], budget: int) -> int:
+        """Index of the oldest message that goes into the prompt."""
+        start = len(history)
+        used = 0
+        while start > 0:
+            cost = self.message_tokens(history[start - 1])
+            if used + cost > budget:
+                break
+            used += cost
+            start -= 1
+        if self.max_messages:
+            start = max(start, len(history) - self.max_messages)
+        if start == 0:
+            return 0
+        # Round up to a block boundary so the window only moves occasionally
+        start = -(-start // self.evict_block) * self.evict_block
+        return min(start, len(history))
+
+    def uncounted(self, history: List[Dict]) -> List[Dict]:
+        """Messages whose token count hasn't been computed yet."""
+        return [msg for msg in history if msg.get("token_count") is None]
+
+
+def build_prompt(system: str, summary: Optional[str], history: List[Dict],
+                 user_message: str) -> str:
+    """Assemble the prompt text from its parts."""
+    parts = [system]
+    if summary:
+        parts.append(summary_header(summary))
+    parts.extend(format_message(msg) for msg in history)
+    parts.append(f"User: {user_message}\n\nAssistant:")
+    return "".join(parts)
+
+
+def summary_header(summary: str) -> str:
+    return f"Summary of the earlier conversation: {summary}\n\n"
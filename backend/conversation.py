@@ -1,132 +1,507 @@
-from typing import List, Dict, Optional
+from typing import Callable, List, Dict, Optional, Tuple
+from collections import OrderedDict
+from datetime import datetime
+import base64
+import threading
 import uuid
-from config import SYSTEM_PROMPT, MAX_HISTORY_MESSAGES
+import weakref
+from config import (
+    SYSTEM_PROMPT, MAX_HISTORY_MESSAGES, N_CTX, MAX_TOKENS,
+    CONTEXT_EVICT_BLOCK, CONTEXT_SUMMARY, CONTEXT_SUMMARY_TOKENS,
+    CONVERSATION_PAGE_SIZE, SEARCH_PAGE_SIZE,
+    WRITE_BEHIND, WRITE_QUEUE_SIZE, WRITE_BATCH_SIZE, WRITE_SPOOL_PATH,
+    HISTORY_CACHE_MB, HISTORY_CACHE_TTL
+)
+from context_builder import ContextBuilder, build_prompt, format_message, summary_header
 from database import DatabaseManager
+from history_cache import HistoryCache
+import metrics
+from persistence import WriteBehindQueue
+from search_index import create_search_index
+
+# Conversations whose rolling summary is kept in memory
+SUMMARY_CACHE_SIZE = 1024
+
+# Characters of the last message shown in the conversation list
+PREVIEW_CHARS = 100
+
+
+def encode_cursor(updated_at: datetime, conversation_id: str) -> str:
+    """Opaque page cursor: the sort key of the last conversation on a page."""
+    raw = f"{updated_at.isoformat()}|{conversation_id}".encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime, str]:
+    """Inverse of encode_cursor; raises ValueError for a malformed cursor."""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode("utf-8")
+        updated_at, conversation_id = raw.split("|", 1)
+        return datetime.fromisoformat(updated_at), conversation_id
+    except (ValueError, UnicodeDecodeError) as e:
+        raise ValueError(f"Invalid cursor: {cursor}") from e
+
 
 class ConversationManager:
-    """Manages conversation history and persistence."""
+    """
+    Manages conversation history and persistence.
+    
+    Holds no per-request state: every call names the conversation it acts
+    on, so concurrent requests for different conversations don't interfere.
+    Changes to one conversation are serialized by a per-conversation lock.
+    """
     
-    def __init__(self):
+    def __init__(self, count_tokens: Optional[Callable[[str], int]] = None,
+                 summarize: Optional[Callable[[str, str], str]] = None):
+        """
+        Args:
+            count_tokens: Model tokenizer; enables packing history by token budget
+            summarize: Folds a transcript into a running summary; used for
+                messages that no longer fit when CONTEXT_SUMMARY is on
+        """
         self.db = DatabaseManager()
         self.system_prompt = SYSTEM_PROMPT
-        self.current_conversation_id = None
+        self._locks: "weakref.WeakValueDictionary[str, threading.RLock]" = weakref.WeakValueDictionary()
+        self._locks_guard = threading.Lock()
+        self.context = None
+        if count_tokens:
+            self.context = ContextBuilder(
+                count_tokens,
+                n_ctx=N_CTX,
+                max_tokens=MAX_TOKENS,
+                max_messages=MAX_HISTORY_MESSAGES,
+                evict_block=CONTEXT_EVICT_BLOCK
+            )
+        self.summarize = summarize if CONTEXT_SUMMARY and count_tokens else None
+        # Per conversation (messages covered, summary, prompt tokens); (0, None, 0) = none yet
+        self._summaries: "OrderedDict[str, Tuple[int, Optional[str], int]]" = OrderedDict()
+        self._summarizing = set()
+        # Clears and deletes made while a summary task runs, per conversation
+        self._summary_resets: Dict[str, int] = {}
+        self._summary_lock = threading.Lock()
+        self.cache = HistoryCache(HISTORY_CACHE_MB * 1024 * 1024, HISTORY_CACHE_TTL)
+        self.search_index = create_search_index(self.db)
+        self.writer = None
+        if WRITE_BEHIND:
+            self.writer = WriteBehindQueue(
+                self._write_turns,
+                spool_path=WRITE_SPOOL_PATH,
+                max_queue=WRITE_QUEUE_SIZE,
+                batch_size=WRITE_BATCH_SIZE,
+                is_transient=self.db.is_transient
+            )
     
     def create_conversation(self, title: str = "New Chat") -> str:
         """Create a new conversation and return its ID."""
         conversation_id = str(uuid.uuid4())
         self.db.execute_query(
-            "INSERT INTO conversations (id, title, history) VALUES (%s, %s, %s)",
-            (conversation_id, title, '[]')
+            "INSERT INTO conversations (id, title) VALUES (%s, %s)",
+            (conversation_id, title)
         )
-        self.current_conversation_id = conversation_id
+        self.cache.put(conversation_id, [], self.cache.begin_load(conversation_id))
         return conversation_id
     
-    def set_conversation(self, conversation_id: str) -> bool:
-        """Set the active conversation."""
+    def conversation_exists(self, conversation_id: str) -> bool:
+        """Check whether a conversation exists."""
+        if self.cache.contains(conversation_id):
+            return True
         exists = self.db.fetch_one(
             "SELECT id FROM conversations WHERE id = %s",
             (conversation_id,)
         )
-        if exists:
-            self.current_conversation_id = conversation_id
-            return True
-        return False
-        
-    def get_conversations(self) -> List[Dict]:
-        """Get list of all conversations."""
-        return self.db.fetch_all(
-            "SELECT id, title, created_at FROM conversations ORDER BY updated_at DESC"
-        )
+        return exists is not None
     
-    def delete_conversation(self, conversation_id: str) -> None:
-        """Delete a conversation."""
-        self.db.execute_query(
-            "DELETE FROM conversations WHERE id = %s",
-            (conversation_id,)
-        )
-        if self.current_conversation_id == conversation_id:
-            self.current_conversation_id = None
-
-    def add_message(self, role: str, content: str) -> None:
-        """Add a message to the current conversation."""
-        if not self.current_conversation_id:
-            self.create_conversation()
-            
-        # Get current history
-        conv = self.db.fetch_one(
-            "SELECT history, title FROM conversations WHERE id = %s",
-            (self.current_conversation_id,)
-        )
+    def _lock(self, conversation_id: str) -> threading.RLock:
+        """The lock serializing changes to one conversation."""
+        with self._locks_guard:
+            lock = self._locks.get(conversation_id)
+            if lock is None:
+                # Dropped again once no thread holds a reference
+                lock = threading.RLock()
+                self._locks[conversation_id] = lock
+            return lock
         
-        if not conv:
-            return
-            
-        import json
-        from datetime import datetime
+    def get_conversations(self, limit: int = CONVERSATION_PAGE_SIZE,
+                          cursor: Optional[str] = None) -> Dict:
+        """
+        One page of conversations, most recently updated first.
         
-        history = json.loads(conv['history']) if isinstance(conv['history'], str) else conv['history']
-        if history is None: history = []
+        Pages are keyed on (updated_at, id), which the idx_conversations_updated
+        index serves directly, so every page costs the same however deep it is.
         
-        # Add new message with timestamp
-        history.append({
-            "id": str(uuid.uuid4()),
-            "role": role,
-            "content": content,
-            "timestamp": datetime.now().isoformat()
-        })
+        Args:
+            limit: Conversations per page
+            cursor: `next_cursor` of the previous page; None for the first
         
-        # Update database
-        self.db.execute_query(
-            "UPDATE conversations SET history = %s, updated_at = CURRENT_TIMESTAMP WHERE id = %s",
-            (json.dumps(history), self.current_conversation_id)
-        )
+        Returns:
+            {"conversations": [...], "next_cursor": cursor of the next page or None}
         
-        # Auto-update title
-        if role == 'user' and conv['title'] == "New Chat":
-            new_title = content[:30] + "..." if len(content) > 30 else content
+        Raises:
+            ValueError: If the cursor is malformed
+        """
+        columns = "id, title, preview, message_count, created_at, updated_at"
+        if cursor is None:
+            rows = self.db.fetch_all(
+                f"SELECT {columns} FROM conversations "
+                "ORDER BY updated_at DESC, id DESC LIMIT %s",
+                (limit + 1,)
+            )
+        else:
+            updated_at, last_id = decode_cursor(cursor)
+            rows = self.db.fetch_all(
+                f"SELECT {columns} FROM conversations "
+                "WHERE updated_at < %s OR (updated_at = %s AND id < %s) "
+                "ORDER BY updated_at DESC, id DESC LIMIT %s",
+                (updated_at, updated_at, last_id, limit + 1)
+            )
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = encode_cursor(rows[-1]["updated_at"], rows[-1]["id"])
+        return {"conversations": rows, "next_cursor": next_cursor}
+    
+    def search(self, query: str, limit: int = SEARCH_PAGE_SIZE, offset: int = 0) -> Dict:
+        """
+        Messages matching `query`, best first, with the conversations they're in.
+
+        Raises:
+            RuntimeError: If search is turned off (SEARCH_BACKEND=off)
+            SearchUnavailableError: If the search backend fails
+        """
+        if self.search_index is None:
+            raise RuntimeError("Search is turned off")
+        return self.search_index.search(query, limit, offset)
+
+    def delete_conversation(self, conversation_id: str) -> None:
+        """Delete a conversation."""
+        with self._lock(conversation_id):
+            if self.writer:
+                self.writer.discard(conversation_id)
+            self.cache.invalidate(conversation_id)
+            self._reset_summary(conversation_id)
             self.db.execute_query(
-                "UPDATE conversations SET title = %s WHERE id = %s",
-                (new_title, self.current_conversation_id)
+                "DELETE FROM conversations WHERE id = %s",
+                (conversation_id,)
             )
+            if self.search_index:
+                self.search_index.remove_conversation(conversation_id)
+
+    def add_message(self, conversation_id: str, role: str, content: str) -> None:
+        """Add a message to a conversation."""
+        self.add_messages(conversation_id, [(role, content)])
+
+    def add_messages(self, conversation_id: str, messages: List[Tuple[str, str]]) -> None:
+        """
+        Append (role, content) messages to a conversation.
+        
+        With write-behind enabled this only queues the messages; they are
+        visible to get_history immediately and written to MySQL shortly after.
+        """
+        now = datetime.now().isoformat()
+        turn = [
+            {"id": str(uuid.uuid4()), "role": role, "content": content, "timestamp": now}
+            for role, content in messages
+        ]
+        if self.context:
+            # Count now so the count is stored with the message
+            for msg in turn:
+                self.context.message_tokens(msg)
+        with self._lock(conversation_id):
+            if self.writer:
+                self.writer.submit(conversation_id, turn)
+            else:
+                self._write_turns([{"conversation_id": conversation_id, "messages": turn}])
+            # After the write/submit, so a concurrent load either sees the turn or is discarded
+            self.cache.append(conversation_id, turn)
+            if self.search_index:
+                self.search_index.add(conversation_id, turn)
 
-    def get_history(self) -> List[Dict[str, str]]:
-        """Get history for current conversation."""
-        if not self.current_conversation_id:
-            return []
+    def _write_turns(self, turns: List[Dict]) -> None:
+        """Insert queued turns, possibly for many conversations, in one transaction."""
+        by_conversation: Dict[str, List[Dict]] = {}
+        for turn in turns:
+            by_conversation.setdefault(turn["conversation_id"], []).extend(turn["messages"])
+        
+        with self.db.transaction() as cursor:
+            rows = []
+            # Lock rows in a fixed order so concurrent writers can't deadlock
+            for conversation_id in sorted(by_conversation):
+                messages = by_conversation[conversation_id]
+                # create_conversation's insert is lost if MySQL was down then;
+                # deleted conversations never get here (their turns are discarded)
+                cursor.execute(
+                    "INSERT IGNORE INTO conversations (id, title) VALUES (%s, %s)",
+                    (conversation_id, "New Chat")
+                )
+                cursor.execute(
+                    "SELECT title, message_count FROM conversations WHERE id = %s FOR UPDATE",
+                    (conversation_id,)
+                )
+                conv = cursor.fetchone()
+                
+                # Replayed turns may already be stored
+                placeholders = ", ".join(["%s"] * len(messages))
+                cursor.execute(
+                    f"SELECT id FROM messages WHERE id IN ({placeholders})",
+                    tuple(m["id"] for m in messages)
+                )
+                stored = {row["id"] for row in cursor.fetchall()}
+                messages = [m for m in messages if m["id"] not in stored]
+                if not messages:
+                    continue
+                
+                for i, msg in enumerate(messages):
+                    rows.append((
+                        msg["id"], conversation_id, conv["message_count"] + i,
+                        msg["role"], msg["content"], datetime.fromisoformat(msg["timestamp"]),
+                        msg.get("token_count")
+                    ))
+                
+                # Auto-update title from the first user message
+                title = conv["title"]
+                if title == "New Chat":
+                    first_user = next((m["content"] for m in messages if m["role"] == "user"), None)
+                    if first_user:
+                        title = first_user[:30] + "..." if len(first_user) > 30 else first_user
+                
+                # Kept here so listing conversations never reads messages
+                preview = messages[-1]["content"][:PREVIEW_CHARS]
+                cursor.execute(
+                    "UPDATE conversations SET message_count = message_count + %s, title = %s, "
+                    "preview = %s, updated_at = CURRENT_TIMESTAMP WHERE id = %s",
+                    (len(messages), title, preview, conversation_id)
+                )
             
-        conv = self.db.fetch_one(
-            "SELECT history FROM conversations WHERE id = %s",
-            (self.current_conversation_id,)
-        )
+            if rows:
+                cursor.executemany(
+                    "INSERT INTO messages "
+                    "(id, conversation_id, seq, role, content, created_at, token_count) "
+                    "VALUES (%s, %s, %s, %s, %s, %s, %s)",
+                    rows
+                )
+
+    def get_history(self, conversation_id: str,
+                    limit: Optional[int] = None) -> List[Dict[str, str]]:
+        """Get a conversation's history, optionally only the last `limit` messages."""
+        history = self.cache.get(conversation_id)
+        if history is None:
+            with self._lock(conversation_id):
+                # Another request may have loaded it while we waited
+                history = self.cache.get(conversation_id)
+                if history is None:
+                    token = self.cache.begin_load(conversation_id)
+                    history = self._load_history(conversation_id)
+                    self.cache.put(conversation_id, history, token)
+        if limit is not None:
+            history = history[-limit:]
+        return history
+
+    def _load_history(self, conversation_id: str) -> List[Dict[str, str]]:
+        """Read a conversation's full history from MySQL plus unwritten messages."""
+        # Read unwritten messages first: one committed in between then shows
+        # up in both lists and is de-duplicated below, rather than in neither.
+        pending = self.writer.pending(conversation_id) if self.writer else []
         
-        if conv and conv['history']:
-            import json
-            return json.loads(conv['history']) if isinstance(conv['history'], str) else conv['history']
-        return []
-
-    def get_prompt(self, user_message: str) -> str:
-        """Build the complete prompt for the LLM."""
-        prompt_parts = [f"System: {self.system_prompt}\n"]
+        rows = self.db.fetch_all(
+            "SELECT id, role, content, created_at, token_count FROM messages "
+            "WHERE conversation_id = %s ORDER BY seq",
+            (conversation_id,)
+        )
+        history = [
+            {
+                "id": row["id"],
+                "role": row["role"],
+                "content": row["content"],
+                "timestamp": row["created_at"].isoformat(),
+                "token_count": row["token_count"]
+            }
+            for row in rows
+        ]
+        stored = {msg["id"] for msg in history}
+        history.extend(msg for msg in pending if msg["id"] not in stored)
+        return history
+
+    @metrics.PROMPT_BUILD_SECONDS.time()
+    def get_prompt(self, conversation_id: str, user_message: str) -> str:
+        """
+        Build the complete prompt for the LLM.
         
-        history = self.get_history()
-        # Limit context size
-        recent_history = history[-MAX_HISTORY_MESSAGES:]
+        With a tokenizer, history is packed newest-first into what's left of
+        N_CTX after the system prompt, the user message and MAX_TOKENS for the
+        reply; without one, the last MAX_HISTORY_MESSAGES messages are used.
+        """
+        system = f"System: {self.system_prompt}\n\n"
+        if not self.context:
+            history = self.get_history(conversation_id, limit=MAX_HISTORY_MESSAGES or None)
+            return build_prompt(system, None, history, user_message)
         
-        for msg in recent_history:
-            role = msg["role"].capitalize()
-            content = msg["content"]
-            prompt_parts.append(f"{role}: {content}\n")
+        history = self.get_history(conversation_id)
+        uncounted = self.context.uncounted(history)
+        reserved = (self.context.text_tokens(system) +
+                    self.context.count_tokens(f"User: {user_message}\n\nAssistant:"))
+        start = self.context.window_start(history, self.context.budget(reserved))
         
-        prompt_parts.append(f"User: {user_message}\n")
-        prompt_parts.append("Assistant:")
+        summary = None
+        if start and self.summarize:
+            count, summary, summary_tokens = self._get_summary(conversation_id)
+            if summary:
+                start = self.context.window_start(
+                    history, self.context.budget(reserved + summary_tokens)
+                )
+            if start > count:
+                self._schedule_summary(conversation_id, history[count:start],
+                                       count, start, summary)
         
-        return "\n".join(prompt_parts)
+        self._store_token_counts([msg for msg in uncounted if msg.get("token_count") is not None])
+        return build_prompt(system, summary, history[start:], user_message)
 
-    def clear_history(self) -> None:
-        """Clear history for current conversation."""
-        if self.current_conversation_id:
-            self.db.execute_query(
-                "UPDATE conversations SET history = '[]' WHERE id = %s",
-                (self.current_conversation_id,)
-            )
+    def get_batch_prompt(self, conversation_id: Optional[str], instruction: str) -> str:
+        """
+        Prompt asking `instruction` about a stored conversation (or on its
+        own, without one), for batch jobs.
+
+        Unlike get_prompt, the history is read without caching it and no
+        summaries are scheduled, so a job over thousands of conversations
+        leaves the state of live ones alone. History that doesn't fit is
+        dropped oldest first.
+        """
+        system = f"System: {self.system_prompt}\n\n"
+        history = []
+        if conversation_id is not None:
+            history = self.cache.get(conversation_id)
+            if history is None:
+                history = self._load_history(conversation_id)
+        if not self.context:
+            if MAX_HISTORY_MESSAGES:
+                history = history[-MAX_HISTORY_MESSAGES:]
+            return build_prompt(system, None, history, instruction)
+        reserved = (self.context.text_tokens(system) +
+                    self.context.count_tokens(f"User: {instruction}\n\nAssistant:"))
+        start = self.context.window_start(history, self.context.budget(reserved))
+        return build_prompt(system, None, history[start:], instruction)
+
+    def _store_token_counts(self, messages: List[Dict]) -> None:
+        """Save token counts computed for messages stored before they were tracked."""
+        if not messages:
+            return
+        try:
+            with self.db.transaction() as cursor:
+                cursor.executemany(
+                    "UPDATE messages SET token_count = %s WHERE id = %s",
+                    [(msg["token_count"], msg["id"]) for msg in messages]
+                )
+        except Exception as e:
+            print(f"Error saving token counts: {e}")
+
+    def _get_summary(self, conversation_id: str) -> Tuple[int, Optional[str], int]:
+        """(messages covered, summary text, prompt tokens) for a conversation."""
+        with self._summary_lock:
+            cached = self._summaries.get(conversation_id)
+            if cached is not None:
+                self._summaries.move_to_end(conversation_id)
+                return cached
+        row = self.db.fetch_one(
+            "SELECT summary, summary_count FROM conversations WHERE id = %s",
+            (conversation_id,)
+        )
+        if not row:
+            return 0, None, 0  # Not cached: the row may only be missing while MySQL is down
+        if not row["summary"]:
+            entry = (0, None, 0)  # Cached too, so a warm conversation reads nothing
+        else:
+            entry = (row["summary_count"], row["summary"],
+                     self.context.count_tokens(summary_header(row["summary"])))
+        with self._summary_lock:
+            # A summary task may have stored a newer one while this read ran
+            if conversation_id not in self._summaries:
+                self._remember_summary(conversation_id, entry)
+        return entry
+
+    def _remember_summary(self, conversation_id: str,
+                          entry: Tuple[int, Optional[str], int]) -> None:
+        # Caller holds _summary_lock
+        self._summaries[conversation_id] = entry
+        self._summaries.move_to_end(conversation_id)
+        while len(self._summaries) > SUMMARY_CACHE_SIZE:
+            self._summaries.popitem(last=False)
+
+    def _schedule_summary(self, conversation_id: str, messages: List[Dict],
+                          count: int, start: int, summary: Optional[str]) -> None:
+        """Fold messages that left the window into the summary, in the background."""
+        with self._summary_lock:
+            if conversation_id in self._summarizing:
+                return
+            self._summarizing.add(conversation_id)
+            reset = self._summary_resets.get(conversation_id, 0)
+        threading.Thread(
+            target=self._update_summary,
+            args=(conversation_id, messages, count, start, summary, reset),
+            name="summarize",
+            daemon=True
+        ).start()
+
+    def _update_summary(self, conversation_id: str, messages: List[Dict], count: int,
+                        start: int, summary: Optional[str], reset: int) -> None:
+        try:
+            # Feed the transcript in pieces that fit the context with room
+            # for the running summary and the new one
+            chunk_budget = N_CTX - 3 * CONTEXT_SUMMARY_TOKENS
+            chunk, used = [], 0
+            for msg in messages + [None]:
+                cost = self.context.message_tokens(msg) if msg else 0
+                if chunk and (msg is None or used + cost > chunk_budget):
+                    summary = self.summarize(summary or "", "".join(chunk))
+                    chunk, used = [], 0
+                if msg:
+                    chunk.append(format_message(msg))
+                    used += cost
+            
+            tokens = self.context.count_tokens(summary_header(summary))
+            with self._summary_lock:
+                if self._summary_resets.get(conversation_id, 0) != reset:
+                    return  # Cleared or deleted meanwhile
+                self.db.execute_query(
+                    "UPDATE conversations SET summary = %s, summary_count = %s, "
+                    "updated_at = updated_at WHERE id = %s AND summary_count = %s",
+                    (summary, start, conversation_id, count)
+                )
+                self._remember_summary(conversation_id, (start, summary, tokens))
+        except Exception as e:
+            print(f"Error summarizing conversation {conversation_id}: {e}")
+        finally:
+            with self._summary_lock:
+                self._summarizing.discard(conversation_id)
+                # Resets only matter to a running task; the next one starts from 0
+                self._summary_resets.pop(conversation_id, None)
+
+    def _reset_summary(self, conversation_id: str) -> None:
+        with self._summary_lock:
+            self._summaries.pop(conversation_id, None)
+            if conversation_id in self._summarizing:
+                self._summary_resets[conversation_id] = self._summary_resets.get(conversation_id, 0) + 1
+
+    def clear_history(self, conversation_id: str) -> None:
+        """Clear a conversation's history."""
+        with self._lock(conversation_id):
+            if self.writer:
+                self.writer.discard(conversation_id)
+            self.cache.invalidate(conversation_id)
+            self._reset_summary(conversation_id)
+            with self.db.transaction() as cursor:
+                cursor.execute(
+                    "SELECT id FROM conversations WHERE id = %s FOR UPDATE",
+                    (conversation_id,)
+                )
+                cursor.fetchone()
+                cursor.execute(
+                    "DELETE FROM messages WHERE conversation_id = %s",
+                    (conversation_id,)
+                )
+                cursor.execute(
+                    "UPDATE conversations SET message_count = 0, preview = NULL, "
+                    "summary = NULL, summary_count = 0 WHERE id = %s",
+                    (conversation_id,)
+                )
+            if self.search_index:
+                self.search_index.remove_conversation(conversation_id)
 
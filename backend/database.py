@@ -1,59 +1,234 @@
 import mysql.connector
 from mysql.connector import Error
+from mysql.connector.errors import InterfaceError, OperationalError, PoolError
+from contextlib import contextmanager
+from datetime import datetime
 from dotenv import load_dotenv
+import json
+import metrics
 import os
+import queue
+import threading
+import time
+import uuid
+from typing import List, Optional
+
+from config import SEARCH_BACKEND
 
 load_dotenv()
 
+# Lock wait timeout and deadlock: the same statements can succeed on a retry
+RETRYABLE_ERRNOS = {1205, 1213}
+
+
+class ConnectionPool:
+    """Bounded, thread-safe pool of persistent MySQL connections."""
+
+    def __init__(self, connect, size: int, timeout: float, health_check_interval: float):
+        self._connect = connect
+        self.size = size
+        self.timeout = timeout
+        self.health_check_interval = health_check_interval
+        # LIFO keeps the warmest connections in use and lets extras go idle
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+
+    @contextmanager
+    def connection(self):
+        """Borrow a connection, waiting up to `timeout` seconds for a free one."""
+        if not self._slots.acquire(timeout=self.timeout):
+            raise PoolError("Timed out waiting for a database connection")
+        conn = None
+        try:
+            conn = self._checkout()
+            yield conn
+        except (InterfaceError, OperationalError):
+            # A broken connection is dropped rather than handed to the next caller
+            self._discard(conn)
+            conn = None
+            raise
+        except Exception:
+            if conn is not None and conn.in_transaction:
+                try:
+                    conn.rollback()
+                except Error:
+                    self._discard(conn)
+                    conn = None
+            raise
+        finally:
+            if conn is not None:
+                self._idle.put((conn, time.monotonic()))
+            self._slots.release()
+
+    def _checkout(self):
+        while True:
+            try:
+                conn, last_used = self._idle.get_nowait()
+            except queue.Empty:
+                return self._connect()
+            if time.monotonic() - last_used < self.health_check_interval:
+                return conn
+            try:
+                conn.ping(reconnect=True, attempts=1, delay=0)
+                return conn
+            except Error:
+                self._discard(conn)
+
+    @staticmethod
+    def _discard(conn) -> None:
+        if conn is None:
+            return
+        try:
+            conn.close()
+        except Error:
+            pass
+
+    def close(self) -> None:
+        """Close all idle connections."""
+        while True:
+            try:
+                conn, _ = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            self._discard(conn)
+
+
+# Tables and columns the application needs; migrate() creates them
+SCHEMA = {
+    "conversations": ("id", "title", "preview", "message_count", "summary", "summary_count",
+                      "created_at", "updated_at"),
+    "messages": ("id", "conversation_id", "seq", "role", "content", "created_at",
+                 "token_count"),
+}
+
+
 class DatabaseManager:
+    """
+    MySQL access through a connection pool.
+
+    Creating one opens no connections; the schema is created or upgraded by
+    migrate(), run once per deploy with `python migrate.py` (or at startup
+    with DB_AUTO_MIGRATE=true).
+    """
+
     def __init__(self):
         self.host = os.getenv('DB_HOST', 'localhost')
         self.user = os.getenv('DB_USER', 'root')
         self.password = os.getenv('DB_PASSWORD', 'root')
         self.database = os.getenv('DB_NAME', 'vamsify_llm_chat')
-        self.connection = None
-        self._init_db()
+        self.pool_size = int(os.getenv('DB_POOL_SIZE', '8'))
+        self.pool_timeout = float(os.getenv('DB_POOL_TIMEOUT', '10'))
+        self.pool = ConnectionPool(
+            self._connect,
+            size=self.pool_size,
+            timeout=self.pool_timeout,
+            health_check_interval=30
+        )
+        self._schema_ok = False
+        if os.getenv('DB_AUTO_MIGRATE', 'false').lower() == 'true':
+            self.migrate()
 
-    def _get_connection(self):
-        """Create a database connection."""
+    def _connect(self):
+        """Open a new connection to the application database."""
+        # Autocommit so reads on a reused connection never see a stale snapshot
+        return mysql.connector.connect(
+            host=self.host,
+            user=self.user,
+            password=self.password,
+            database=self.database,
+            autocommit=True
+        )
+
+    def migrate(self) -> bool:
+        """Create the database and tables, and upgrade older schemas."""
         try:
-            # First connect without database to create it if needed
+            # Connect without a database once to create it if needed
             connection = mysql.connector.connect(
                 host=self.host,
                 user=self.user,
                 password=self.password
             )
-            if connection.is_connected():
-                cursor = connection.cursor()
-                cursor.execute(f"CREATE DATABASE IF NOT EXISTS {self.database}")
-                connection.close()
-            
-            # Now connect to the database
-            self.connection = mysql.connector.connect(
-                host=self.host,
-                user=self.user,
-                password=self.password,
-                database=self.database
-            )
-            return self.connection
+            cursor = connection.cursor()
+            cursor.execute(f"CREATE DATABASE IF NOT EXISTS {self.database}")
+            cursor.close()
+            connection.close()
         except Error as e:
             print(f"Error connecting to MySQL: {e}")
+            return False
+
+        try:
+            with self.pool.connection() as conn:
+                self._create_tables(conn)
+            print("Database initialized successfully!")
+            return True
+        except Error as e:
+            print(f"Error initializing database: {e}")
+            return False
+
+    def missing_columns(self) -> Optional[List[str]]:
+        """
+        `table.column` (and `table.index`) names migrate() would still add,
+        or None if MySQL is unreachable.
+        """
+        try:
+            with self.pool.connection() as conn:
+                cursor = conn.cursor()
+                try:
+                    cursor.execute(
+                        "SELECT TABLE_NAME, COLUMN_NAME FROM information_schema.COLUMNS "
+                        "WHERE TABLE_SCHEMA = %s",
+                        (self.database,)
+                    )
+                    present = {f"{table}.{column}" for table, column in cursor.fetchall()}
+                    cursor.execute(
+                        "SELECT TABLE_NAME, INDEX_NAME FROM information_schema.STATISTICS "
+                        "WHERE TABLE_SCHEMA = %s",
+                        (self.database,)
+                    )
+                    present |= {f"{table}.{index}" for table, index in cursor.fetchall()}
+                finally:
+                    cursor.close()
+        except Error as e:
+            print(f"Error reading database schema: {e}")
             return None
+        missing = [f"{table}.{column}" for table, columns in SCHEMA.items()
+                   for column in columns if f"{table}.{column}" not in present]
+        # /search with SEARCH_BACKEND=mysql fails without it
+        if SEARCH_BACKEND == "mysql" and "messages.ft_messages_content" not in present:
+            missing.append("messages.ft_messages_content")
+        return missing
 
-    def _init_db(self):
+    def check(self) -> Optional[str]:
+        """None if MySQL is reachable and migrated, else what's wrong."""
+        if self._schema_ok:
+            return None if self.fetch_one("SELECT 1 AS ok") else "Database unreachable"
+        missing = self.missing_columns()
+        if missing is None:
+            return "Database unreachable"
+        if missing:
+            return (f"Database schema out of date (missing {', '.join(missing)}); "
+                    "run python migrate.py")
+        self._schema_ok = True
+        return None
+
+    def _create_tables(self, conn):
         """Initialize database tables."""
-        conn = self._get_connection()
-        if conn and conn.is_connected():
+        if conn.is_connected():
             cursor = conn.cursor()
             
-            # Create conversations table with JSON history
+            # Create conversations table; messages live in their own table
             cursor.execute("""
                 CREATE TABLE IF NOT EXISTS conversations (
                     id VARCHAR(255) PRIMARY KEY,
                     title VARCHAR(255),
+                    preview VARCHAR(255) NULL,
                     history JSON,
+                    message_count INT NOT NULL DEFAULT 0,
+                    summary MEDIUMTEXT NULL,
+                    summary_count INT NOT NULL DEFAULT 0,
                     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+                    INDEX idx_conversations_updated (updated_at, id)
                 )
             """)
             
@@ -63,66 +238,204 @@ class DatabaseManager:
                 print("Migrating conversations table: adding history column...")
                 cursor.execute("ALTER TABLE conversations ADD COLUMN history JSON")
             
-            # Drop messages table if exists (migration)
-            cursor.execute("DROP TABLE IF EXISTS messages")
+            cursor.execute("SHOW COLUMNS FROM conversations LIKE 'message_count'")
+            if not cursor.fetchone():
+                print("Migrating conversations table: adding message_count column...")
+                cursor.execute(
+                    "ALTER TABLE conversations ADD COLUMN message_count INT NOT NULL DEFAULT 0"
+                )
+            
+            cursor.execute("SHOW COLUMNS FROM conversations LIKE 'summary'")
+            if not cursor.fetchone():
+                print("Migrating conversations table: adding summary columns...")
+                cursor.execute(
+                    "ALTER TABLE conversations ADD COLUMN summary MEDIUMTEXT NULL, "
+                    "ADD COLUMN summary_count INT NOT NULL DEFAULT 0"
+                )
+            
+            cursor.execute("SHOW COLUMNS FROM conversations LIKE 'preview'")
+            if not cursor.fetchone():
+                print("Migrating conversations table: adding preview column...")
+                cursor.execute("ALTER TABLE conversations ADD COLUMN preview VARCHAR(255) NULL")
+            
+            # Serves the keyset-paginated conversation list
+            cursor.execute(
+                "SHOW INDEX FROM conversations WHERE Key_name = 'idx_conversations_updated'"
+            )
+            if not cursor.fetchall():
+                print("Migrating conversations table: indexing updated_at...")
+                cursor.execute(
+                    "CREATE INDEX idx_conversations_updated ON conversations (updated_at, id)"
+                )
+            
+            # Append-only message log, one row per message
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS messages (
+                    id VARCHAR(36) PRIMARY KEY,
+                    conversation_id VARCHAR(255) NOT NULL,
+                    seq INT NOT NULL,
+                    role VARCHAR(20) NOT NULL,
+                    content MEDIUMTEXT NOT NULL,
+                    created_at DATETIME(6) NOT NULL,
+                    token_count INT NULL,
+                    UNIQUE KEY uq_messages_conversation_seq (conversation_id, seq),
+                    CONSTRAINT fk_messages_conversation FOREIGN KEY (conversation_id)
+                        REFERENCES conversations(id) ON DELETE CASCADE
+                )
+            """)
+            
+            cursor.execute("SHOW COLUMNS FROM messages LIKE 'token_count'")
+            if not cursor.fetchone():
+                print("Migrating messages table: adding token_count column...")
+                cursor.execute("ALTER TABLE messages ADD COLUMN token_count INT NULL")
+            
+            # Serves /search with SEARCH_BACKEND=mysql; InnoDB keeps it up to date.
+            # Other backends don't need it (or the server may not support it).
+            cursor.execute("SHOW INDEX FROM messages WHERE Key_name = 'ft_messages_content'")
+            if not cursor.fetchall() and SEARCH_BACKEND == "mysql":
+                print("Migrating messages table: adding full-text index (may take a while)...")
+                cursor.execute("CREATE FULLTEXT INDEX ft_messages_content ON messages (content)")
             
             conn.commit()
             cursor.close()
-            conn.close()
-            print("Database initialized successfully!")
+            self._migrate_history(conn)
+            self._backfill_previews(conn)
 
-    def execute_query(self, query, params=None):
-        """Execute a query (INSERT, UPDATE, DELETE)."""
-        conn = self._get_connection()
-        if conn and conn.is_connected():
-            cursor = conn.cursor()
+    def _migrate_history(self, conn):
+        """Move messages out of the legacy JSON history column."""
+        cursor = conn.cursor(dictionary=True)
+        cursor.execute(
+            "SELECT id, history FROM conversations "
+            "WHERE history IS NOT NULL AND JSON_LENGTH(history) > 0"
+        )
+        pending = cursor.fetchall()
+        if pending:
+            print(f"Migrating {len(pending)} conversations to the messages table...")
+        for conv in pending:
+            history = conv['history']
+            if isinstance(history, (str, bytes)):
+                history = json.loads(history)
+            rows = []
+            for seq, msg in enumerate(history):
+                created_at = msg.get('timestamp')
+                rows.append((
+                    msg.get('id') or str(uuid.uuid4()),
+                    conv['id'],
+                    seq,
+                    msg['role'],
+                    msg['content'],
+                    datetime.fromisoformat(created_at) if created_at else datetime.now()
+                ))
+            conn.start_transaction()
             try:
-                if params:
-                    cursor.execute(query, params)
-                else:
-                    cursor.execute(query)
+                cursor.executemany(
+                    "INSERT IGNORE INTO messages (id, conversation_id, seq, role, content, created_at) "
+                    "VALUES (%s, %s, %s, %s, %s, %s)",
+                    rows
+                )
+                cursor.execute(
+                    "UPDATE conversations SET history = NULL, message_count = %s, "
+                    "updated_at = updated_at WHERE id = %s",
+                    (len(rows), conv['id'])
+                )
                 conn.commit()
-                return cursor.lastrowid
             except Error as e:
-                print(f"Error executing query: {e}")
-            finally:
-                cursor.close()
-                conn.close()
+                conn.rollback()
+                print(f"Error migrating conversation {conv['id']}: {e}")
+        cursor.close()
 
-    def fetch_all(self, query, params=None):
-        """Fetch all results (SELECT)."""
-        conn = self._get_connection()
-        if conn and conn.is_connected():
+    def _backfill_previews(self, conn):
+        """Fill in the preview of conversations written before it was kept."""
+        cursor = conn.cursor()
+        cursor.execute(
+            "UPDATE conversations c SET preview = ("
+            "    SELECT LEFT(m.content, 100) FROM messages m"
+            "    WHERE m.conversation_id = c.id ORDER BY m.seq DESC LIMIT 1"
+            "), updated_at = updated_at "
+            "WHERE c.preview IS NULL AND c.message_count > 0"
+        )
+        if cursor.rowcount > 0:
+            print(f"Added previews to {cursor.rowcount} conversations")
+        conn.commit()
+        cursor.close()
+
+    @staticmethod
+    def is_transient(error: Exception) -> bool:
+        """Whether a failed write may succeed later (lost connection, busy pool, lock conflict)."""
+        if isinstance(error, (InterfaceError, OperationalError, PoolError)):
+            return True
+        return isinstance(error, Error) and error.errno in RETRYABLE_ERRNOS
+
+    @contextmanager
+    def transaction(self):
+        """Run several statements atomically on one connection; yields a dictionary cursor."""
+        with metrics.DB_QUERY_SECONDS.time(operation="transaction"), \
+                self.pool.connection() as conn:
+            conn.start_transaction()
             cursor = conn.cursor(dictionary=True)
             try:
-                if params:
-                    cursor.execute(query, params)
-                else:
-                    cursor.execute(query)
-                return cursor.fetchall()
-            except Error as e:
-                print(f"Error fetching data: {e}")
-                return []
+                yield cursor
+                conn.commit()
+            except Exception:
+                metrics.DB_ERRORS.inc(operation="transaction")
+                conn.rollback()
+                raise
             finally:
                 cursor.close()
-                conn.close()
-        return []
+
+    def execute_query(self, query, params=None):
+        """Execute a query (INSERT, UPDATE, DELETE)."""
+        try:
+            with metrics.DB_QUERY_SECONDS.time(operation="execute_query"), \
+                    self.pool.connection() as conn:
+                cursor = conn.cursor()
+                try:
+                    if params:
+                        cursor.execute(query, params)
+                    else:
+                        cursor.execute(query)
+                    conn.commit()
+                    return cursor.lastrowid
+                finally:
+                    cursor.close()
+        except Error as e:
+            metrics.DB_ERRORS.inc(operation="execute_query")
+            print(f"Error executing query: {e}")
+
+    def fetch_all(self, query, params=None):
+        """Fetch all results (SELECT)."""
+        try:
+            with metrics.DB_QUERY_SECONDS.time(operation="fetch_all"), \
+                    self.pool.connection() as conn:
+                cursor = conn.cursor(dictionary=True)
+                try:
+                    if params:
+                        cursor.execute(query, params)
+                    else:
+                        cursor.execute(query)
+                    return cursor.fetchall()
+                finally:
+                    cursor.close()
+        except Error as e:
+            metrics.DB_ERRORS.inc(operation="fetch_all")
+            print(f"Error fetching data: {e}")
+            return []
 
     def fetch_one(self, query, params=None):
         """Fetch one result (SELECT)."""
-        conn = self._get_connection()
-        if conn and conn.is_connected():
-            cursor = conn.cursor(dictionary=True)
-            try:
-                if params:
-                    cursor.execute(query, params)
-                else:
-                    cursor.execute(query)
-                return cursor.fetchone()
-            except Error as e:
-                print(f"Error fetching data: {e}")
-                return None
-            finally:
-                cursor.close()
-                conn.close()
-        return None
+        try:
+            with metrics.DB_QUERY_SECONDS.time(operation="fetch_one"), \
+                    self.pool.connection() as conn:
+                cursor = conn.cursor(dictionary=True)
+                try:
+                    if params:
+                        cursor.execute(query, params)
+                    else:
+                        cursor.execute(query)
+                    return cursor.fetchone()
+                finally:
+                    cursor.close()
+        except Error as e:
+            metrics.DB_ERRORS.inc(operation="fetch_one")
+            print(f"Error fetching data: {e}")
+            return None
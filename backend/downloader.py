@@ -0,0 +1,299 @@
+"""
+Resumable, parallel file download for model weights.
+
+The file is fetched in fixed-size chunks over several HTTP range requests
+into `<dest>.part`; finished chunks are recorded in `<dest>.part.json`, so an
+interrupted download resumes where it stopped. The result is checked
+against the expected size (and SHA-256, if given) before it is renamed to
+`dest`, so a truncated or corrupt file never takes the model's place.
+
+Sources can be http(s):// URLs, file:// URLs or plain paths (e.g. a local
+mirror); servers without range support are downloaded in one stream.
+"""
+import hashlib
+import http.client
+import json
+import os
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable, Iterator, List, Optional, Tuple
+from urllib.parse import unquote, urlparse
+
+READ_SIZE = 1024 * 1024
+TIMEOUT = 30
+RETRIES = 3
+
+# What a failed or cut-off transfer raises; IncompleteRead and other
+# http.client errors are not OSErrors
+TRANSFER_ERRORS = (OSError, urllib.error.URLError, http.client.HTTPException)
+
+ProgressCallback = Callable[[int, Optional[int]], None]
+
+
+class DownloadError(RuntimeError):
+    """Raised when a file can't be fetched or fails verification."""
+
+
+def _local_path(source: str) -> Optional[Path]:
+    """The filesystem path of a file:// URL or plain path, else None."""
+    url = urlparse(source)
+    if url.scheme == "file":
+        return Path(unquote(url.path))
+    if url.scheme in ("http", "https"):
+        return None
+    return Path(source)  # A plain path, including Windows drive letters
+
+
+def _probe(source: str) -> Tuple[Optional[int], bool, str]:
+    """(size in bytes or None, whether ranges work, validator) for a source."""
+    path = _local_path(source)
+    if path is not None:
+        if not path.is_file():
+            raise DownloadError(f"No such file: {path}")
+        stat = path.stat()
+        return stat.st_size, True, f"{stat.st_size}-{stat.st_mtime_ns}"
+
+    request = urllib.request.Request(source, headers={"Range": "bytes=0-0"})
+    with urllib.request.urlopen(request, timeout=TIMEOUT) as response:
+        validator = response.headers.get("ETag") or response.headers.get("Last-Modified") or ""
+        content_range = response.headers.get("Content-Range", "")
+        if response.status == 206 and "/" in content_range:
+            total = content_range.rsplit("/", 1)[1]
+            return (int(total) if total.isdigit() else None), True, validator
+        length = response.headers.get("Content-Length")
+        return (int(length) if length else None), False, validator
+
+
+def _read_range(source: str, start: int, end: Optional[int]) -> Iterator[bytes]:
+    """Yield bytes start..end (inclusive; None = to the end) of a source."""
+    path = _local_path(source)
+    if path is not None:
+        with open(path, "rb") as f:
+            f.seek(start)
+            remaining = None if end is None else end - start + 1
+            while remaining is None or remaining > 0:
+                data = f.read(READ_SIZE if remaining is None else min(READ_SIZE, remaining))
+                if not data:
+                    return
+                if remaining is not None:
+                    remaining -= len(data)
+                yield data
+        return
+
+    headers = {}
+    if start or end is not None:
+        headers["Range"] = f"bytes={start}-{'' if end is None else end}"
+    request = urllib.request.Request(source, headers=headers)
+    with urllib.request.urlopen(request, timeout=TIMEOUT) as response:
+        if headers and response.status != 206:
+            raise DownloadError(f"Server ignored range request for {source}")
+        while True:
+            data = response.read(READ_SIZE)
+            if not data:
+                return
+            yield data
+
+
+def sha256_file(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(READ_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class _Progress:
+    """Thread-safe byte counter that reports at most a few times a second."""
+
+    def __init__(self, total: Optional[int], done: int, callback: Optional[ProgressCallback]):
+        self.total = total
+        self.done = done
+        self._callback = callback
+        self._lock = threading.Lock()
+        self._reported = 0.0
+
+    def add(self, n: int) -> None:
+        with self._lock:
+            self.done += n
+            now = time.monotonic()
+            if self._callback is None or now - self._reported < 0.25:
+                return
+            self._reported = now
+            done = self.done
+        self._callback(done, self.total)
+
+    def finish(self) -> None:
+        if self._callback is not None:
+            self._callback(self.done, self.total)
+
+
+def download(source: str, dest: Path, sha256: Optional[str] = None,
+             connections: int = 4, chunk_size: int = 16 * 1024 * 1024,
+             progress: Optional[ProgressCallback] = None) -> None:
+    """
+    Download `source` to `dest`, resuming an earlier partial download.
+
+    Raises:
+        DownloadError: If the source can't be read, or the result has the
+            wrong size or checksum (the partial file is then discarded)
+    """
+    dest = Path(dest)
+    dest.parent.mkdir(parents=True, exist_ok=True)
+    part = dest.with_name(dest.name + ".part")
+    state_path = dest.with_name(dest.name + ".part.json")
+
+    try:
+        size, ranged, validator = _probe(source)
+    except TRANSFER_ERRORS as e:
+        raise DownloadError(f"Cannot reach {source}: {e}") from e
+
+    if size is not None and ranged:
+        received = _download_chunks(source, part, state_path, size, validator,
+                                    max(connections, 1), chunk_size, progress)
+        if received != size:
+            raise DownloadError(
+                f"Downloaded {received} bytes, expected {size}; will resume on retry"
+            )
+    else:
+        # No ranges: a partial file can't be resumed
+        state_path.unlink(missing_ok=True)
+        counter = _Progress(size, 0, progress)
+        try:
+            with open(part, "wb") as f:
+                for data in _read_range(source, 0, None):
+                    f.write(data)
+                    counter.add(len(data))
+        except TRANSFER_ERRORS as e:
+            raise DownloadError(f"Download of {source} failed: {e}") from e
+        counter.finish()
+        actual = part.stat().st_size
+        if size is not None and actual != size:
+            raise DownloadError(
+                f"Downloaded {actual} bytes, expected {size}; the server does not "
+                f"support resuming, so a retry starts over"
+            )
+    if sha256:
+        digest = sha256_file(part)
+        if digest.lower() != sha256.lower():
+            part.unlink(missing_ok=True)
+            state_path.unlink(missing_ok=True)
+            raise DownloadError(f"Checksum mismatch for {dest.name}: got {digest}, expected {sha256}")
+
+    with open(part, "rb+") as f:
+        os.fsync(f.fileno())
+    os.replace(part, dest)
+    state_path.unlink(missing_ok=True)
+
+
+def _load_state(state_path: Path, part: Path, source: str, size: int,
+                validator: str, chunk_size: int) -> List[int]:
+    """Chunks already on disk from an earlier attempt at the same file."""
+    if not part.exists() or not state_path.exists():
+        return []
+    try:
+        state = json.loads(state_path.read_text())
+    except (OSError, ValueError):
+        return []
+    if (state.get("source"), state.get("size"), state.get("validator"),
+            state.get("chunk_size")) != (source, size, validator, chunk_size):
+        return []  # A different file, or it changed on the server
+    return list(state.get("done", []))
+
+
+def _save_state(state_path: Path, source: str, size: int, validator: str,
+                chunk_size: int, done: List[int]) -> None:
+    tmp = state_path.with_name(state_path.name + ".tmp")
+    tmp.write_text(json.dumps({
+        "source": source, "size": size, "validator": validator,
+        "chunk_size": chunk_size, "done": sorted(done),
+    }))
+    os.replace(tmp, state_path)
+
+
+def _download_chunks(source: str, part: Path, state_path: Path, size: int, validator: str,
+                     connections: int, chunk_size: int,
+                     progress: Optional[ProgressCallback]) -> int:
+    """Fetch the chunks not yet on disk; returns the bytes of all finished chunks."""
+    n_chunks = max((size + chunk_size - 1) // chunk_size, 1)
+    done = _load_state(state_path, part, source, size, validator, chunk_size)
+    if not done:
+        part.unlink(missing_ok=True)
+    with open(part, "ab"):
+        pass
+    os.truncate(part, size)
+
+    chunk_bytes = lambda i: min(chunk_size, size - i * chunk_size)
+    todo = [i for i in range(n_chunks) if i not in set(done)]
+    counter = _Progress(size, sum(chunk_bytes(i) for i in done), progress)
+    lock = threading.Lock()
+    failed = threading.Event()
+    fd = os.open(part, os.O_RDWR | getattr(os, "O_BINARY", 0))
+
+    def fetch(index: int) -> None:
+        start = index * chunk_size
+        end = start + chunk_bytes(index) - 1
+        for attempt in range(RETRIES):
+            if failed.is_set():
+                return
+            offset = start
+            try:
+                for data in _read_range(source, offset, end):
+                    if failed.is_set():
+                        return  # Another chunk failed; keep what's recorded
+                    _pwrite(fd, data, offset)
+                    offset += len(data)
+                    counter.add(len(data))
+                if offset != end + 1:
+                    raise DownloadError(f"Chunk {index} ended early")
+                with lock:
+                    done.append(index)
+                    _save_state(state_path, source, size, validator, chunk_size, done)
+                return
+            except TRANSFER_ERRORS + (DownloadError,) as e:
+                counter.add(start - offset)
+                if attempt == RETRIES - 1:
+                    failed.set()
+                    raise DownloadError(f"Chunk {index} of {source} failed: {e}") from e
+                time.sleep(2 ** attempt)
+
+    try:
+        with ThreadPoolExecutor(max_workers=min(connections, max(len(todo), 1))) as pool:
+            futures = [pool.submit(fetch, index) for index in todo]
+            try:
+                for future in futures:
+                    future.result()
+            except BaseException:
+                # Includes Ctrl+C: finished chunks are kept for the next attempt
+                failed.set()
+                pool.shutdown(cancel_futures=True)
+                raise
+    finally:
+        os.close(fd)
+    counter.finish()
+    # The part file is pre-sized, so count what was actually received
+    return sum(chunk_bytes(i) for i in set(done))
+
+
+_write_lock = threading.Lock()
+
+
+def _write_at(fd: int, data: bytes, offset: int) -> None:
+    """os.pwrite for platforms without it."""
+    with _write_lock:
+        os.lseek(fd, offset, os.SEEK_SET)
+        os.write(fd, data)
+
+
+_pwrite = getattr(os, "pwrite", _write_at)
+
+
+def mirror_url(mirror: str, name: str) -> str:
+    """Where a mirror (base URL or directory) keeps the file `name`."""
+    if _local_path(mirror) is not None and urlparse(mirror).scheme != "file":
+        return str(Path(mirror) / name)
+    return mirror.rstrip("/") + "/" + name
+
@@ -0,0 +1,110 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+
+def _message_size(message: Dict) -> int:
+    # Rough in-memory footprint: content plus ids, role, timestamp and dict overhead
+    return len(message["content"]) + 200
+
+
+class HistoryCache:
+    """
+    LRU cache of conversation histories, bounded by size and age.
+
+    ConversationManager writes new messages through to cached entries, so
+    an active conversation is served without touching MySQL. A load that
+    races with a write is discarded rather than caching a stale history.
+    """
+
+    def __init__(self, capacity_bytes: int, ttl_seconds: float):
+        self.capacity_bytes = capacity_bytes
+        self.ttl_seconds = ttl_seconds
+        self._entries: "OrderedDict[str, Tuple[List[Dict], int, float]]" = OrderedDict()
+        self._loads: Dict[str, object] = {}
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, conversation_id: str) -> Optional[List[Dict]]:
+        """Return the cached history, or None on a miss."""
+        with self._lock:
+            entry = self._live_entry(conversation_id)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(conversation_id)
+            return list(entry[0])
+
+    def contains(self, conversation_id: str) -> bool:
+        """Whether an unexpired history is cached."""
+        with self._lock:
+            return self._live_entry(conversation_id) is not None
+
+    def begin_load(self, conversation_id: str) -> object:
+        """Mark the start of a database load; pass the token to put()."""
+        token = object()
+        with self._lock:
+            self._loads[conversation_id] = token
+        return token
+
+    def put(self, conversation_id: str, history: List[Dict], token: object) -> None:
+        """Cache a loaded history unless it was written to while loading."""
+        with self._lock:
+            if self._loads.get(conversation_id) is not token:
+                return
+            del self._loads[conversation_id]
+            self._store(conversation_id, list(history))
+
+    def append(self, conversation_id: str, messages: List[Dict]) -> None:
+        """Write new messages through to a cached history."""
+        with self._lock:
+            self._loads.pop(conversation_id, None)
+            entry = self._entries.get(conversation_id)
+            if entry is not None:
+                size = entry[1] + sum(_message_size(m) for m in messages)
+                self._store(conversation_id, entry[0] + messages, size)
+
+    def invalidate(self, conversation_id: str) -> None:
+        with self._lock:
+            self._loads.pop(conversation_id, None)
+            if conversation_id in self._entries:
+                self._remove(conversation_id)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "size_bytes": self._size,
+                "capacity_bytes": self.capacity_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+    def _live_entry(self, conversation_id: str) -> Optional[Tuple[List[Dict], int, float]]:
+        # Caller holds the lock; drops the entry if it has expired
+        entry = self._entries.get(conversation_id)
+        if entry is not None and time.monotonic() - entry[2] > self.ttl_seconds:
+            self._remove(conversation_id)
+            return None
+        return entry
+
+    def _store(self, conversation_id: str, history: List[Dict],
+               size: Optional[int] = None) -> None:
+        if conversation_id in self._entries:
+            self._remove(conversation_id)
+        if size is None:
+            size = sum(_message_size(m) for m in history)
+        if size > self.capacity_bytes:
+            return
+        self._entries[conversation_id] = (history, size, time.monotonic())
+        self._size += size
+        while self._size > self.capacity_bytes:
+            self._remove(next(iter(self._entries)))
+
+    def _remove(self, conversation_id: str) -> None:
+        _, size, _ = self._entries.pop(conversation_id)
+        self._size -= size
@@ -0,0 +1,114 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional, Set, Tuple
+
+
+def prefix_hash(tokens: List[int]) -> str:
+    """Stable hash of a token sequence."""
+    digest = hashlib.sha1()
+    for token in tokens:
+        digest.update(token.to_bytes(4, "little", signed=True))
+    return digest.hexdigest()
+
+
+def common_prefix_length(a: List[int], b: List[int]) -> int:
+    """Number of leading tokens two sequences share."""
+    n = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        n += 1
+    return n
+
+
+class CachedSequence:
+    """KV cache contents of one sequence, as copied out of llama.cpp."""
+
+    def __init__(self, tokens: List[int], data: bytes):
+        self.tokens = tokens
+        self.data = data
+
+    @property
+    def size(self) -> int:
+        return len(self.data) + 4 * len(self.tokens)
+
+
+class KVStateCache:
+    """
+    LRU cache of per-conversation KV state within a memory budget.
+
+    Entries are keyed by conversation id and the hash of the tokens they
+    cover. A lookup returns the entry sharing the longest prefix with the
+    new prompt, so a follow-up turn only needs to evaluate what was added
+    since the previous one.
+    """
+
+    def __init__(self, capacity_bytes: int):
+        self.capacity_bytes = capacity_bytes
+        self._entries: "OrderedDict[Tuple[str, str], CachedSequence]" = OrderedDict()
+        self._by_conversation: Dict[str, Set[Tuple[str, str]]] = {}
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def lookup(self, conversation_id: str,
+               tokens: List[int]) -> Tuple[Optional[CachedSequence], int]:
+        """Return the best cached sequence for a prompt and how many tokens it reuses."""
+        with self._lock:
+            best_key, best_len = None, 0
+            for key in self._by_conversation.get(conversation_id, ()):
+                n = common_prefix_length(self._entries[key].tokens, tokens)
+                if n > best_len:
+                    best_key, best_len = key, n
+            if best_key is None:
+                self.misses += 1
+                return None, 0
+            self.hits += 1
+            self._entries.move_to_end(best_key)
+            return self._entries[best_key], best_len
+
+    def store(self, conversation_id: str, tokens: List[int], data: bytes) -> None:
+        """Cache a sequence's KV data as the conversation's latest state."""
+        entry = CachedSequence(list(tokens), data)
+        if entry.size > self.capacity_bytes:
+            return
+        key = (conversation_id, prefix_hash(entry.tokens))
+        with self._lock:
+            # A conversation only moves forward; its previous turn's state is
+            # superseded by this one.
+            for old in list(self._by_conversation.get(conversation_id, ())):
+                self._remove(old)
+            self._entries[key] = entry
+            self._by_conversation.setdefault(conversation_id, set()).add(key)
+            self._size += entry.size
+            while self._size > self.capacity_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def drop(self, conversation_id: str) -> None:
+        """Forget everything cached for a conversation."""
+        with self._lock:
+            for key in list(self._by_conversation.get(conversation_id, ())):
+                self._remove(key)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "size_bytes": self._size,
+                "capacity_bytes": self.capacity_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+    def _remove(self, key: Tuple[str, str]) -> None:
+        entry = self._entries.pop(key)
+        self._size -= entry.size
+        keys = self._by_conversation[key[0]]
+        keys.discard(key)
+        if not keys:
+            del self._by_conversation[key[0]]
@@ -1,107 +1,631 @@
+import asyncio
 import os
-import urllib.request
+import threading
+import time
 from pathlib import Path
-from typing import Iterator
+from typing import AsyncIterator, Callable, Dict, Iterator, List, Optional, Tuple
+import llama_cpp
 from llama_cpp import Llama
+import metrics
+from downloader import DownloadError, download, mirror_url
+from kv_cache import KVStateCache, prefix_hash
+from model_registry import ModelRegistry, ModelSpec, load_model_specs
+from response_cache import ResponseCache, replay_chunks
+from scheduler import GenerationRequest, InferenceScheduler
+from worker_pool import WorkerPool
 from config import (
-    MODEL_PATH, MODEL_URL, MODEL_NAME,
+    MODELS_DIR, MODEL_PATH, SYSTEM_PROMPT,
+    MODEL_MIRROR, DOWNLOAD_CONNECTIONS, DOWNLOAD_CHUNK_MB,
     N_CTX, N_THREADS, N_GPU_LAYERS,
-    MAX_TOKENS, TEMPERATURE
+    MAX_TOKENS, TEMPERATURE, CONTEXT_SUMMARY_TOKENS,
+    MAX_BATCH_SLOTS, MAX_QUEUE_DEPTH, KV_CACHE_MB, PERSIST_PREFIX_STATE,
+    PROMPT_LOOKUP_TOKENS, PROMPT_LOOKUP_NGRAM,
+    MODEL_WORKERS, WORKER_THREADS, PIN_WORKER_CPUS,
+    RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL, RESPONSE_CACHE_DISK_PATH,
+    RESPONSE_CACHE_SEMANTIC, RESPONSE_CACHE_SIMILARITY, RESPONSE_CACHE_IGNORE_CASE,
+    RESPONSE_REPLAY_DELAY
 )
 
+STOP_SEQUENCES = ["User:", "System:"]
 
-class LLMHandler:
-    """Handles LLM model loading and inference."""
-    
-    def __init__(self):
-        self.model = None
-        self._ensure_model_exists()
-        self._load_model()
-    
-    def _ensure_model_exists(self) -> None:
-        """Download the model if it doesn't exist locally."""
-        if MODEL_PATH.exists():
-            print(f"✓ Model found: {MODEL_PATH}")
+# Every prompt built by ConversationManager.get_prompt starts with this header
+SYSTEM_PREFIX = f"System: {SYSTEM_PROMPT}\n\n"
+
+# Sampling outcomes whose text is worth caching
+CACHEABLE_FINISH_REASONS = ("stop", "length")
+
+SUMMARY_INSTRUCTIONS = (
+    "System: Summarize the conversation below in one short paragraph. "
+    "Keep names, facts, decisions and open questions.\n\n"
+)
+
+# Scheduler stats added up across models in LLMHandler.stats()
+TOTALED_STATS = ("queue_depth", "active_slots", "max_slots", "tokens_per_second",
+                 "submitted", "rejected", "cancelled", "completed", "failed",
+                 "generated_tokens", "prefix_reused_tokens",
+                 "drafted_tokens", "accepted_draft_tokens")
+
+
+def _prefix_state_path(model_path: Path, prefix_tokens) -> Path | None:
+    """Where the system prompt's KV state is saved, next to the model."""
+    if not PERSIST_PREFIX_STATE:
+        return None
+    return MODELS_DIR / f"{model_path.stem}.{prefix_hash(prefix_tokens)[:12]}.prefix"
+
+
+def first_turn_question(prompt: str) -> Optional[str]:
+    """The user message of a prompt with no history before it, else None."""
+    body = prompt[len(SYSTEM_PREFIX):] if prompt.startswith(SYSTEM_PREFIX) else None
+    if not body or not body.startswith("User: ") or not body.endswith("\n\nAssistant:"):
+        return None
+    question = body[len("User: "):-len("\n\nAssistant:")]
+    if "\n\nAssistant: " in question or "\n\nUser: " in question:
+        return None
+    return question
+
+
+def load_scheduler(model_path: Path = MODEL_PATH,
+                   n_threads: Optional[int] = N_THREADS) -> Tuple[Llama, InferenceScheduler]:
+    """Load a model and start an inference scheduler on it."""
+    # The KV cache is shared by all decode slots, each of which may
+    # use up to N_CTX positions.
+    model = Llama(
+        model_path=str(model_path),
+        n_ctx=N_CTX * MAX_BATCH_SLOTS,
+        n_threads=n_threads,
+        n_gpu_layers=N_GPU_LAYERS,
+        verbose=False
+    )
+    kv_cache = KVStateCache(KV_CACHE_MB * 1024 * 1024) if KV_CACHE_MB > 0 else None
+    prefix_tokens = model.tokenize(SYSTEM_PREFIX.encode("utf-8"), special=True)
+    scheduler = InferenceScheduler(
+        model,
+        max_slots=MAX_BATCH_SLOTS,
+        max_queue=MAX_QUEUE_DEPTH,
+        n_ctx=N_CTX,
+        kv_cache=kv_cache,
+        shared_prefix=prefix_tokens,
+        prefix_state_path=_prefix_state_path(model_path, prefix_tokens),
+        draft_tokens=PROMPT_LOOKUP_TOKENS,
+        draft_ngram=PROMPT_LOOKUP_NGRAM
+    )
+    return model, scheduler
+
+
+def estimate_memory(model_path: Path, processes: int = 1) -> int:
+    """
+    Rough resident size of a model in bytes: its weights (mmap'd, so shared
+    by worker processes), plus each process's KV cache for MAX_BATCH_SLOTS
+    full contexts and its KV_CACHE_MB of saved conversation state.
+    """
+    vocab = Llama(model_path=str(model_path), vocab_only=True, verbose=False)
+    meta = vocab.metadata
+    vocab.close()
+    arch = meta.get("general.architecture", "llama")
+    n_layer = int(meta.get(f"{arch}.block_count", 0))
+    n_embd = int(meta.get(f"{arch}.embedding_length", 0))
+    n_head = int(meta.get(f"{arch}.attention.head_count", 1)) or 1
+    n_head_kv = int(meta.get(f"{arch}.attention.head_count_kv", n_head))
+    # 16-bit keys and values for every layer and position
+    kv_bytes = 2 * 2 * n_layer * (n_embd // n_head) * n_head_kv * N_CTX * MAX_BATCH_SLOTS
+    per_process = kv_bytes + KV_CACHE_MB * 1024 * 1024
+    return model_path.stat().st_size + per_process * processes
+
+
+class _HeldStream:
+    """Iterates a generation's chunks, calling `release` once when done or closed."""
+
+    def __init__(self, chunks: Iterator[str], release: Callable[[], None]):
+        self._chunks = chunks
+        self._release = release
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> str:
+        try:
+            return next(self._chunks)
+        except BaseException:
+            self.close()
+            raise
+
+    def close(self) -> None:
+        release, self._release = self._release, None
+        if release is None:
             return
-        
-        print(f"Model not found. Downloading {MODEL_NAME}...")
-        print(f"URL: {MODEL_URL}")
-        print(f"Destination: {MODEL_PATH}")
-        print("This may take several minutes (800MB-2GB)...")
-        
         try:
-            # Download with progress
-            def report_progress(block_num, block_size, total_size):
-                downloaded = block_num * block_size
-                percent = min(downloaded * 100 / total_size, 100)
-                print(f"\rDownloading: {percent:.1f}%", end="", flush=True)
-            
-            urllib.request.urlretrieve(
-                MODEL_URL,
-                MODEL_PATH,
-                reporthook=report_progress
-            )
-            print("\n✓ Download complete!")
-        except Exception as e:
-            print(f"\n✗ Download failed: {e}")
+            close = getattr(self._chunks, "close", None)
+            if close is not None:
+                close()
+        finally:
+            release()
+
+    def __del__(self):
+        self.close()
+
+
+class _HeldAsyncStream:
+    """Async counterpart of _HeldStream."""
+
+    def __init__(self, chunks: AsyncIterator[str], release: Callable[[], None]):
+        self._chunks = chunks
+        self._release = release
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> str:
+        try:
+            return await self._chunks.__anext__()
+        except BaseException:
+            await self.aclose()
             raise
-    
-    def _load_model(self) -> None:
-        """Load the LLM model into memory."""
-        print(f"Loading model: {MODEL_NAME}...")
+
+    async def aclose(self) -> None:
+        release, self._release = self._release, None
+        if release is None:
+            return
         try:
-            self.model = Llama(
-                model_path=str(MODEL_PATH),
-                n_ctx=N_CTX,
-                n_threads=N_THREADS,
-                n_gpu_layers=N_GPU_LAYERS,
-                verbose=False
+            aclose = getattr(self._chunks, "aclose", None)
+            if aclose is not None:
+                await aclose()
+        finally:
+            release()
+
+    def __del__(self):
+        # Unfinished async generators are finalized by the event loop
+        release, self._release = self._release, None
+        if release is not None:
+            release()
+
+
+class LLMHandler:
+    """
+    Serves generations from the models in the registry.
+
+    Requests name a model (or get the default one); see model_registry for
+    how models are loaded, unloaded and swapped. With MODEL_WORKERS set, the
+    default model runs in the worker pool and the others in this process.
+    """
+
+    def __init__(self, background: bool = False):
+        """
+        Args:
+            background: Download and load the default model on a background
+                thread and return at once; is_loaded() turns True when it's
+                ready and status() reports progress until then
+        """
+        specs, default = load_model_specs()
+        self._pool = None
+        if MODEL_WORKERS > 0:
+            # Fork the worker supervisor now, before the server starts threads;
+            # the workers load the model once it's on disk
+            self._pool = WorkerPool(
+                MODEL_WORKERS,
+                threads=WORKER_THREADS,
+                pin_cpus=PIN_WORKER_CPUS,
+                max_slots=MAX_BATCH_SLOTS,
+                max_queue=MAX_QUEUE_DEPTH,
+                model_path=specs[default].path
             )
-            print("✓ Model loaded successfully!")
-        except Exception as e:
-            print(f"✗ Failed to load model: {e}")
-            raise
-    
-    def generate(self, prompt: str, stream: bool = False) -> str | Iterator[str]:
+        self.registry = ModelRegistry(specs, default, self._create_engine)
+        self.registry.load(wait=not background)
+
+    def _create_engine(self, spec: ModelSpec) -> "ModelEngine":
+        pool = self._pool if spec.name == self.registry.default else None
+        return ModelEngine(spec, pool)
+
+    def status(self) -> Dict:
+        """Default model's loading state: downloading, loading, ready or failed."""
+        return self.registry.status()
+
+    def is_loaded(self) -> bool:
+        """Check if the default model is loaded."""
+        return self.registry.resident() is not None
+
+    def model_names(self) -> List[str]:
+        return self.registry.names()
+
+    def models(self) -> Dict:
+        """Every model with its state, plus memory use against MODEL_MEMORY_MB."""
+        return {
+            "default": self.registry.default,
+            "models": self.registry.list(),
+            "memory": self.registry.memory(),
+        }
+
+    def load_model(self, name: str) -> Dict:
+        """Start loading a model in the background; returns its state."""
+        self.registry.load(name)
+        return self.registry.status(name)
+
+    def swap_model(self, name: str, file: str, url: Optional[str] = None,
+                   sha256: Optional[str] = None) -> Dict:
+        """
+        Serve `name` from another file (registering it if it's new). The
+        current weights keep serving until the new ones are loaded.
+
+        Raises:
+            ValueError: For the default model when it runs in worker processes
+        """
+        if self._pool is not None and name == self.registry.default:
+            raise ValueError("The default model runs in MODEL_WORKERS processes; "
+                             "change it by restarting the server")
+        self.registry.swap(ModelSpec.from_dict(name, {"file": file, "url": url, "sha256": sha256}))
+        return self.registry.status(name)
+
+    def generate(self, prompt: str, stream: bool = False,
+                 conversation_id: Optional[str] = None,
+                 model: Optional[str] = None,
+                 use_cache: bool = True) -> str | Iterator[str]:
         """
         Generate a response from the LLM.
-        
+
+        The prompt is queued on the model's inference scheduler, which
+        interleaves it with other in-flight generations. Closing the
+        returned iterator cancels the generation. Answers found in the
+        response cache are returned (or replayed, when streaming) without
+        running the model.
+
         Args:
             prompt: The input prompt
             stream: If True, return an iterator for streaming responses
-        
+            conversation_id: Reuse (and update) this conversation's cached
+                KV state so only the new part of the prompt is evaluated
+            model: Name of the model to use (default: the default model)
+            use_cache: Answer from, and add to, the response cache; batch
+                jobs turn this off so their answers and users' stay apart
+
         Returns:
             Complete response string or iterator of response chunks
+
+        Raises:
+            UnknownModelError: If there is no such model
+            ModelNotReadyError: If the model is still loading
+            SchedulerFullError: If too many requests are already waiting
         """
+        engine = self.registry.acquire(model)
+        try:
+            result = engine.generate(prompt, stream=stream, conversation_id=conversation_id,
+                                     use_cache=use_cache)
+        except BaseException:
+            self.registry.release(engine)
+            raise
+        if not stream:
+            self.registry.release(engine)
+            return result
+        # The engine stays loaded until the stream is finished or closed
+        return _HeldStream(result, lambda: self.registry.release(engine))
+
+    async def stream_async(self, prompt: str, conversation_id: Optional[str] = None,
+                           model: Optional[str] = None) -> AsyncIterator[str]:
+        """
+        Queue a generation and return an async iterator over its chunks.
+
+        For the ASGI server: chunks are awaited on the event loop instead
+        of blocking a thread, and cancelling the consuming task cancels the
+        generation.
+
+        Raises:
+            UnknownModelError: If there is no such model
+            ModelNotReadyError: If the model is still loading
+            SchedulerFullError: If too many requests are already waiting
+        """
+        engine = self.registry.acquire(model)
+        try:
+            chunks = await engine.stream_async(prompt, conversation_id=conversation_id)
+        except BaseException:
+            self.registry.release(engine)
+            raise
+        return _HeldAsyncStream(chunks, lambda: self.registry.release(engine))
+
+    def count_tokens(self, text: str) -> int:
+        """Number of tokens `text` takes up inside a prompt, by the default model's vocabulary."""
+        engine = self.registry.resident()
+        if engine is None:
+            raise RuntimeError("Model not loaded")
+        return engine.count_tokens(text)
+
+    def summarize(self, summary: str, transcript: str) -> str:
+        """Fold a transcript into an existing (possibly empty) summary, with the default model."""
+        engine = self.registry.acquire()
+        try:
+            return engine.summarize(summary, transcript)
+        finally:
+            self.registry.release(engine)
+
+    def forget_conversation(self, conversation_id: str) -> None:
+        """Release cached KV state for a deleted or cleared conversation."""
+        for engine in self.registry.engines().values():
+            engine.forget(conversation_id)
+
+    def stats(self) -> Dict:
+        """Queue and throughput metrics, totaled and per loaded model."""
+        per_model = {name: engine.stats() for name, engine in self.registry.engines().items()}
+        totals = {key: round(sum(s.get(key, 0) for s in per_model.values()), 2)
+                  for key in TOTALED_STATS}
+        return {**totals, "models": per_model}
+
+
+class ModelEngine:
+    """One model's weights, scheduler (or worker pool), response cache and embedder."""
+
+    def __init__(self, spec: ModelSpec, pool: Optional[WorkerPool] = None):
+        """
+        Args:
+            spec: The model to load
+            pool: Run generations in this worker pool instead of in-process
+        """
+        self.spec = spec
+        self.model = None
+        self.scheduler = None
+        self.response_cache = None
+        self.embedder = None
+        self.memory = 0
+        self._embed_lock = threading.Lock()
+        self._pool = pool
+
+    def prepare(self, report: Callable[[str, float], None]) -> None:
+        """Download the model if needed and estimate its memory use."""
+        self._ensure_model_exists(report)
+        self.memory = estimate_memory(self.spec.path, MODEL_WORKERS if self._pool else 1)
+
+    def _ensure_model_exists(self, report: Callable[[str, float], None]) -> None:
+        """Download the model if it doesn't exist locally."""
+        path = self.spec.path
+        if path.exists():
+            print(f"✓ Model found: {path}")
+            return
+
+        sources = [mirror_url(MODEL_MIRROR, path.name)] if MODEL_MIRROR else []
+        if self.spec.url:
+            sources.append(self.spec.url)
+        if not sources:
+            raise FileNotFoundError(f"{path} doesn't exist and model '{self.spec.name}' has no url")
+        report("downloading", 0.0)
+        print(f"Model not found. Downloading {path.name}...")
+        print(f"Destination: {path}")
+        print("This may take several minutes (800MB-2GB); an interrupted download resumes.")
+
+        def report_progress(done, total):
+            if total:
+                report("downloading", done / total)
+                print(f"\rDownloading: {done / total * 100:.1f}%", end="", flush=True)
+
+        for i, source in enumerate(sources):
+            print(f"URL: {source}")
+            try:
+                download(
+                    source,
+                    path,
+                    sha256=self.spec.sha256,
+                    connections=DOWNLOAD_CONNECTIONS,
+                    chunk_size=DOWNLOAD_CHUNK_MB * 1024 * 1024,
+                    progress=report_progress
+                )
+                print("\n✓ Download complete!")
+                return
+            except DownloadError as e:
+                print(f"\n✗ Download failed: {e}")
+                if i == len(sources) - 1:
+                    raise
+
+    def load(self) -> None:
+        """Load the model into memory."""
+        if self._pool is not None:
+            self._pool.start()
+            # Generation runs in the workers; this process only tokenizes
+            model = Llama(model_path=str(self.spec.path), vocab_only=True, verbose=False)
+            self.scheduler = self._pool
+        else:
+            model, self.scheduler = load_scheduler(self.spec.path)
+        if RESPONSE_CACHE_SIZE > 0:
+            self.response_cache = self._create_response_cache()
+        self.model = model
+
+    def close(self) -> None:
+        """Stop the scheduler and free the weights."""
+        if self.scheduler is not None:
+            self.scheduler.close()
+        for llama in (self.embedder, self.model):
+            if llama is not None:
+                llama.close()
+        self.scheduler = self.model = self.embedder = self.response_cache = None
+
+    def _create_response_cache(self) -> ResponseCache:
+        embed = None
+        if RESPONSE_CACHE_SEMANTIC:
+            # A small embedding context over the same mmap'd weights
+            self.embedder = Llama(
+                model_path=str(self.spec.path),
+                embedding=True,
+                n_ctx=512,
+                n_threads=N_THREADS,
+                pooling_type=llama_cpp.LLAMA_POOLING_TYPE_MEAN,
+                verbose=False
+            )
+            embed = self._embed
+        return ResponseCache(
+            RESPONSE_CACHE_SIZE,
+            RESPONSE_CACHE_TTL,
+            settings={
+                "model": self.spec.path.name,
+                "temperature": TEMPERATURE,
+                "max_tokens": MAX_TOKENS,
+                "stop": STOP_SEQUENCES,
+            },
+            disk_path=RESPONSE_CACHE_DISK_PATH,
+            embed=embed,
+            similarity=RESPONSE_CACHE_SIMILARITY,
+            ignore_case=RESPONSE_CACHE_IGNORE_CASE
+        )
+
+    def _embed(self, text: str) -> List[float]:
+        with self._embed_lock:
+            return self.embedder.embed(text, normalize=True)
+
+    def _cached(self, prompt: str) -> Tuple[Optional[str], Optional[str]]:
+        """(cached answer or None, first-turn question) for a prompt."""
+        if self.response_cache is None:
+            return None, None
+        question = first_turn_question(prompt)
+        return self.response_cache.get(prompt, question), question
+
+    def _remember(self, request: GenerationRequest, prompt: str, text: str,
+                  question: Optional[str]) -> None:
+        if self.response_cache is not None and text.strip() and \
+                request.finish_reason in CACHEABLE_FINISH_REASONS:
+            self.response_cache.put(prompt, text, question)
+
+    @staticmethod
+    def _record(request: GenerationRequest) -> None:
+        """Record a finished generation's token counts and stage timings."""
+        metrics.GENERATIONS.inc(finish_reason=request.finish_reason or "cancelled")
+        if request.started_at is None:
+            return  # Never left the queue
+        metrics.PROMPT_TOKENS.observe(request.n_prompt_tokens)
+        if request.n_drafted:
+            metrics.DRAFTED_TOKENS.inc(request.n_drafted)
+            metrics.ACCEPTED_DRAFT_TOKENS.inc(request.n_draft_accepted)
+            metrics.DRAFT_ACCEPTANCE.observe(request.n_draft_accepted / request.n_drafted)
+        metrics.QUEUE_WAIT_SECONDS.observe(request.started_at - request.submitted_at)
+        if request.first_token_at is None:
+            return
+        metrics.PREFILL_SECONDS.observe(request.first_token_at - request.started_at)
+        decode_time = (request.finished_at or 0) - request.first_token_at
+        if request.n_generated > 1 and decode_time > 0:
+            metrics.DECODE_TOKENS_PER_SECOND.observe((request.n_generated - 1) / decode_time)
+
+    def _replay(self, text: str) -> Iterator[str]:
+        """Stream a cached answer back at RESPONSE_REPLAY_DELAY per chunk."""
+        for i, chunk in enumerate(replay_chunks(text)):
+            if i and RESPONSE_REPLAY_DELAY > 0:
+                time.sleep(RESPONSE_REPLAY_DELAY)
+            yield chunk
+
+    async def _replay_async(self, text: str) -> AsyncIterator[str]:
+        for i, chunk in enumerate(replay_chunks(text)):
+            if i and RESPONSE_REPLAY_DELAY > 0:
+                await asyncio.sleep(RESPONSE_REPLAY_DELAY)
+            yield chunk
+
+    def _stream_and_cache(self, request: GenerationRequest, prompt: str,
+                          question: Optional[str], use_cache: bool = True) -> Iterator[str]:
+        chunks = request.stream()
+        parts: List[str] = []
+        try:
+            for chunk in chunks:
+                parts.append(chunk)
+                yield chunk
+        finally:
+            chunks.close()
+            self._record(request)
+        if use_cache:
+            self._remember(request, prompt, "".join(parts), question)
+
+    async def _astream_and_cache(self, request: GenerationRequest, prompt: str,
+                                 question: Optional[str]) -> AsyncIterator[str]:
+        chunks = request.astream()
+        parts: List[str] = []
+        try:
+            async for chunk in chunks:
+                parts.append(chunk)
+                yield chunk
+        finally:
+            await chunks.aclose()
+            self._record(request)
+        await asyncio.to_thread(self._remember, request, prompt, "".join(parts), question)
+
+    def generate(self, prompt: str, stream: bool = False,
+                 conversation_id: Optional[str] = None,
+                 use_cache: bool = True) -> str | Iterator[str]:
+        """See LLMHandler.generate."""
         if self.model is None:
             raise RuntimeError("Model not loaded")
-        
+
         try:
-            response = self.model(
+            cached, question = self._cached(prompt) if use_cache else (None, None)
+            if cached is not None:
+                return self._replay(cached) if stream else cached.strip()
+
+            request = self.scheduler.submit(
                 prompt,
                 max_tokens=MAX_TOKENS,
                 temperature=TEMPERATURE,
-                stop=["User:", "System:"],
-                stream=stream,
-                echo=False
+                stop=STOP_SEQUENCES,
+                cache_key=conversation_id
             )
-            
+
             if stream:
-                return self._stream_response(response)
+                return self._stream_and_cache(request, prompt, question, use_cache)
             else:
-                return response["choices"][0]["text"].strip()
-        
+                try:
+                    text = request.result()
+                finally:
+                    self._record(request)
+                if use_cache:
+                    self._remember(request, prompt, text, question)
+                return text.strip()
+
         except Exception as e:
             print(f"Generation error: {e}")
             raise
-    
-    def _stream_response(self, response_iterator) -> Iterator[str]:
-        """Process streaming response from the model."""
-        for chunk in response_iterator:
-            text = chunk["choices"][0]["text"]
-            if text:
-                yield text
-    
-    def is_loaded(self) -> bool:
-        """Check if the model is loaded."""
-        return self.model is not None
+
+    async def stream_async(self, prompt: str,
+                           conversation_id: Optional[str] = None) -> AsyncIterator[str]:
+        """See LLMHandler.stream_async."""
+        if self.model is None:
+            raise RuntimeError("Model not loaded")
+
+        # A disk lookup, and with RESPONSE_CACHE_SEMANTIC an embedding pass
+        cached, question = await asyncio.to_thread(self._cached, prompt)
+        if cached is not None:
+            return self._replay_async(cached)
+
+        request = self.scheduler.submit(
+            prompt,
+            max_tokens=MAX_TOKENS,
+            temperature=TEMPERATURE,
+            stop=STOP_SEQUENCES,
+            cache_key=conversation_id
+        )
+        return self._astream_and_cache(request, prompt, question)
+
+    def count_tokens(self, text: str) -> int:
+        """Number of tokens `text` takes up inside a prompt."""
+        if self.model is None:
+            raise RuntimeError("Model not loaded")
+        return len(self.model.tokenize(text.encode("utf-8"), add_bos=False, special=True))
+
+    def summarize(self, summary: str, transcript: str) -> str:
+        """Fold a transcript into an existing (possibly empty) summary."""
+        if self.model is None:
+            raise RuntimeError("Model not loaded")
+        prompt = SUMMARY_INSTRUCTIONS
+        if summary:
+            prompt += f"Summary so far: {summary}\n\n"
+        prompt += f"{transcript}Summary:"
+        request = self.scheduler.submit(
+            prompt,
+            max_tokens=CONTEXT_SUMMARY_TOKENS,
+            temperature=0.2,
+            stop=STOP_SEQUENCES
+        )
+        try:
+            return request.result().strip()
+        finally:
+            self._record(request)
+
+    def forget(self, conversation_id: str) -> None:
+        """Release cached KV state for a conversation."""
+        if self.scheduler is not None:
+            self.scheduler.forget(conversation_id)
+
+    def stats(self) -> Dict:
+        """Scheduler queue and throughput metrics."""
+        if self.scheduler is None:
+            return {}
+        stats = self.scheduler.stats()
+        if self.response_cache is not None:
+            stats["response_cache"] = self.response_cache.stats()
+        return stats
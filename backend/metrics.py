@@ -0,0 +1,241 @@
+"""
+Counters, gauges and histograms rendered in the Prometheus text format.
+
+A deliberately small subset of prometheus_client: metrics live in this
+process only (worker processes report their timings back to the server,
+which records them), and render() produces what GET /metrics returns.
+"""
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+TOKEN_BUCKETS = (16, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192)
+RATE_BUCKETS = (1, 2, 5, 10, 15, 20, 30, 50, 75, 100, 200, 500)
+RATIO_BUCKETS = (0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0)
+
+_registry: List["_Metric"] = []
+_registry_lock = threading.Lock()
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str],
+                   extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+               for _, v in pairs)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help_text: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        with _registry_lock:
+            _registry.append(self)
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        if set(labels) != set(self.labels):
+            raise ValueError(f"{self.name} takes labels {self.labels}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def _samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        return "\n".join(lines + self._samples())
+
+
+class Counter(_Metric):
+    """A value that only goes up."""
+
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str, labels: Sequence[str] = ()):
+        super().__init__(name, help_text, labels)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            values = sorted(self._values.items())
+        return [f"{self.name}{_format_labels(self.labels, key)} {_format_value(value)}"
+                for key, value in values]
+
+
+class Gauge(_Metric):
+    """A current value, either set directly or read from a function at scrape time."""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, help_text: str):
+        super().__init__(name, help_text)
+        self._value = 0.0
+        self._function: Optional[Callable[[], float]] = None
+
+    def set(self, value: float) -> None:
+        with self._lock:
+            self._value = value
+
+    def set_function(self, function: Callable[[], float]) -> None:
+        with self._lock:
+            self._function = function
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            function, value = self._function, self._value
+        if function is not None:
+            try:
+                value = function()
+            except Exception as e:
+                print(f"Error reading metric {self.name}: {e}")
+                return []
+        return [f"{self.name} {_format_value(value)}"]
+
+
+class Histogram(_Metric):
+    """Observations counted into cumulative buckets, plus their sum and count."""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labels: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(sorted(buckets))
+        # Per label set: ([count per bucket, then +Inf], sum)
+        self._values: Dict[Tuple[str, ...], Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._values.setdefault(
+                key, ([0] * (len(self.buckets) + 1), [0.0])
+            )
+            counts[index] += 1
+            total[0] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the duration of a block; also usable as a decorator."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            values = sorted((key, (list(counts), total[0]))
+                            for key, (counts, total) in self._values.items())
+        lines = []
+        for key, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = _format_labels(self.labels, key, ("le", _format_value(float(bound))))
+                lines.append(f"{self.name}_bucket{le} {cumulative}")
+            labels = _format_labels(self.labels, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+def render() -> str:
+    """All registered metrics in the Prometheus text exposition format."""
+    with _registry_lock:
+        metrics = list(_registry)
+    return "\n".join(metric.render() for metric in metrics) + "\n"
+
+
+# ---------------------------------------------------------------------- #
+# Metrics recorded by the server
+# ---------------------------------------------------------------------- #
+
+REQUEST_SECONDS = Histogram(
+    "chat_request_duration_seconds", "Time to answer /chat or /stream, end to end.",
+    labels=("route",)
+)
+REQUEST_ERRORS = Counter(
+    "chat_request_errors_total", "Failed /chat and /stream requests.",
+    labels=("route", "status")
+)
+TIME_TO_FIRST_TOKEN = Histogram(
+    "chat_time_to_first_token_seconds",
+    "Time from receiving a /stream request to sending its first token."
+)
+SSE_WRITE_SECONDS = Histogram(
+    "chat_sse_write_seconds", "Time to hand one server-sent event to the client."
+)
+PROMPT_BUILD_SECONDS = Histogram(
+    "chat_prompt_build_seconds", "Time to load history and build a prompt."
+)
+DB_QUERY_SECONDS = Histogram(
+    "db_query_duration_seconds", "Database time per query or transaction.",
+    labels=("operation",)
+)
+DB_ERRORS = Counter(
+    "db_errors_total", "Failed database queries.", labels=("operation",)
+)
+PROMPT_TOKENS = Histogram(
+    "llm_prompt_tokens", "Prompt length of each generation, in tokens.",
+    buckets=TOKEN_BUCKETS
+)
+QUEUE_WAIT_SECONDS = Histogram(
+    "llm_queue_wait_seconds", "Time a generation waited for a decode slot."
+)
+PREFILL_SECONDS = Histogram(
+    "llm_prefill_seconds", "Time to evaluate a prompt, from admission to first token."
+)
+DECODE_TOKENS_PER_SECOND = Histogram(
+    "llm_decode_tokens_per_second", "Decode speed of each generation after its first token.",
+    buckets=RATE_BUCKETS
+)
+DRAFTED_TOKENS = Counter(
+    "llm_drafted_tokens_total", "Tokens guessed by prompt lookup and checked by the model."
+)
+ACCEPTED_DRAFT_TOKENS = Counter(
+    "llm_accepted_draft_tokens_total", "Guessed tokens the model agreed with."
+)
+DRAFT_ACCEPTANCE = Histogram(
+    "llm_draft_acceptance_ratio", "Share of guessed tokens accepted, per generation that drafted.",
+    buckets=RATIO_BUCKETS
+)
+GENERATIONS = Counter(
+    "llm_generations_total", "Finished generations by outcome.", labels=("finish_reason",)
+)
+MODEL_READY = Gauge(
+    "llm_model_ready", "1 once the model is loaded and serving, else 0."
+)
+GENERATIONS_IN_FLIGHT = Gauge(
+    "llm_generations_in_flight", "Generations currently holding a decode slot."
+)
+QUEUE_DEPTH = Gauge(
+    "llm_queue_depth", "Generations waiting for a decode slot."
+)
+PENDING_WRITES = Gauge(
+    "db_pending_writes", "Conversation turns queued for writing to the database."
+)
@@ -0,0 +1,21 @@
+"""
+Create or upgrade the database schema.
+
+Run once per deploy, before starting (or restarting) the servers, so they
+never run DDL themselves:
+
+    python migrate.py
+"""
+import sys
+
+from database import DatabaseManager
+
+if __name__ == '__main__':
+    db = DatabaseManager()
+    if not db.migrate():
+        sys.exit(1)
+    missing = db.missing_columns()
+    if missing:
+        print(f"✗ Schema still missing: {', '.join(missing)}")
+        sys.exit(1)
+    print("✓ Database schema is up to date")
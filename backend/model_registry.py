@@ -0,0 +1,415 @@
+"""
+Named models served side by side from one process.
+
+The models come from MODELS_CONFIG, a JSON object mapping each name to its
+file name in MODELS_DIR, download URL and optional SHA-256:
+
+    {
+      "fast": {"file": "llama-3.2-1b-instruct-q4_k_m.gguf", "url": "https://..."},
+      "smart": {"file": "qwen2.5-3b-instruct-q4_k_m.gguf", "url": "https://...",
+                "sha256": "..."}
+    }
+
+Without that file the registry holds a single model, "default", built from
+MODEL_NAME/MODEL_URL/MODEL_SHA256. A model is loaded in the background the
+first time it is asked for; while it loads, requests for it get
+ModelNotReadyError. Resident models are kept under MODEL_MEMORY_MB by
+unloading the least recently used idle ones, except the default model,
+which stays loaded. Replacing a model's file (swap) loads the new engine
+next to the old one and switches over atomically: generations already
+running finish on the old engine, which is closed once they have.
+"""
+import json
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+
+from config import (
+    MODELS_CONFIG, MODELS_DIR, MODEL_NAME, MODEL_URL, MODEL_SHA256,
+    DEFAULT_MODEL, MODEL_MEMORY_MB, MODEL_EVICT_WAIT, MODEL_SWAP_URLS
+)
+
+MB = 1024 * 1024
+
+
+class ModelNotReadyError(RuntimeError):
+    """Raised when a request names a model that is still loading, or failed to."""
+
+
+class UnknownModelError(ValueError):
+    """Raised when a request names a model the registry doesn't have."""
+
+
+class ModelSpec:
+    """Where a model's weights live and where to download them from."""
+
+    def __init__(self, name: str, path: Path, url: Optional[str] = None,
+                 sha256: Optional[str] = None):
+        self.name = name
+        self.path = Path(path)
+        self.url = url
+        self.sha256 = sha256 or None
+
+    @classmethod
+    def from_dict(cls, name: str, data: Dict) -> "ModelSpec":
+        if not isinstance(data, dict) or not data.get("file"):
+            raise ValueError(f"Model '{name}' needs a file")
+        file = data["file"]
+        separators = {"/", "\\", os.sep, os.altsep} - {None}
+        if (not isinstance(file, str) or file in (".", "..") or Path(file).is_absolute()
+                or any(sep in file for sep in separators) or ".." in file):
+            raise ValueError(f"Model '{name}': file must be a plain file name in {MODELS_DIR}")
+        spec = cls(name, MODELS_DIR / file, data.get("url"), data.get("sha256"))
+        spec.check_path()
+        return spec
+
+    def check_path(self) -> None:
+        """
+        Raises:
+            ValueError: If the weights file resolves to somewhere outside MODELS_DIR
+        """
+        models_dir = MODELS_DIR.resolve()
+        path = self.path.resolve()
+        if path == models_dir or not path.is_relative_to(models_dir):
+            raise ValueError(f"Model '{self.name}': {self.path} is outside {MODELS_DIR}")
+
+    def to_dict(self) -> Dict:
+        return {"file": self.path.name, "url": self.url, "sha256": self.sha256}
+
+
+def load_model_specs() -> Tuple[Dict[str, ModelSpec], str]:
+    """(models by name, name of the default model) from MODELS_CONFIG."""
+    if not MODELS_CONFIG.is_file():
+        spec = ModelSpec("default", MODELS_DIR / MODEL_NAME, MODEL_URL, MODEL_SHA256)
+        return {"default": spec}, "default"
+    data = json.loads(MODELS_CONFIG.read_text())
+    if not isinstance(data, dict) or not data:
+        raise ValueError(f"{MODELS_CONFIG} must map model names to {{\"file\", \"url\"}}")
+    specs = {name: ModelSpec.from_dict(name, entry) for name, entry in data.items()}
+    default = DEFAULT_MODEL or next(iter(specs))
+    if default not in specs:
+        raise ValueError(f"DEFAULT_MODEL '{default}' is not in {MODELS_CONFIG}")
+    return specs, default
+
+
+class _Entry:
+    """A registered model: its spec, resident engine and loading state."""
+
+    def __init__(self, spec: ModelSpec):
+        self.spec = spec
+        self.engine = None
+        self.state = "unloaded"  # unloaded, downloading, loading, ready or failed
+        self.progress = 0.0
+        self.error: Optional[str] = None
+        self.loading = False
+        self.last_used = 0.0
+
+
+class ModelRegistry:
+    """
+    Loads, tracks and unloads the engines that serve each named model.
+
+    `create_engine(spec)` builds an engine with:
+        prepare(report): make the weights available locally and set
+            `engine.memory`, its expected resident size in bytes;
+            report(state, progress) tracks downloads
+        load(): load the weights; generation may start once it returns
+        close(): free everything; called once nothing is using the engine
+
+    Callers hold an engine between acquire() and release(); only engines
+    nobody holds are unloaded.
+    """
+
+    def __init__(self, specs: Dict[str, ModelSpec], default: str,
+                 create_engine: Callable[[ModelSpec], object],
+                 memory_budget: int = MODEL_MEMORY_MB * MB,
+                 evict_wait: float = MODEL_EVICT_WAIT,
+                 swap_urls: List[str] = MODEL_SWAP_URLS):
+        self.default = default
+        self._create_engine = create_engine
+        self._budget = memory_budget
+        self._evict_wait = evict_wait
+        self._swap_urls = list(swap_urls)
+        self._entries = {name: _Entry(spec) for name, spec in specs.items()}
+        self._cond = threading.Condition()
+        self._used = 0  # Bytes of loaded, loading and retiring engines
+        self._in_flight: Dict[int, int] = {}  # id(engine) -> holders
+        self._retiring: List[object] = []  # Replaced or unloaded, still held
+
+    # ------------------------------------------------------------------ #
+    # Requests
+    # ------------------------------------------------------------------ #
+
+    def names(self) -> List[str]:
+        with self._cond:
+            return list(self._entries)
+
+    def acquire(self, name: Optional[str] = None):
+        """
+        The engine serving `name` (default: the default model), held until
+        release(). A model that isn't loaded starts loading in the background.
+
+        Raises:
+            UnknownModelError: If there is no such model
+            ModelNotReadyError: If the model isn't loaded yet
+        """
+        name = name or self.default
+        with self._cond:
+            entry = self._entry(name)
+            if entry.engine is None:
+                self._start_load(entry, entry.spec)
+                detail = f": {entry.error}" if entry.state == "failed" else ""
+                raise ModelNotReadyError(f"Model '{name}' is {entry.state}{detail}, please retry shortly")
+            entry.last_used = time.monotonic()
+            engine = entry.engine
+            self._in_flight[id(engine)] = self._in_flight.get(id(engine), 0) + 1
+            return engine
+
+    def release(self, engine) -> None:
+        """Give back an engine from acquire()."""
+        with self._cond:
+            held = self._in_flight.get(id(engine), 0) - 1
+            if held > 0:
+                self._in_flight[id(engine)] = held
+                return
+            self._in_flight.pop(id(engine), None)
+            retired = engine in self._retiring
+            if retired:
+                self._retiring.remove(engine)
+                self._used -= engine.memory
+            self._cond.notify_all()
+        if retired:
+            self._close(engine)
+
+    def resident(self, name: Optional[str] = None):
+        """The loaded engine for `name`, or None, without holding it."""
+        with self._cond:
+            return self._entry(name or self.default).engine
+
+    def engines(self) -> Dict[str, object]:
+        """Loaded engines by model name."""
+        with self._cond:
+            return {name: e.engine for name, e in self._entries.items() if e.engine is not None}
+
+    # ------------------------------------------------------------------ #
+    # Loading and swapping
+    # ------------------------------------------------------------------ #
+
+    def load(self, name: Optional[str] = None, wait: bool = False) -> None:
+        """
+        Start loading `name` if it isn't loaded or loading already.
+
+        Args:
+            wait: Block until it is ready, raising the error if it fails
+        """
+        name = name or self.default
+        with self._cond:
+            entry = self._entry(name)
+            if entry.engine is None:
+                self._start_load(entry, entry.spec)
+            if not wait:
+                return
+            self._cond.wait_for(lambda: not entry.loading)
+            if entry.engine is None:
+                raise RuntimeError(f"Model '{name}' failed to load: {entry.error}")
+
+    def swap(self, spec: ModelSpec) -> None:
+        """
+        Serve `spec.name` from new weights, registering it if it's new.
+
+        The new engine loads in the background while the current one keeps
+        serving; new requests move over once it's ready.
+
+        Raises:
+            ValueError: If `spec.url` is neither a configured model's URL nor
+                under one of the MODEL_SWAP_URLS prefixes
+        """
+        with self._cond:
+            if spec.url and not self._allowed_url(spec.url):
+                raise ValueError(f"Downloads from {spec.url} are not allowed; "
+                                 f"add its prefix to MODEL_SWAP_URLS")
+            entry = self._entries.get(spec.name)
+            if entry is None:
+                entry = self._entries[spec.name] = _Entry(spec)
+            if entry.loading:
+                raise ModelNotReadyError(f"Model '{spec.name}' is already loading, retry once it's ready")
+            self._start_load(entry, spec)
+
+    def status(self, name: Optional[str] = None) -> Dict:
+        """Loading state of one model: state, progress and error."""
+        with self._cond:
+            entry = self._entry(name or self.default)
+            return {"state": entry.state, "progress": round(entry.progress, 3), "error": entry.error}
+
+    def list(self) -> List[Dict]:
+        """Every registered model with its state and estimated memory."""
+        with self._cond:
+            return [
+                {
+                    "name": name,
+                    "default": name == self.default,
+                    **entry.spec.to_dict(),
+                    "state": entry.state,
+                    "progress": round(entry.progress, 3),
+                    "error": entry.error,
+                    "memory_mb": round(entry.engine.memory / MB) if entry.engine else None,
+                    "in_flight": self._in_flight.get(id(entry.engine), 0) if entry.engine else 0,
+                }
+                for name, entry in self._entries.items()
+            ]
+
+    def memory(self) -> Dict:
+        """Estimated bytes in use against the budget (0 = unlimited)."""
+        with self._cond:
+            return {"used_mb": round(self._used / MB), "budget_mb": round(self._budget / MB)}
+
+    def close(self) -> None:
+        """Unload every model."""
+        with self._cond:
+            engines = [e.engine for e in self._entries.values() if e.engine is not None]
+            engines += self._retiring
+            for entry in self._entries.values():
+                entry.engine = None
+                entry.state = "unloaded"
+            self._retiring = []
+            self._used = 0
+        for engine in engines:
+            self._close(engine)
+
+    # ------------------------------------------------------------------ #
+    # Internals
+    # ------------------------------------------------------------------ #
+
+    def _entry(self, name: str) -> _Entry:
+        """The entry for `name` (caller holds the lock)."""
+        entry = self._entries.get(name)
+        if entry is None:
+            raise UnknownModelError(f"Unknown model '{name}'")
+        return entry
+
+    def _allowed_url(self, url: str) -> bool:
+        """Whether a swap may download from `url` (caller holds the lock)."""
+        if any(entry.spec.url == url for entry in self._entries.values()):
+            return True
+        return any(url.startswith(prefix) for prefix in self._swap_urls)
+
+    def _start_load(self, entry: _Entry, spec: ModelSpec) -> None:
+        """Load `spec` for `entry` on a background thread (caller holds the lock)."""
+        if entry.loading:
+            return
+        entry.loading = True
+        entry.state = "loading" if entry.engine is None else entry.state
+        entry.error = None
+        threading.Thread(
+            target=self._load, args=(entry, spec), name=f"model-loader-{spec.name}", daemon=True
+        ).start()
+
+    def _load(self, entry: _Entry, spec: ModelSpec) -> None:
+        with self._cond:
+            swapping = entry.engine is not None
+        engine, reserved = None, 0
+
+        def report(state: str, progress: float) -> None:
+            with self._cond:
+                if not swapping:
+                    entry.state = state
+                entry.progress = progress
+
+        try:
+            spec.check_path()  # Also covers a symlink swapped in after registration
+            engine = self._create_engine(spec)
+            engine.prepare(report)
+            report("loading", 0.0)
+            self._reserve(engine.memory, keep=entry)
+            reserved = engine.memory  # Only now counted in self._used
+            print(f"Loading model '{spec.name}' ({spec.path.name}, ~{reserved // MB} MB)...")
+            engine.load()
+        except Exception as e:
+            print(f"✗ Failed to load model '{spec.name}': {e}")
+            if engine is not None:
+                self._close(engine)  # Frees whatever load() got as far as creating
+            with self._cond:
+                self._used -= reserved
+                entry.loading = False
+                entry.error = str(e)
+                if entry.engine is None:
+                    entry.state = "failed"
+                self._cond.notify_all()
+            return
+
+        with self._cond:
+            old = entry.engine
+            entry.engine = engine
+            entry.spec = spec
+            entry.state = "ready"
+            entry.progress = 1.0
+            entry.loading = False
+            entry.last_used = time.monotonic()
+            close_old = old is not None and not self._in_flight.get(id(old))
+            if close_old:
+                self._used -= old.memory
+            elif old is not None:
+                self._retiring.append(old)  # Closed by the last release()
+            self._cond.notify_all()
+        print(f"✓ Model '{spec.name}' {'swapped in' if swapping else 'loaded'}")
+        if close_old:
+            self._close(old)
+
+    def _reserve(self, needed: int, keep: _Entry) -> None:
+        """
+        Count `needed` bytes against the budget, unloading least recently
+        used idle models to make room. Waits up to evict_wait for busy ones.
+        """
+        if self._budget <= 0:
+            with self._cond:
+                self._used += needed
+            return
+        if needed > self._budget:
+            raise MemoryError(
+                f"Model needs ~{needed // MB} MB, more than MODEL_MEMORY_MB={self._budget // MB}"
+            )
+        deadline = time.monotonic() + self._evict_wait
+        evicted = []
+        try:
+            with self._cond:
+                while self._used + needed > self._budget:
+                    victim = self._least_recently_used(keep)
+                    if victim is not None:
+                        evicted.append(victim.engine)
+                        self._used -= victim.engine.memory
+                        print(f"Unloading model '{victim.spec.name}' to make room")
+                        victim.engine = None
+                        victim.state = "unloaded"
+                        victim.progress = 0.0
+                        continue
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise MemoryError(
+                            f"Not enough of MODEL_MEMORY_MB={self._budget // MB} free for "
+                            f"~{needed // MB} MB; the other models are busy"
+                        )
+                    self._cond.wait(remaining)
+                self._used += needed
+        finally:
+            # Models unloaded before a MemoryError are gone either way
+            for engine in evicted:
+                self._close(engine)
+
+    def _least_recently_used(self, keep: _Entry) -> Optional[_Entry]:
+        """The idle, unpinned entry used longest ago (caller holds the lock)."""
+        idle = [
+            entry for name, entry in self._entries.items()
+            if entry.engine is not None and entry is not keep and name != self.default
+            and not self._in_flight.get(id(entry.engine))
+        ]
+        return min(idle, key=lambda entry: entry.last_used, default=None)
+
+    @staticmethod
+    def _close(engine) -> None:
+        """Close an engine whose memory the caller has already uncounted."""
+        try:
+            engine.close()
+        except Exception as e:
+            print(f"Error closing model: {e}")
@@ -0,0 +1,327 @@
+import atexit
+import json
+import os
+import queue
+import threading
+import time
+from pathlib import Path
+from typing import Callable, Dict, List
+
+
+class WriteBehindQueue:
+    """
+    Persists conversation turns in the background so requests never wait on MySQL.
+
+    Turns are queued in memory and written in batches by a worker thread.
+    A failed batch is retried with exponential backoff; if the database
+    stays unavailable, turns are appended to a local JSONL spool file and
+    replayed, in order, once it recovers. Until a turn is written it is
+    visible through `pending()` so reads still see it.
+
+    Only errors `is_transient` accepts (lost connections and the like) are
+    retried. A turn the database rejects outright is moved to a dead-letter
+    file next to the spool, so one bad turn can't hold up the ones behind it.
+    """
+
+    def __init__(self, write_turns: Callable[[List[Dict]], None], spool_path: Path,
+                 max_queue: int = 1000, batch_size: int = 50,
+                 retries: int = 3, max_backoff: float = 30.0,
+                 is_transient: Callable[[Exception], bool] = lambda e: True):
+        self._write_turns = write_turns
+        self._is_transient = is_transient
+        self.spool_path = spool_path
+        self.dead_letter_path = spool_path.with_name(spool_path.stem + ".dead.jsonl")
+        self.batch_size = batch_size
+        self.retries = retries
+        self.max_backoff = max_backoff
+        self._queue: "queue.Queue" = queue.Queue(maxsize=max_queue)
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()  # Held while a batch is being written
+        self._order = 0  # Submission order, kept with each turn so the spool replays in order
+        self._failing = False  # The last write attempt couldn't reach the database
+        self._pending: Dict[str, List[Dict]] = {}
+        self._epochs: Dict[str, int] = {}
+        self._spooled = 0
+        self._retry_at = 0.0
+        self._backoff = 1.0
+        self.stats = {"written": 0, "batches": 0, "failures": 0, "spooled": 0, "dead_lettered": 0}
+
+        self.spool_path.parent.mkdir(parents=True, exist_ok=True)
+        self._load_spool()
+
+        self._stop = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name="write-behind", daemon=True
+        )
+        self._thread.start()
+        atexit.register(self.close)
+
+    def submit(self, conversation_id: str, messages: List[Dict]) -> None:
+        """Queue messages for a conversation; returns immediately."""
+        with self._lock:
+            turn = {
+                "conversation_id": conversation_id,
+                "messages": messages,
+                "epoch": self._epochs.get(conversation_id, 0),
+                "order": self._order,
+            }
+            self._order += 1
+            self._pending.setdefault(conversation_id, []).extend(messages)
+        try:
+            self._queue.put_nowait(turn)
+        except queue.Full:
+            # Spooled ahead of older turns still queued; replay sorts by "order"
+            with self._lock:
+                self._append_spool([turn])
+
+    def pending(self, conversation_id: str) -> List[Dict]:
+        """Messages accepted for a conversation but not yet written."""
+        with self._lock:
+            return list(self._pending.get(conversation_id, ()))
+
+    def discard(self, conversation_id: str) -> None:
+        """Drop unwritten messages for a cleared or deleted conversation."""
+        with self._lock:
+            self._epochs[conversation_id] = self._epochs.get(conversation_id, 0) + 1
+            self._pending.pop(conversation_id, None)
+            if self._spooled:
+                turns = [t for t in self._read_spool()
+                         if t["conversation_id"] != conversation_id]
+                self._rewrite_spool(turns)
+        # A batch already being written may still hold its turns; let it
+        # finish so the caller's delete can't be followed by that write
+        with self._write_lock:
+            pass
+
+    def backlog(self) -> int:
+        """Turns waiting in memory or in the spool file."""
+        return self._queue.qsize() + self._spooled
+
+    def flush(self, timeout: float = 10.0) -> bool:
+        """Wait until everything queued so far has been written."""
+        return self._wait_written(timeout, give_up_when_failing=False)
+
+    def close(self, timeout: float = 10.0) -> None:
+        """Flush what can be written and spool the rest."""
+        if self._stop.is_set():
+            return
+        # While the database is unreachable waiting gets nothing written; spool now
+        self._wait_written(timeout, give_up_when_failing=True)
+        self._stop.set()
+        self._thread.join(timeout)
+
+    def _wait_written(self, timeout: float, give_up_when_failing: bool) -> bool:
+        deadline = time.monotonic() + timeout
+        while self._queue.unfinished_tasks or self._spooled:
+            if (give_up_when_failing and self._failing) or time.monotonic() >= deadline:
+                return False
+            time.sleep(0.05)
+        return True
+
+    # ------------------------------------------------------------------ #
+    # Worker thread
+    # ------------------------------------------------------------------ #
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            received = self._next_batch(timeout=0.5)
+            with self._lock:
+                batch = [turn for turn in received if self._is_live(turn)]
+                if self._spooled and batch:
+                    # Keep per-conversation order behind turns already spooled
+                    self._append_spool(batch)
+                    batch = []
+
+            if self._spooled:
+                if time.monotonic() >= self._retry_at:
+                    self._replay_spool()
+            elif batch:
+                self._write_with_retry(batch)
+            self._mark_done(received)
+
+        # Shutting down: whatever is left goes to the spool for next start
+        leftover = self._next_batch(timeout=0)
+        while leftover:
+            with self._lock:
+                self._append_spool([t for t in leftover if self._is_live(t)])
+            self._mark_done(leftover)
+            leftover = self._next_batch(timeout=0)
+
+    def _next_batch(self, timeout: float) -> List[Dict]:
+        try:
+            batch = [self._queue.get(timeout=timeout) if timeout else self._queue.get_nowait()]
+        except queue.Empty:
+            return []
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _mark_done(self, batch: List[Dict]) -> None:
+        for _ in batch:
+            self._queue.task_done()
+
+    def _is_live(self, turn: Dict) -> bool:
+        return turn["epoch"] == self._epochs.get(turn["conversation_id"], 0)
+
+    def _write(self, turns: List[Dict]) -> List[Dict]:
+        """
+        Write turns, dead-lettering any the database rejects for good.
+
+        Returns the turns left unwritten because the database couldn't be
+        reached (empty once everything is written); the caller keeps those
+        for another try.
+        """
+        with self._write_lock:
+            with self._lock:
+                # Drop turns discarded since they were queued or spooled
+                live = [turn for turn in turns if self._is_live(turn)]
+            if not live:
+                return []
+            try:
+                self._write_turns(live)
+            except Exception as e:
+                if self._is_transient(e):
+                    self.stats["failures"] += 1
+                    self._failing = True
+                    print(f"Background write failed: {e}")
+                    return live
+                if len(live) == 1:
+                    self._dead_letter(live[0], e)
+                    self._forget(live)
+                    return []
+                rejected = e
+            else:
+                self._failing = False
+                self.stats["batches"] += 1
+                self.stats["written"] += len(live)
+                self._forget(live)
+                return []
+        # Write one at a time to find the turns the database won't take
+        print(f"Background write rejected ({rejected}); retrying turns one by one")
+        for i, turn in enumerate(live):
+            if self._write([turn]):
+                return live[i:]
+        return []
+
+    def _forget(self, turns: List[Dict]) -> None:
+        """Stop reporting written (or dead-lettered) turns as pending."""
+        with self._lock:
+            for turn in turns:
+                written = {m["id"] for m in turn["messages"]}
+                remaining = [m for m in self._pending.get(turn["conversation_id"], ())
+                             if m["id"] not in written]
+                if remaining:
+                    self._pending[turn["conversation_id"]] = remaining
+                else:
+                    self._pending.pop(turn["conversation_id"], None)
+
+    def _dead_letter(self, turn: Dict, error: Exception) -> None:
+        print(f"✗ Turn for conversation {turn['conversation_id']} rejected by the database "
+              f"({error}); moved to {self.dead_letter_path}")
+        with self._lock, open(self.dead_letter_path, "a", encoding="utf-8") as f:
+            f.write(json.dumps({**turn, "error": str(error)}) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self.stats["dead_lettered"] += 1
+
+    def _write_with_retry(self, batch: List[Dict]) -> None:
+        delay = 0.5
+        for attempt in range(self.retries):
+            batch = self._write(batch)
+            if not batch:
+                return
+            # Stop retrying when shutting down; the spool keeps the batch
+            if attempt + 1 < self.retries and not self._stop.wait(delay):
+                delay = min(delay * 2, self.max_backoff)
+            else:
+                break
+        print(f"Database unavailable; spooling {len(batch)} turns to {self.spool_path}")
+        with self._lock:
+            self._append_spool(batch)
+        self._schedule_retry(failed=True)
+
+    def _replay_spool(self) -> None:
+        with self._lock:
+            turns = self._read_spool()
+        written = set()
+        for start in range(0, len(turns), self.batch_size):
+            chunk = turns[start:start + self.batch_size]
+            unwritten = {turn["messages"][0]["id"] for turn in self._write(chunk)}
+            written.update(turn["messages"][0]["id"] for turn in chunk
+                           if turn["messages"][0]["id"] not in unwritten)
+            if unwritten:
+                break
+        with self._lock:
+            # The file may have changed meanwhile (new turns, discards)
+            remaining = [t for t in self._read_spool()
+                         if t["messages"][0]["id"] not in written and self._is_live(t)]
+            self._rewrite_spool(remaining)
+        self._schedule_retry(failed=bool(self._spooled))
+        if written and not self._spooled:
+            print("✓ Spooled conversation turns written to the database")
+
+    def _schedule_retry(self, failed: bool) -> None:
+        if failed:
+            self._retry_at = time.monotonic() + self._backoff
+            self._backoff = min(self._backoff * 2, self.max_backoff)
+        else:
+            self._backoff = 1.0
+
+    # ------------------------------------------------------------------ #
+    # Spool file (caller holds the lock)
+    # ------------------------------------------------------------------ #
+
+    def _append_spool(self, turns: List[Dict]) -> None:
+        if not turns:
+            return
+        with open(self.spool_path, "a", encoding="utf-8") as f:
+            for turn in turns:
+                f.write(json.dumps(turn) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self._spooled += len(turns)
+        self.stats["spooled"] += len(turns)
+
+    def _read_spool(self) -> List[Dict]:
+        if not self.spool_path.exists():
+            return []
+        turns = []
+        with open(self.spool_path, encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    turns.append(json.loads(line))
+                except ValueError:
+                    # A line cut short by a crash mid-append
+                    print(f"Skipping unreadable spool entry in {self.spool_path}")
+        # Appends can land out of submission order (overflow, failed batches)
+        turns.sort(key=lambda turn: turn.get("order", 0))
+        return turns
+
+    def _rewrite_spool(self, turns: List[Dict]) -> None:
+        tmp_path = self.spool_path.with_suffix(".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for turn in turns:
+                f.write(json.dumps(turn) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        tmp_path.replace(self.spool_path)
+        self._spooled = len(turns)
+
+    def _load_spool(self) -> None:
+        """Pick up turns spooled by a previous run."""
+        turns = self._read_spool()
+        for order, turn in enumerate(turns):
+            turn["epoch"] = 0
+            turn["order"] = order
+            self._pending.setdefault(turn["conversation_id"], []).extend(turn["messages"])
+        self._order = len(turns)
+        if turns:
+            print(f"Found {len(turns)} spooled conversation turns; replaying in background")
+            self._rewrite_spool(turns)
+
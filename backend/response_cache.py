@@ -0,0 +1,244 @@
+import hashlib
+import json
+import queue
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+
+def normalize_prompt(text: str, ignore_case: bool = False) -> str:
+    """Whitespace-insensitive (and optionally case-insensitive) form of a prompt."""
+    text = re.sub(r"\s+", " ", text).strip()
+    return text.casefold() if ignore_case else text
+
+
+def replay_chunks(text: str) -> List[str]:
+    """Split a cached answer into word-sized pieces for streaming it back."""
+    return re.findall(r"\s*\S+|\s+$", text)
+
+
+class ResponseCache:
+    """
+    Cache of finished answers, keyed by normalized prompt and sampling settings.
+
+    Prompts that differ in case are different questions (code, names,
+    acronyms) unless `ignore_case` is set.
+
+    Entries live in an in-memory LRU bounded by count and age, optionally
+    backed by a larger SQLite file so they survive restarts. put() only
+    updates memory; the SQLite write (and the embedding, for semantic
+    lookup) happens on a background thread, off the request path. With an `embed`
+    function, first-turn questions are also matched by meaning: an answer
+    is reused when the question's embedding is close enough (cosine
+    similarity) to one already answered under the same settings.
+    """
+
+    def __init__(self, capacity: int, ttl_seconds: float, settings: Dict,
+                 disk_path: Optional[Path] = None, disk_capacity: int = 0,
+                 embed: Optional[Callable[[str], List[float]]] = None,
+                 similarity: float = 0.95, ignore_case: bool = False):
+        self.capacity = capacity
+        self.ttl_seconds = ttl_seconds
+        self.disk_capacity = disk_capacity or capacity * 10
+        self.similarity = similarity
+        self.ignore_case = ignore_case
+        self._embed = embed
+        # Model and sampling settings are part of every key, and so is the
+        # normalization, so switching it doesn't reuse answers keyed the other way
+        self._settings = json.dumps({**settings, "ignore_case": ignore_case}, sort_keys=True)
+        self._scope = hashlib.sha256(self._settings.encode("utf-8")).hexdigest()[:16]
+        self._puts = 0
+        self._entries: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+        # Embeddings of cached first-turn questions, for semantic lookup
+        self._vectors: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+
+        self._db = None
+        if disk_path is not None:
+            disk_path.parent.mkdir(parents=True, exist_ok=True)
+            self._db = sqlite3.connect(str(disk_path), check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, scope TEXT NOT NULL, response TEXT NOT NULL, "
+                "embedding BLOB, created_at REAL NOT NULL)"
+            )
+            self._prune()
+            self._load_vectors()
+
+        # Disk writes and embeddings of new answers, done by _write_behind()
+        self._pending: "queue.Queue" = queue.Queue()
+        if self._db is not None or self._embed is not None:
+            threading.Thread(
+                target=self._write_behind, name="response-cache-writer", daemon=True
+            ).start()
+
+    def get(self, prompt: str, question: Optional[str] = None) -> Optional[str]:
+        """
+        Return a cached answer for `prompt`, or None.
+
+        `question` is the user message of a first-turn prompt; only those
+        are matched semantically, since with history the same question can
+        need a different answer.
+        """
+        key = self._key(prompt)
+        response = self._lookup(key)
+        if response is None and question is not None and self._embed is not None:
+            response = self._lookup_similar(question)
+            if response is not None:
+                with self._lock:
+                    self.semantic_hits += 1
+        with self._lock:
+            if response is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return response
+
+    def put(self, prompt: str, response: str, question: Optional[str] = None) -> None:
+        """Cache an answer; `question` as for get()."""
+        key = self._key(prompt)
+        now = time.time()
+        with self._lock:
+            self._store(key, response, now)
+        if self._db is not None or (question is not None and self._embed is not None):
+            self._pending.put((key, response, question, now))
+
+    def _write_behind(self) -> None:
+        """Embed and persist answers queued by put(), committing once per burst."""
+        while True:
+            batch = [self._pending.get()]
+            while True:
+                try:
+                    batch.append(self._pending.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._persist(batch)
+            except Exception as e:
+                print(f"Error saving cached answers: {e}")
+
+    def _persist(self, batch: List[Tuple[str, str, Optional[str], float]]) -> None:
+        vectors = {}
+        if self._embed is not None:
+            vectors = {key: self._vector(question) for key, _, question, _ in batch
+                       if question is not None}
+        with self._lock:
+            for key, vector in vectors.items():
+                self._vectors[key] = vector
+                self._vectors.move_to_end(key)
+                while len(self._vectors) > self.disk_capacity:
+                    self._vectors.popitem(last=False)
+            if self._db is None:
+                return
+            self._db.executemany(
+                "INSERT OR REPLACE INTO responses "
+                "(key, scope, response, embedding, created_at) VALUES (?, ?, ?, ?, ?)",
+                [(key, self._scope, response,
+                  vectors[key].tobytes() if key in vectors else None, stored_at)
+                 for key, response, _, stored_at in batch]
+            )
+            self._db.commit()
+            before = self._puts
+            self._puts += len(batch)
+            if self._puts // 100 != before // 100:
+                self._prune()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "capacity": self.capacity,
+                "hits": self.hits,
+                "semantic_hits": self.semantic_hits,
+                "misses": self.misses,
+            }
+
+    def _key(self, prompt: str) -> str:
+        return hashlib.sha256(
+            f"{self._settings}\n{normalize_prompt(prompt, self.ignore_case)}".encode("utf-8")
+        ).hexdigest()
+
+    def _lookup(self, key: str) -> Optional[str]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if time.time() - entry[1] <= self.ttl_seconds:
+                    self._entries.move_to_end(key)
+                    return entry[0]
+                self._remove(key)
+            if self._db is None:
+                return None
+            row = self._db.execute(
+                "SELECT response, created_at FROM responses WHERE key = ? AND created_at >= ?",
+                (key, time.time() - self.ttl_seconds)
+            ).fetchone()
+            if row is None:
+                return None
+            self._store(key, row[0], row[1])
+            return row[0]
+
+    def _lookup_similar(self, question: str) -> Optional[str]:
+        vector = self._vector(question)
+        with self._lock:
+            if not self._vectors:
+                return None
+            keys = list(self._vectors)
+            scores = np.stack(list(self._vectors.values())) @ vector
+        for index in np.argsort(scores)[::-1]:
+            if scores[index] < self.similarity:
+                break
+            response = self._lookup(keys[index])
+            if response is not None:
+                return response
+        return None
+
+    def _vector(self, text: str) -> np.ndarray:
+        vector = np.asarray(self._embed(normalize_prompt(text, self.ignore_case)), dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def _store(self, key: str, response: str, stored_at: float) -> None:
+        # Caller holds the lock
+        self._entries[key] = (response, stored_at)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.capacity:
+            self._remove(next(iter(self._entries)))
+
+    def _remove(self, key: str) -> None:
+        self._entries.pop(key, None)
+        # Keep the vector while the disk tier still has the answer
+        if self._db is None:
+            self._vectors.pop(key, None)
+
+    def _prune(self) -> None:
+        """Drop expired rows and the oldest beyond disk_capacity."""
+        self._db.execute(
+            "DELETE FROM responses WHERE created_at < ?", (time.time() - self.ttl_seconds,)
+        )
+        self._db.execute(
+            "DELETE FROM responses WHERE key IN (SELECT key FROM responses "
+            "ORDER BY created_at DESC LIMIT -1 OFFSET ?)",
+            (self.disk_capacity,)
+        )
+        self._db.commit()
+
+    def _load_vectors(self) -> None:
+        """Rebuild the semantic index from the disk tier."""
+        if self._embed is None:
+            return
+        rows = self._db.execute(
+            "SELECT key, embedding FROM responses "
+            "WHERE scope = ? AND embedding IS NOT NULL ORDER BY created_at",
+            (self._scope,)
+        ).fetchall()
+        for key, blob in rows:
+            self._vectors[key] = np.frombuffer(blob, dtype=np.float32)
@@ -0,0 +1,389 @@
+"""
+Request handling shared by app.py (Flask) and asgi_app.py (Quart).
+
+Handlers validate a request, call the model, conversation store and job
+queue, and return a JSON body (optionally with a status and headers) or
+raise ApiError. They block, so the ASGI server runs them in a thread. The
+servers themselves only do transport: reading the request, streaming
+generations and sending files.
+"""
+import html
+import time
+from typing import Any, Dict, Mapping, Optional, Tuple
+
+import metrics
+from llm_handler import LLMHandler
+from model_registry import ModelNotReadyError, UnknownModelError
+from scheduler import SchedulerFullError
+from batch_jobs import BatchJobManager, JobStateError, parse_items
+from conversation import ConversationManager
+from search_index import SearchUnavailableError
+from static_assets import StaticAssets
+from config import CONVERSATION_PAGE_SIZE, CONVERSATION_PAGE_MAX, SEARCH_PAGE_SIZE
+
+# Longest message accepted by /chat and /stream, in characters
+MAX_MESSAGE_CHARS = 4000
+
+# JSON routes: (rule, methods, ChatAPI handler name)
+ROUTES = [
+    ('/health', ['GET'], 'health'),
+    ('/health/live', ['GET'], 'liveness'),
+    ('/health/ready', ['GET'], 'readiness'),
+    ('/models', ['GET'], 'list_models'),
+    ('/models/<name>/load', ['POST'], 'load_model'),
+    ('/models/<name>', ['PUT'], 'swap_model'),
+    ('/jobs', ['POST'], 'submit_job'),
+    ('/jobs', ['GET'], 'list_jobs'),
+    ('/jobs/<job_id>', ['GET'], 'get_job'),
+    ('/jobs/<job_id>/<action>', ['POST'], 'change_job'),
+    ('/jobs/<job_id>', ['DELETE'], 'delete_job'),
+    ('/conversations', ['GET'], 'list_conversations'),
+    ('/conversations', ['POST'], 'create_conversation'),
+    ('/search', ['GET'], 'search'),
+    ('/conversations/<cid>', ['GET'], 'get_conversation'),
+    ('/conversations/<cid>', ['DELETE'], 'delete_conversation'),
+    ('/clear', ['POST'], 'clear_history'),
+]
+
+# (body, status, headers), turned into a JSON response by the server
+Reply = Tuple[Dict[str, Any], int, Dict[str, str]]
+
+
+class ApiError(Exception):
+    """A request that is answered with {"error": message} and a non-2xx status."""
+
+    def __init__(self, status: int, message: str, headers: Optional[Dict[str, str]] = None,
+                 **extra):
+        super().__init__(message)
+        self.status = status
+        self.headers = headers or {}
+        self.body = {"error": message, **extra}
+
+    def reply(self) -> Reply:
+        return self.body, self.status, self.headers
+
+
+class ApiRequest:
+    """The parts of a request handlers read, whichever server received it."""
+
+    def __init__(self, json: Optional[Dict] = None, args: Optional[Mapping[str, str]] = None,
+                 text: str = "", is_json: bool = False):
+        self.json = json if isinstance(json, dict) else None
+        self.args = args or {}
+        self.text = text
+        self.is_json = is_json
+
+
+class Turn:
+    """A validated /chat or /stream message, with the prompt to answer it."""
+
+    def __init__(self, route: str, started: float, user_message: str, conversation_id: str,
+                 model: Optional[str], prompt: str, compact: bool):
+        self.route = route
+        self.started = started
+        self.user_message = user_message
+        self.conversation_id = conversation_id
+        self.model = model
+        self.prompt = prompt
+        self.compact = compact
+
+    def finished(self) -> None:
+        """Record the request's duration once the answer has been sent."""
+        metrics.REQUEST_SECONDS.observe(time.perf_counter() - self.started, route=self.route)
+
+
+class ChatAPI:
+    """The model, conversation store and job queue, and the handlers that use them."""
+
+    def __init__(self):
+        # The model loads in the background; /chat and /stream answer 503 until it is ready
+        self.llm = LLMHandler(background=True)
+        self.conversation = ConversationManager(
+            count_tokens=self.llm.count_tokens, summarize=self.llm.summarize
+        )
+        metrics.GENERATIONS_IN_FLIGHT.set_function(
+            lambda: self.llm.stats().get("active_slots", 0)
+        )
+        metrics.QUEUE_DEPTH.set_function(lambda: self.llm.stats().get("queue_depth", 0))
+        metrics.MODEL_READY.set_function(lambda: 1 if self.llm.is_loaded() else 0)
+        metrics.PENDING_WRITES.set_function(self._pending_writes)
+        self.jobs = BatchJobManager(self.llm, self.conversation)
+        self.assets = StaticAssets()
+
+    def _pending_writes(self) -> int:
+        writer = self.conversation.writer
+        return writer.backlog() if writer else 0
+
+    @staticmethod
+    def call(handler, request: ApiRequest, **params) -> Reply:
+        """Run a handler, normalising its result (or ApiError) to (body, status, headers)."""
+        try:
+            result = handler(request, **params)
+        except ApiError as e:
+            return e.reply()
+        if not isinstance(result, tuple):
+            return result, 200, {}
+        body, status, *headers = result
+        return body, status, headers[0] if headers else {}
+
+    # Chat
+
+    def _check_model_ready(self) -> None:
+        """Raise a 503 while the model is loading (or failed to)."""
+        if self.llm.is_loaded():
+            return
+        status = self.llm.status()
+        if status["state"] == "failed":
+            error = f"Model failed to load: {status['error']}"
+        else:
+            error = "Model is still loading, please retry shortly"
+        raise ApiError(503, error, {"Retry-After": "5"}, model=status)
+
+    def begin_turn(self, request: ApiRequest, route: str) -> Turn:
+        """
+        Validate a /chat or /stream body and build the prompt for it.
+
+        Creates the conversation when the body names none.
+
+        Raises:
+            ApiError: If the model is not ready or the body is invalid
+        """
+        started = time.perf_counter()
+        self._check_model_ready()
+
+        data = request.json
+        if not data or not isinstance(data.get('message'), str):
+            raise ApiError(400, "No message provided")
+
+        user_message = data['message'].strip()
+        conversation_id = data.get('conversation_id')
+        model = data.get('model')
+
+        if conversation_id and not self.conversation.conversation_exists(conversation_id):
+            raise ApiError(404, "Conversation not found")
+        if model and model not in self.llm.model_names():
+            raise ApiError(400, f"Unknown model: {model}")
+        if not user_message:
+            raise ApiError(400, "Empty message")
+        if len(user_message) > MAX_MESSAGE_CHARS:
+            raise ApiError(400, "Message too long")
+
+        user_message = html.escape(user_message)
+        if not conversation_id:
+            conversation_id = self.conversation.create_conversation()
+        prompt = self.conversation.get_prompt(conversation_id, user_message)
+        return Turn(route, started, user_message, conversation_id, model, prompt,
+                    bool(data.get('compact')))
+
+    def save_turn(self, turn: Turn, response: str) -> None:
+        """Store a message and the answer generated for it."""
+        self.conversation.add_messages(
+            turn.conversation_id, [('user', turn.user_message), ('assistant', response)]
+        )
+
+    def finish_chat(self, turn: Turn, response: str) -> Reply:
+        """Store a /chat answer and build its response body."""
+        self.save_turn(turn, response)
+        history = self.conversation.get_history(turn.conversation_id)
+        turn.finished()
+        return {
+            "response": response,
+            "conversation_id": turn.conversation_id,
+            "history": history
+        }, 200, {}
+
+    @staticmethod
+    def generation_failed(route: str, error: Exception) -> Reply:
+        """The response for an error raised while starting a generation."""
+        if isinstance(error, ApiError):
+            return error.reply()
+        if isinstance(error, SchedulerFullError):
+            metrics.REQUEST_ERRORS.inc(route=route, status="503")
+            return {"error": str(error)}, 503, {"Retry-After": "1"}
+        if isinstance(error, ModelNotReadyError):
+            metrics.REQUEST_ERRORS.inc(route=route, status="503")
+            return {"error": str(error)}, 503, {"Retry-After": "5"}
+        metrics.REQUEST_ERRORS.inc(route=route, status="500")
+        print(f"Error in /{route}: {error}")
+        return {"error": str(error)}, 500, {}
+
+    # Health
+
+    def health(self, request: ApiRequest):
+        """Health check endpoint."""
+        return {
+            "status": "healthy" if self.llm.is_loaded() else self.llm.status()["state"],
+            "model_loaded": self.llm.is_loaded(),
+            "model": self.llm.status(),
+            "scheduler": self.llm.stats(),
+            "pending_writes": self._pending_writes(),
+            "history_cache": self.conversation.cache.stats()
+        }
+
+    def liveness(self, request: ApiRequest):
+        """Liveness probe: fails only once the model has failed to load."""
+        status = self.llm.status()
+        if status["state"] == "failed":
+            return {"status": "failed", "error": status["error"]}, 503
+        return {"status": "alive"}
+
+    def readiness(self, request: ApiRequest):
+        """Readiness probe: 200 once the model is loaded and the database is usable."""
+        problems = []
+        if not self.llm.is_loaded():
+            problems.append(f"Model {self.llm.status()['state']}")
+        db_problem = self.conversation.db.check()
+        if db_problem:
+            problems.append(db_problem)
+        if problems:
+            return {"status": "not ready", "problems": problems, "model": self.llm.status()}, 503
+        return {"status": "ready"}
+
+    # Models
+
+    def list_models(self, request: ApiRequest):
+        """Available models, which are loaded, and memory use."""
+        return self.llm.models()
+
+    def load_model(self, request: ApiRequest, name: str):
+        """Start loading a model in the background."""
+        try:
+            return self.llm.load_model(name), 202
+        except UnknownModelError as e:
+            raise ApiError(404, str(e))
+
+    def swap_model(self, request: ApiRequest, name: str):
+        """Register a model, or swap in new weights for one, without downtime."""
+        data = request.json or {}
+        if not data.get('file'):
+            raise ApiError(400, "No file provided")
+        try:
+            status = self.llm.swap_model(
+                name, data['file'], url=data.get('url'), sha256=data.get('sha256')
+            )
+            return status, 202
+        except ModelNotReadyError as e:
+            raise ApiError(409, str(e))
+        except ValueError as e:
+            raise ApiError(400, str(e))
+
+    # Batch jobs
+
+    def submit_job(self, request: ApiRequest):
+        """
+        Queue a batch job: a JSONL body of items (model from ?model=), or JSON
+        naming an instruction to run over conversations.
+        """
+        try:
+            if request.is_json:
+                data = request.json or {}
+                model = data.get('model')
+                conversation_ids = data.get('conversation_ids')
+                if conversation_ids is not None and not isinstance(conversation_ids, list):
+                    raise ApiError(400, "conversation_ids must be a list")
+            else:
+                model = request.args.get('model')
+                items = parse_items(request.text.splitlines())
+            if model and model not in self.llm.model_names():
+                raise ApiError(400, f"Unknown model: {model}")
+            if request.is_json:
+                job = self.jobs.submit_conversations(
+                    data.get('instruction'), conversation_ids, model
+                )
+            else:
+                job = self.jobs.submit(items, model)
+            return job, 202
+        except ValueError as e:
+            raise ApiError(400, str(e))
+
+    def list_jobs(self, request: ApiRequest):
+        """Every batch job with its progress."""
+        return {"jobs": self.jobs.list()}
+
+    def get_job(self, request: ApiRequest, job_id: str):
+        """A batch job's state and progress."""
+        job = self.jobs.get(job_id)
+        if job is None:
+            raise ApiError(404, "Job not found")
+        return job
+
+    def job_output_path(self, job_id: str):
+        """Where a job's results are written, for the server to send."""
+        path = self.jobs.output_path(job_id)
+        if path is None:
+            raise ApiError(404, "Job not found")
+        return path
+
+    def change_job(self, request: ApiRequest, job_id: str, action: str):
+        """Pause or resume a batch job."""
+        if action not in ('pause', 'resume'):
+            raise ApiError(404, f"Unknown action: {action}")
+        try:
+            job = self.jobs.pause(job_id) if action == 'pause' else self.jobs.resume(job_id)
+        except JobStateError as e:
+            raise ApiError(409, str(e))
+        if job is None:
+            raise ApiError(404, "Job not found")
+        return job
+
+    def delete_job(self, request: ApiRequest, job_id: str):
+        """Cancel a batch job and delete its files."""
+        if not self.jobs.delete(job_id):
+            raise ApiError(404, "Job not found")
+        return {"status": "deleted"}
+
+    # Conversations
+
+    def list_conversations(self, request: ApiRequest):
+        """Get a page of conversations, most recently updated first."""
+        try:
+            limit = int(request.args.get('limit', CONVERSATION_PAGE_SIZE))
+        except ValueError:
+            raise ApiError(400, "limit must be a number")
+        limit = max(1, min(limit, CONVERSATION_PAGE_MAX))
+        try:
+            return self.conversation.get_conversations(limit, request.args.get('cursor'))
+        except ValueError as e:
+            raise ApiError(400, str(e))
+
+    def search(self, request: ApiRequest):
+        """Find messages across all conversations, best match first."""
+        query = request.args.get('q', '').strip()
+        if not query:
+            raise ApiError(400, "No query provided")
+        try:
+            limit = int(request.args.get('limit', SEARCH_PAGE_SIZE))
+            offset = int(request.args.get('offset', 0))
+        except ValueError:
+            raise ApiError(400, "limit and offset must be numbers")
+        try:
+            return self.conversation.search(query, limit, offset)
+        except SearchUnavailableError as e:
+            raise ApiError(503, str(e))
+        except RuntimeError as e:
+            raise ApiError(404, str(e))
+
+    def create_conversation(self, request: ApiRequest):
+        """Create a new conversation."""
+        return {"id": self.conversation.create_conversation()}
+
+    def get_conversation(self, request: ApiRequest, cid: str):
+        """Get specific conversation history."""
+        if not self.conversation.conversation_exists(cid):
+            raise ApiError(404, "Conversation not found")
+        return {"id": cid, "history": self.conversation.get_history(cid)}
+
+    def delete_conversation(self, request: ApiRequest, cid: str):
+        """Delete a conversation."""
+        self.conversation.delete_conversation(cid)
+        self.llm.forget_conversation(cid)
+        return {"status": "deleted"}
+
+    def clear_history(self, request: ApiRequest):
+        """Clear a conversation's history."""
+        conversation_id = (request.json or {}).get('conversation_id')
+        if not conversation_id:
+            raise ApiError(400, "No conversation_id provided")
+        self.conversation.clear_history(conversation_id)
+        self.llm.forget_conversation(conversation_id)
+        return {"status": "cleared"}
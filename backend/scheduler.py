@@ -0,0 +1,657 @@
+import asyncio
+import codecs
+import ctypes
+import queue
+import threading
+import time
+import uuid
+from collections import deque
+from pathlib import Path
+from typing import AsyncIterator, Dict, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+import llama_cpp
+from llama_cpp import Llama
+from kv_cache import CachedSequence, KVStateCache, common_prefix_length
+
+
+class SchedulerFullError(RuntimeError):
+    """Raised when the waiting queue is at capacity."""
+
+
+def prompt_lookup(tokens: Sequence[int], max_ngram: int, min_ngram: int,
+                  n_draft: int) -> List[int]:
+    """
+    Guess the next tokens by finding the latest earlier occurrence of the
+    sequence's last n-gram (longest first) and copying what followed it.
+    """
+    array = np.asarray(tokens, dtype=np.int64)
+    for n in range(min(max_ngram, len(array) - 1), min_ngram - 1, -1):
+        # Every n-gram that starts before the final one
+        windows = np.lib.stride_tricks.sliding_window_view(array[:-1], n)
+        matches = np.flatnonzero((windows == array[-n:]).all(axis=1))
+        if len(matches):
+            start = int(matches[-1]) + n
+            return [int(t) for t in array[start:start + n_draft]]
+    return []
+
+
+class GenerationRequest:
+    """A queued generation whose text is delivered chunk by chunk as it decodes."""
+
+    _DONE = object()
+
+    # Reported back by worker processes along with a finished generation
+    TIMING_FIELDS = ("n_prompt_tokens", "cached_tokens", "n_generated",
+                     "n_drafted", "n_draft_accepted",
+                     "submitted_at", "started_at", "first_token_at", "finished_at")
+
+    def __init__(self, prompt_tokens: List[int], max_tokens: int,
+                 temperature: float, stop: List[str],
+                 cache_key: Optional[str] = None):
+        self.id = str(uuid.uuid4())
+        self.prompt_tokens = prompt_tokens
+        self.n_prompt_tokens = len(prompt_tokens)
+        self.max_tokens = max_tokens
+        self.temperature = temperature
+        self.stop = stop
+        self.cache_key = cache_key
+        self.cached_tokens = 0
+        self.submitted_at = time.monotonic()
+        self.started_at: Optional[float] = None
+        self.first_token_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.n_generated = 0
+        self.n_drafted = 0
+        self.n_draft_accepted = 0
+        self.finish_reason: Optional[str] = None
+        self._chunks: "queue.Queue" = queue.Queue()
+        self._cancelled = threading.Event()
+        self._lock = threading.Lock()
+        self._listener = None  # (event loop, asyncio.Queue) once astream() starts
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled.is_set()
+
+    def cancel(self) -> None:
+        """Stop generating; the slot is freed on the scheduler's next step."""
+        self._cancelled.set()
+
+    def stream(self) -> Iterator[str]:
+        """Yield text chunks until the generation finishes."""
+        try:
+            while True:
+                item = self._chunks.get()
+                if item is self._DONE:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            # A consumer that stops reading early (e.g. client disconnect)
+            # should not keep a decode slot busy.
+            if self.finish_reason is None:
+                self.cancel()
+
+    async def astream(self) -> AsyncIterator[str]:
+        """
+        Like stream(), but for asyncio code: awaits chunks without tying up a
+        thread. Cancelling the consuming task cancels the generation.
+        """
+        loop = asyncio.get_running_loop()
+        chunks: "asyncio.Queue" = asyncio.Queue()
+        with self._lock:
+            # Hand over anything produced before we started listening
+            while True:
+                try:
+                    chunks.put_nowait(self._chunks.get_nowait())
+                except queue.Empty:
+                    break
+            self._listener = (loop, chunks)
+        try:
+            while True:
+                item = await chunks.get()
+                if item is self._DONE:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            if self.finish_reason is None:
+                self.cancel()
+
+    def timings(self) -> Dict:
+        """Token counts and timestamps of this generation."""
+        return {field: getattr(self, field) for field in self.TIMING_FIELDS}
+
+    def result(self) -> str:
+        """Block until the generation finishes and return the full text."""
+        return "".join(self.stream())
+
+    def _put(self, item) -> None:
+        with self._lock:
+            if self._listener is None:
+                self._chunks.put(item)
+                return
+            loop, chunks = self._listener
+        try:
+            loop.call_soon_threadsafe(chunks.put_nowait, item)
+        except RuntimeError:
+            # The consumer's event loop has shut down
+            self.cancel()
+
+
+class _Slot:
+    """One decode lane in the shared context, bound to a llama.cpp sequence id."""
+
+    def __init__(self, seq_id: int):
+        self.seq_id = seq_id
+        self.request: Optional[GenerationRequest] = None
+        self.tokens: List[int] = []   # tokens already in the KV cache
+        self.pending: List[int] = []  # tokens still to be evaluated
+        self.draft: List[int] = []    # guessed tokens being verified this step
+        self.kv_cells = 0             # KV cells the request may hold that no other sequence shares
+        self.cached: Optional[Tuple[CachedSequence, int]] = None  # state to restore, tokens reused
+        self.batch_index = -1
+        self.text = ""                # decoded text held back for stop matching
+        self.decoder = None
+
+    def assign(self, request: GenerationRequest) -> None:
+        self.request = request
+        self.tokens = []
+        self.pending = list(request.prompt_tokens)
+        self.batch_index = -1
+        self.text = ""
+        self.decoder = codecs.getincrementaldecoder("utf-8")(errors="ignore")
+
+
+class InferenceScheduler:
+    """
+    Continuous-batching scheduler in front of a single llama.cpp context.
+
+    Requests wait in a bounded queue and are admitted into decode slots as
+    they free up. Every step packs one token per generating slot plus prompt
+    chunks for slots still prefilling into a single llama_decode call, so
+    concurrent users share each forward pass instead of taking turns.
+
+    With a KVStateCache, a finished sequence's KV data is kept per
+    conversation and restored into the slot of that conversation's next
+    request, so only the new part of the prompt is prefilled.
+
+    A shared prefix (the system prompt) is evaluated once into a reserved
+    sequence and copied into every new slot; llama.cpp shares the cells
+    between sequences, so this costs no extra KV memory. Restored state is
+    not shared, prefix included, so admission counts each request's cells
+    against the context: a request that would overflow it is prefilled
+    from the shared prefix instead, or waits for a running one to finish.
+
+    With draft_tokens > 0, decoding slots speculate by prompt lookup: when
+    the last few tokens also occur earlier in the prompt or answer, what
+    followed them there is appended as a draft and checked in the same
+    forward pass. Each draft token is kept only if it is what would have
+    been sampled anyway, so output is unchanged, but answers that quote
+    their context (code, names, earlier turns) take several tokens a step.
+    """
+
+    PREFIX_SEQ_ID = 0
+
+    TOP_K = 40
+    TOP_P = 0.95
+    MIN_P = 0.05
+
+    # Shortest n-gram worth drafting from; single tokens match too loosely
+    MIN_DRAFT_NGRAM = 2
+
+    def __init__(self, model: Llama, max_slots: int, max_queue: int, n_ctx: int,
+                 kv_cache: Optional[KVStateCache] = None,
+                 shared_prefix: Optional[List[int]] = None,
+                 prefix_state_path: Optional[Path] = None,
+                 draft_tokens: int = 0, draft_ngram: int = 3):
+        self.model = model
+        self.kv_cache = kv_cache
+        self.draft_tokens = draft_tokens
+        self.draft_ngram = draft_ngram
+        self.shared_prefix: List[int] = []
+        self.max_queue = max_queue
+        self.n_ctx = n_ctx
+        self.n_batch = model.n_batch
+        self._kv_cells = model.n_ctx()
+        self._n_vocab = model.n_vocab()
+        self._slots = [_Slot(seq_id) for seq_id in range(1, max_slots + 1)]
+        self._waiting: deque = deque()
+        self._cond = threading.Condition()
+        self._batch = llama_cpp.llama_batch_init(self.n_batch, 0, 1)
+        self._rng = np.random.default_rng()
+        self._recent_tokens: deque = deque()  # (timestamp, n_tokens) per step
+        self._counters = {
+            "submitted": 0,
+            "rejected": 0,
+            "cancelled": 0,
+            "completed": 0,
+            "failed": 0,
+            "generated_tokens": 0,
+            "prefix_reused_tokens": 0,
+            "drafted_tokens": 0,
+            "accepted_draft_tokens": 0,
+        }
+        if shared_prefix:
+            self._load_shared_prefix(shared_prefix, prefix_state_path)
+        self._running = True
+        self._thread = threading.Thread(
+            target=self._run, name="inference-scheduler", daemon=True
+        )
+        self._thread.start()
+
+    def submit(self, prompt: str, max_tokens: int, temperature: float,
+               stop: List[str], cache_key: Optional[str] = None) -> GenerationRequest:
+        """Queue a prompt for generation, or raise SchedulerFullError."""
+        tokens = self.model.tokenize(prompt.encode("utf-8"), special=True)
+        if len(tokens) >= self.n_ctx:
+            raise ValueError(
+                f"Requested tokens ({len(tokens)}) exceed context window of {self.n_ctx}"
+            )
+        request = GenerationRequest(
+            tokens, min(max_tokens, self.n_ctx - len(tokens)), temperature, stop,
+            cache_key=cache_key
+        )
+        with self._cond:
+            if len(self._waiting) >= self.max_queue:
+                self._counters["rejected"] += 1
+                raise SchedulerFullError("Server is busy, please retry shortly")
+            self._waiting.append(request)
+            self._counters["submitted"] += 1
+            self._cond.notify()
+        return request
+
+    def stats(self) -> Dict:
+        """Queue depth, slot usage and throughput counters."""
+        now = time.monotonic()
+        with self._cond:
+            while self._recent_tokens and now - self._recent_tokens[0][0] > 10:
+                self._recent_tokens.popleft()
+            recent = sum(n for _, n in self._recent_tokens)
+            return {
+                "queue_depth": len(self._waiting),
+                "max_queue_depth": self.max_queue,
+                "active_slots": sum(1 for s in self._slots if s.request is not None),
+                "max_slots": len(self._slots),
+                "tokens_per_second": round(recent / 10, 2),
+                **self._counters,
+                "kv_cache": self.kv_cache.stats() if self.kv_cache else None,
+            }
+
+    def forget(self, cache_key: str) -> None:
+        """Drop cached KV state for a conversation."""
+        if self.kv_cache is not None:
+            self.kv_cache.drop(cache_key)
+
+    def close(self) -> None:
+        """Stop the worker thread and fail anything still queued."""
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+        self._thread.join()
+        llama_cpp.llama_batch_free(self._batch)
+
+    # ------------------------------------------------------------------ #
+    # Worker thread
+    # ------------------------------------------------------------------ #
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                while self._running and not self._waiting and not self._active():
+                    self._cond.wait()
+                if not self._running:
+                    break
+                admitted = self._admit()
+            try:
+                for slot in admitted:
+                    self._restore(slot)
+                self._step()
+            except Exception as e:
+                print(f"Scheduler step failed: {e}")
+                for slot in self._active():
+                    slot.request._put(e)
+                    self._release(slot, "error")
+        self._shutdown()
+
+    def _active(self) -> List[_Slot]:
+        return [slot for slot in self._slots if slot.request is not None]
+
+    def _admit(self) -> List[_Slot]:
+        """Move waiting requests into free slots (caller holds the lock)."""
+        admitted = []
+        free_cells = (self._kv_cells - len(self.shared_prefix)
+                      - sum(slot.kv_cells for slot in self._active()))
+        for slot in self._slots:
+            if slot.request is not None:
+                continue
+            while self._waiting:
+                request = self._waiting[0]
+                if request.cancelled:
+                    self._waiting.popleft()
+                    request.finish_reason = "cancelled"
+                    request._put(GenerationRequest._DONE)
+                    self._counters["cancelled"] += 1
+                    continue
+                plan = self._plan(request, free_cells, idle=not self._active())
+                if plan is None:
+                    return admitted  # Wait for a running request to free KV cells
+                self._waiting.popleft()
+                request.started_at = time.monotonic()
+                slot.assign(request)
+                slot.kv_cells, slot.cached = plan
+                free_cells -= slot.kv_cells
+                admitted.append(slot)
+                break
+        return admitted
+
+    def _plan(self, request: GenerationRequest, free_cells: int,
+              idle: bool) -> Optional[Tuple[int, Optional[Tuple[CachedSequence, int]]]]:
+        """
+        KV cells a request needs and the cached state to restore for it.
+
+        Returns None if it does not fit beside the running requests; an idle
+        scheduler admits it regardless, as nothing will free cells for it.
+        """
+        prompt = request.prompt_tokens
+        # The last prompt token is always evaluated so there are logits to sample
+        limit = len(prompt) - 1
+        n_prefix = min(common_prefix_length(self.shared_prefix, prompt), limit)
+        needed = len(prompt) + request.max_tokens
+        if needed - n_prefix > free_cells and not idle:
+            return None
+        if self.kv_cache is not None and request.cache_key is not None:
+            entry, n_cached = self.kv_cache.lookup(request.cache_key, prompt)
+            n_cached = min(n_cached, limit)
+            # Restored cells are the slot's own, including the prefix part
+            cells = max(needed, len(entry.tokens)) if entry is not None else 0
+            if n_cached > n_prefix and (cells <= free_cells or idle):
+                return cells, (entry, n_cached)
+        return needed - n_prefix, None
+
+    def _load_shared_prefix(self, tokens: List[int], state_path: Optional[Path]) -> None:
+        """Fill the reserved prefix sequence from disk, or evaluate and save it."""
+        ctx = self.model.ctx
+        if state_path is not None and state_path.exists():
+            saved = (llama_cpp.llama_token * len(tokens))()
+            n_saved = ctypes.c_size_t(0)
+            loaded = llama_cpp.llama_state_seq_load_file(
+                ctx, str(state_path).encode("utf-8"), self.PREFIX_SEQ_ID,
+                saved, len(tokens), ctypes.byref(n_saved)
+            )
+            if loaded and list(saved[:n_saved.value]) == tokens:
+                self.shared_prefix = list(tokens)
+                print(f"✓ System prompt state restored: {state_path.name}")
+                return
+            llama_cpp.llama_kv_cache_seq_rm(ctx, self.PREFIX_SEQ_ID, -1, -1)
+
+        batch = self._batch
+        for start in range(0, len(tokens), self.n_batch):
+            chunk = tokens[start:start + self.n_batch]
+            batch.n_tokens = len(chunk)
+            for i, token in enumerate(chunk):
+                batch.token[i] = token
+                batch.pos[i] = start + i
+                batch.seq_id[i][0] = self.PREFIX_SEQ_ID
+                batch.n_seq_id[i] = 1
+                batch.logits[i] = False
+            batch.logits[len(chunk) - 1] = True
+            if llama_cpp.llama_decode(ctx, batch) != 0:
+                print("✗ Failed to precompute system prompt state")
+                llama_cpp.llama_kv_cache_seq_rm(ctx, self.PREFIX_SEQ_ID, -1, -1)
+                return
+        self.shared_prefix = list(tokens)
+
+        if state_path is not None:
+            token_array = (llama_cpp.llama_token * len(tokens))(*tokens)
+            if llama_cpp.llama_state_seq_save_file(
+                ctx, str(state_path).encode("utf-8"), self.PREFIX_SEQ_ID,
+                token_array, len(tokens)
+            ):
+                print(f"✓ System prompt state saved: {state_path.name}")
+
+    def _restore(self, slot: _Slot) -> None:
+        """Seed a freshly admitted slot with cached KV data for its prompt."""
+        request = slot.request
+        prompt = request.prompt_tokens
+        n_prefix = min(common_prefix_length(self.shared_prefix, prompt), len(prompt) - 1)
+
+        if slot.cached is not None and self._load_cached(slot, slot.cached[0]):
+            n_reused = slot.cached[1]
+        elif n_prefix > 0:
+            llama_cpp.llama_kv_cache_seq_cp(
+                self.model.ctx, self.PREFIX_SEQ_ID, slot.seq_id, 0, n_prefix
+            )
+            self._counters["prefix_reused_tokens"] += n_prefix
+            n_reused = n_prefix
+        else:
+            return
+        llama_cpp.llama_kv_cache_seq_rm(self.model.ctx, slot.seq_id, n_reused, -1)
+        slot.tokens = prompt[:n_reused]
+        slot.pending = prompt[n_reused:]
+        request.cached_tokens = n_reused
+
+    def _load_cached(self, slot: _Slot, entry: CachedSequence) -> bool:
+        data = (ctypes.c_uint8 * len(entry.data)).from_buffer_copy(entry.data)
+        if llama_cpp.llama_state_seq_set_data(
+            self.model.ctx, data, len(entry.data), slot.seq_id
+        ) == 0:
+            print(f"Failed to restore cached state for {slot.request.cache_key}")
+            llama_cpp.llama_kv_cache_seq_rm(self.model.ctx, slot.seq_id, -1, -1)
+            return False
+        return True
+
+    def _save(self, slot: _Slot) -> None:
+        """Copy a finished slot's KV data into the cache for its conversation."""
+        size = llama_cpp.llama_state_seq_get_size(self.model.ctx, slot.seq_id)
+        data = (ctypes.c_uint8 * size)()
+        n_bytes = llama_cpp.llama_state_seq_get_data(
+            self.model.ctx, data, size, slot.seq_id
+        )
+        if n_bytes:
+            self.kv_cache.store(slot.request.cache_key, slot.tokens, bytes(data)[:n_bytes])
+
+    def _step(self) -> None:
+        """Run one batched forward pass over every active slot."""
+        for slot in self._active():
+            if slot.request.cancelled:
+                self._release(slot, "cancelled")
+
+        batch = self._batch
+        batch.n_tokens = 0
+        budget = self.n_batch
+        # Single-token decode steps go first so a long prefill can't stall
+        # sequences that are already streaming.
+        scheduled = sorted(self._active(), key=lambda s: len(s.pending))
+        for slot in scheduled:
+            slot.batch_index = -1
+            slot.draft = []
+            if budget == 0:
+                continue
+            chunk = slot.pending[:budget]
+            n_past = len(slot.tokens)
+            for i, token in enumerate(chunk):
+                j = batch.n_tokens
+                batch.token[j] = token
+                batch.pos[j] = n_past + i
+                batch.seq_id[j][0] = slot.seq_id
+                batch.n_seq_id[j] = 1
+                batch.logits[j] = False
+                batch.n_tokens += 1
+            del slot.pending[:len(chunk)]
+            slot.tokens.extend(chunk)
+            budget -= len(chunk)
+            if not slot.pending:
+                batch.logits[batch.n_tokens - 1] = True
+                slot.batch_index = batch.n_tokens - 1
+                slot.draft = self._draft(slot, budget)
+                # Drafted tokens follow the real one, each with logits to verify it
+                for i, token in enumerate(slot.draft):
+                    j = batch.n_tokens
+                    batch.token[j] = token
+                    batch.pos[j] = len(slot.tokens) + i
+                    batch.seq_id[j][0] = slot.seq_id
+                    batch.n_seq_id[j] = 1
+                    batch.logits[j] = True
+                    batch.n_tokens += 1
+                slot.tokens.extend(slot.draft)
+                budget -= len(slot.draft)
+
+        if batch.n_tokens == 0:
+            return
+        ret = llama_cpp.llama_decode(self.model.ctx, batch)
+        if ret != 0:
+            raise RuntimeError(f"llama_decode failed with status {ret}")
+
+        sampled = 0
+        for slot in scheduled:
+            if slot.batch_index < 0:
+                continue
+            request = slot.request
+            tokens = self._verify(slot)
+            for token in tokens:
+                self._accept(slot, token)
+                sampled += 1
+                if slot.request is not request:
+                    break  # Finished part way through the accepted draft
+
+        if sampled:
+            with self._cond:
+                self._recent_tokens.append((time.monotonic(), sampled))
+            self._counters["generated_tokens"] += sampled
+
+    def _draft(self, slot: _Slot, budget: int) -> List[int]:
+        """Tokens to guess after a decoding slot's next token, or none."""
+        request = slot.request
+        if self.draft_tokens <= 0 or request.n_generated == 0:
+            return []  # Off, or the prompt has only just been evaluated
+        # Room left in the batch, the answer and the slot's context
+        limit = min(self.draft_tokens, budget,
+                    request.max_tokens - request.n_generated - 1,
+                    self.n_ctx - len(slot.tokens) - 2)
+        if limit <= 0:
+            return []
+        return prompt_lookup(slot.tokens, self.draft_ngram, self.MIN_DRAFT_NGRAM, limit)
+
+    def _verify(self, slot: _Slot) -> List[int]:
+        """
+        Sample a slot's next token and, while they match its draft, the
+        ones after it. Rejected draft tokens are removed from the KV cache.
+        """
+        request = slot.request
+        draft = slot.draft
+        tokens = []
+        for i in range(len(draft) + 1):
+            logits = np.ctypeslib.as_array(
+                llama_cpp.llama_get_logits_ith(self.model.ctx, slot.batch_index + i),
+                shape=(self._n_vocab,),
+            )
+            tokens.append(self._sample(logits, request.temperature))
+            if i == len(draft) or tokens[-1] != draft[i]:
+                break
+        if draft:
+            accepted = len(tokens) - 1
+            keep = len(slot.tokens) - (len(draft) - accepted)
+            if keep < len(slot.tokens):
+                llama_cpp.llama_kv_cache_seq_rm(self.model.ctx, slot.seq_id, keep, -1)
+                del slot.tokens[keep:]
+            request.n_drafted += len(draft)
+            request.n_draft_accepted += accepted
+            self._counters["drafted_tokens"] += len(draft)
+            self._counters["accepted_draft_tokens"] += accepted
+        return tokens
+
+    def _sample(self, logits: np.ndarray, temperature: float) -> int:
+        """
+        Top-k / top-p / min-p filtering, then temperature, in the order of
+        llama.cpp's default sampler chain.
+        """
+        if temperature <= 0:
+            return int(np.argmax(logits))
+        candidates = np.argpartition(logits, -self.TOP_K)[-self.TOP_K:]
+        values = logits[candidates].astype(np.float64)
+        probs = np.exp(values - values.max())
+        probs /= probs.sum()
+        order = np.argsort(-probs)
+        cumulative = np.cumsum(probs[order])
+        keep = order[: int(np.searchsorted(cumulative, self.TOP_P)) + 1]
+        keep = keep[probs[keep] >= self.MIN_P * probs[keep[0]]]
+        scaled = values[keep] / temperature
+        p = np.exp(scaled - scaled.max())
+        p /= p.sum()
+        return int(candidates[self._rng.choice(keep, p=p)])
+
+    def _accept(self, slot: _Slot, token: int) -> None:
+        """Emit a sampled token's text and decide whether the slot continues."""
+        request = slot.request
+        if request.first_token_at is None:
+            request.first_token_at = time.monotonic()
+        if llama_cpp.llama_token_is_eog(self.model.model, token):
+            self._release(slot, "stop")
+            return
+
+        request.n_generated += 1
+        slot.text += slot.decoder.decode(self.model.detokenize([token]))
+        for stop in request.stop:
+            index = slot.text.find(stop)
+            if index != -1:
+                slot.text = slot.text[:index]
+                self._release(slot, "stop")
+                return
+
+        # Hold back a tail that could still turn into a stop sequence
+        held = self._partial_stop_length(slot.text, request.stop)
+        if len(slot.text) > held:
+            request._put(slot.text[:len(slot.text) - held])
+            slot.text = slot.text[len(slot.text) - held:]
+
+        if request.n_generated >= request.max_tokens or len(slot.tokens) + 1 >= self.n_ctx:
+            self._release(slot, "length")
+            return
+        slot.pending = [token]
+
+    @staticmethod
+    def _partial_stop_length(text: str, stops: List[str]) -> int:
+        held = 0
+        for stop in stops:
+            for n in range(min(len(stop) - 1, len(text)), held, -1):
+                if text.endswith(stop[:n]):
+                    held = n
+                    break
+        return held
+
+    def _release(self, slot: _Slot, reason: str) -> None:
+        """Finish the slot's request and drop its sequence from the KV cache."""
+        request = slot.request
+        if reason in ("stop", "length"):
+            if slot.text:
+                request._put(slot.text)
+            if self.kv_cache is not None and request.cache_key is not None:
+                self._save(slot)
+        request.finish_reason = reason
+        request.finished_at = time.monotonic()
+        request._put(GenerationRequest._DONE)
+        llama_cpp.llama_kv_cache_seq_rm(self.model.ctx, slot.seq_id, -1, -1)
+        slot.request = None
+        slot.pending = []
+        slot.text = ""
+        slot.kv_cells = 0
+        slot.cached = None
+        if reason == "cancelled":
+            self._counters["cancelled"] += 1
+        elif reason == "error":
+            self._counters["failed"] += 1
+        else:
+            self._counters["completed"] += 1
+
+    def _shutdown(self) -> None:
+        error = RuntimeError("Scheduler stopped")
+        for slot in self._active():
+            slot.request._put(error)
+            self._release(slot, "error")
+        with self._cond:
+            while self._waiting:
+                self._waiting.popleft()._put(error)
@@ -0,0 +1,359 @@
+"""
+Full-text search over conversation messages.
+
+Two interchangeable backends, chosen with SEARCH_BACKEND:
+
+- mysql: a FULLTEXT index on messages.content, added by migrate.py. InnoDB
+  keeps it current as messages are written and deleted, so the indexing
+  hooks do nothing. Hits are ranked by relevance to any of the words.
+- sqlite: an FTS5 index in a local file (SEARCH_INDEX_PATH), updated as
+  messages are added and dropped with their conversation. It needs no
+  FULLTEXT support from the database and keeps search load off it; hits
+  contain every word (or another form of it, e.g. a plural) and the most
+  recent RANK_WINDOW of them are ranked by BM25; when there are more, the
+  response says so with "truncated".
+  An empty index is filled from the messages table in the background.
+
+Either way a search reads a bounded number of hits from the index and never
+scans the messages table.
+"""
+import math
+import re
+import sqlite3
+import threading
+from pathlib import Path
+from typing import Dict, List, Optional, Set, Tuple
+
+from config import SEARCH_BACKEND, SEARCH_INDEX_PATH
+
+# Largest page a client may ask for
+MAX_PAGE_SIZE = 100
+
+# Words of a query that are used; the rest are ignored
+MAX_TERMS = 16
+
+# Characters of message text shown around the first match
+SNIPPET_CHARS = 160
+
+class SearchUnavailableError(RuntimeError):
+    """Raised when the search backend can't answer, e.g. its index is missing."""
+
+
+# With SEARCH_BACKEND=sqlite, how many of the most recent matches are ranked
+RANK_WINDOW = 1000
+
+# Messages read from MySQL per batch when filling an empty index
+REBUILD_BATCH = 1000
+
+# Conversation ids per query when looking up titles
+TITLE_BATCH = 500
+
+
+def search_terms(query: str) -> List[str]:
+    """The words of a query, lowercased, without search syntax."""
+    return re.findall(r"\w+", query.lower())[:MAX_TERMS]
+
+
+def bm25(documents: List[str], terms: List[str], k1: float = 1.2, b: float = 0.75) -> List[float]:
+    """BM25 score of each document for the terms, with statistics taken from `documents`."""
+    if not documents:
+        return []
+    patterns = [re.compile(r"\b" + re.escape(term), re.IGNORECASE) for term in terms]
+    counts = [[len(pattern.findall(doc)) for pattern in patterns] for doc in documents]
+    lengths = [len(doc.split()) or 1 for doc in documents]
+    average = sum(lengths) / len(lengths)
+    n = len(documents)
+    idf = []
+    for j in range(len(terms)):
+        containing = sum(1 for row in counts if row[j])
+        idf.append(math.log((n - containing + 0.5) / (containing + 0.5) + 1))
+    return [
+        sum(idf[j] * tf * (k1 + 1) / (tf + k1 * (1 - b + b * length / average))
+            for j, tf in enumerate(row))
+        for row, length in zip(counts, lengths)
+    ]
+
+
+def make_snippet(content: str, terms: List[str], width: int = SNIPPET_CHARS) -> str:
+    """About `width` characters of `content` around the first word matching a term."""
+    match = re.search(r"\b(?:" + "|".join(map(re.escape, terms)) + ")", content, re.IGNORECASE)
+    start = max((match.start() if match else 0) - width // 4, 0)
+    if start:
+        # Start at a word boundary
+        space = content.find(" ", start)
+        start = space + 1 if 0 <= space < start + 20 else start
+    snippet = content[start:start + width]
+    prefix = "…" if start else ""
+    suffix = "…" if start + width < len(content) else ""
+    return prefix + " ".join(snippet.split()) + suffix
+
+
+class SearchIndex:
+    """Base class: indexing hooks that do nothing, and paging of hits."""
+
+    def __init__(self, db):
+        self.db = db
+
+    def add(self, conversation_id: str, messages: List[Dict]) -> None:
+        """Index newly added messages (dicts with id, role, content, timestamp)."""
+
+    def remove_conversation(self, conversation_id: str) -> None:
+        """Drop a deleted or cleared conversation's messages from the index."""
+
+    def search(self, query: str, limit: int = 20, offset: int = 0) -> Dict:
+        """
+        One page of messages matching `query`, best first.
+
+        Returns:
+            {"results": [{conversation_id, title, message_id, role, snippet,
+            created_at, score}, ...], "next_offset": offset of the next page or None,
+            "truncated": True if only some of the matches were ranked}
+        """
+        terms = search_terms(query)
+        if not terms:
+            return {"results": [], "next_offset": None, "truncated": False}
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
+        rows, truncated = self._search(terms, limit + 1, max(offset, 0))
+        next_offset = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_offset = offset + limit
+        results = [
+            {
+                "conversation_id": row["conversation_id"],
+                "title": row["title"],
+                "message_id": row["message_id"],
+                "role": row["role"],
+                "snippet": make_snippet(row["content"], terms),
+                "created_at": row["created_at"],
+                "score": round(float(row["score"]), 4),
+            }
+            for row in rows
+        ]
+        return {"results": results, "next_offset": next_offset, "truncated": truncated}
+
+    def _search(self, terms: List[str], limit: int, offset: int) -> Tuple[List[Dict], bool]:
+        """(`limit` hits from `offset`, whether matches beyond those ranked were left out)."""
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+
+class MySQLSearchIndex(SearchIndex):
+    """Searches the FULLTEXT index InnoDB maintains on messages.content."""
+
+    def _search(self, terms: List[str], limit: int, offset: int) -> Tuple[List[Dict], bool]:
+        query = " ".join(terms)
+        # Not fetch_all(): it turns errors into no rows, and a missing index
+        # (error 1191 until migrate.py has run) must not look like no hits
+        try:
+            with self.db.transaction() as cursor:
+                cursor.execute(
+                    "SELECT m.id AS message_id, m.conversation_id, m.role, m.content, "
+                    "m.created_at, c.title, "
+                    "MATCH(m.content) AGAINST (%s IN NATURAL LANGUAGE MODE) AS score "
+                    "FROM messages m JOIN conversations c ON c.id = m.conversation_id "
+                    "WHERE MATCH(m.content) AGAINST (%s IN NATURAL LANGUAGE MODE) "
+                    "ORDER BY score DESC, m.id LIMIT %s OFFSET %s",
+                    (query, query, limit, offset)
+                )
+                rows = cursor.fetchall()
+        except Exception as e:
+            print(f"✗ Full-text search failed: {e}")
+            raise SearchUnavailableError(f"Search is unavailable: {e}") from e
+        for row in rows:
+            row["created_at"] = row["created_at"].isoformat()
+        return rows, False
+
+
+class SQLiteSearchIndex(SearchIndex):
+    """FTS5 index of message text in a local SQLite file."""
+
+    def __init__(self, db, path: Path = SEARCH_INDEX_PATH):
+        super().__init__(db)
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(str(path), check_same_thread=False, isolation_level=None)
+        self._conn.row_factory = sqlite3.Row
+        self._lock = threading.Lock()
+        # Conversations removed while a rebuild runs; its batches skip them
+        self._removed: Optional[Set[str]] = None
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode = WAL")
+            self._conn.execute("PRAGMA synchronous = NORMAL")
+            self._conn.executescript("""
+                CREATE TABLE IF NOT EXISTS indexed_messages (
+                    rowid INTEGER PRIMARY KEY,
+                    message_id TEXT NOT NULL UNIQUE,
+                    conversation_id TEXT NOT NULL,
+                    role TEXT NOT NULL,
+                    created_at TEXT NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS idx_indexed_messages_conversation
+                    ON indexed_messages (conversation_id);
+                CREATE VIRTUAL TABLE IF NOT EXISTS message_text
+                    USING fts5(content, tokenize = 'porter unicode61 remove_diacritics 2');
+                CREATE TABLE IF NOT EXISTS index_state (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL
+                );
+            """)
+            built = self._conn.execute(
+                "SELECT value FROM index_state WHERE key = 'built'"
+            ).fetchone()
+        if built is None:
+            self._removed = set()
+            threading.Thread(target=self._rebuild, name="search-rebuild", daemon=True).start()
+
+    def add(self, conversation_id: str, messages: List[Dict]) -> None:
+        try:
+            with self._lock:
+                self._conn.execute("BEGIN")
+                try:
+                    self._insert(conversation_id, messages)
+                    self._conn.execute("COMMIT")
+                except BaseException:
+                    self._conn.execute("ROLLBACK")
+                    raise
+        except sqlite3.Error as e:
+            print(f"✗ Error indexing messages of {conversation_id}: {e}")
+
+    def _insert(self, conversation_id: str, messages: List[Dict]) -> None:
+        """Index messages not indexed yet; call inside a transaction."""
+        for msg in messages:
+            cursor = self._conn.execute(
+                "INSERT OR IGNORE INTO indexed_messages "
+                "(message_id, conversation_id, role, created_at) VALUES (?, ?, ?, ?)",
+                (msg["id"], conversation_id, msg["role"], msg["timestamp"])
+            )
+            if cursor.rowcount:
+                self._conn.execute(
+                    "INSERT INTO message_text (rowid, content) VALUES (?, ?)",
+                    (cursor.lastrowid, msg["content"])
+                )
+
+    def remove_conversation(self, conversation_id: str) -> None:
+        try:
+            with self._lock:
+                if self._removed is not None:
+                    self._removed.add(conversation_id)
+                self._conn.execute("BEGIN")
+                try:
+                    self._conn.execute(
+                        "DELETE FROM message_text WHERE rowid IN ("
+                        "SELECT rowid FROM indexed_messages WHERE conversation_id = ?)",
+                        (conversation_id,)
+                    )
+                    self._conn.execute(
+                        "DELETE FROM indexed_messages WHERE conversation_id = ?",
+                        (conversation_id,)
+                    )
+                    self._conn.execute("COMMIT")
+                except BaseException:
+                    self._conn.execute("ROLLBACK")
+                    raise
+        except sqlite3.Error as e:
+            print(f"✗ Error removing {conversation_id} from the search index: {e}")
+
+    def _search(self, terms: List[str], limit: int, offset: int) -> Tuple[List[Dict], bool]:
+        # Quoted so the words are never read as FTS5 syntax
+        match = " ".join(f'"{term}"' for term in terms)
+        with self._lock:
+            # FTS5's own BM25 reads every posting of every word to weigh it, so
+            # common words would cost time in proportion to the index. Instead
+            # the newest RANK_WINDOW matches, which FTS5 streams in rowid order,
+            # are ranked here.
+            rows = self._conn.execute(
+                "SELECT i.message_id, i.conversation_id, i.role, i.created_at, t.content "
+                "FROM message_text t JOIN indexed_messages i ON i.rowid = t.rowid "
+                "WHERE message_text MATCH ? ORDER BY t.rowid DESC LIMIT ?",
+                (match, RANK_WINDOW + 1)
+            ).fetchall()
+        truncated = len(rows) > RANK_WINDOW
+        rows = [dict(row) for row in rows[:RANK_WINDOW]]
+        # Drop conversations deleted behind the index's back before paging,
+        # so pages stay full and next_offset is right
+        titles = self._titles({row["conversation_id"] for row in rows})
+        rows = [{**row, "title": titles[row["conversation_id"]]}
+                for row in rows if row["conversation_id"] in titles]
+        for row, score in zip(rows, bm25([row["content"] for row in rows], terms)):
+            row["score"] = score
+        rows.sort(key=lambda row: row["score"], reverse=True)
+        return rows[offset:offset + limit], truncated
+
+    def _titles(self, conversation_ids: Set[str]) -> Dict[str, str]:
+        """Titles of those conversations that still exist."""
+        ids = list(conversation_ids)
+        titles = {}
+        for start in range(0, len(ids), TITLE_BATCH):
+            chunk = ids[start:start + TITLE_BATCH]
+            placeholders = ", ".join(["%s"] * len(chunk))
+            for conv in self.db.fetch_all(
+                    f"SELECT id, title FROM conversations WHERE id IN ({placeholders})",
+                    tuple(chunk)):
+                titles[conv["id"]] = conv["title"]
+        return titles
+
+    def _rebuild(self) -> None:
+        """Index every stored message, a batch at a time, then mark the index built."""
+        last_id = ""
+        indexed = 0
+        try:
+            while True:
+                # Through a transaction so a database error stops the build
+                with self.db.transaction() as cursor:
+                    cursor.execute(
+                        "SELECT id, conversation_id, role, content, created_at FROM messages "
+                        "WHERE id > %s ORDER BY id LIMIT %s",
+                        (last_id, REBUILD_BATCH)
+                    )
+                    rows = cursor.fetchall()
+                by_conversation: Dict[str, List[Dict]] = {}
+                for row in rows:
+                    by_conversation.setdefault(row["conversation_id"], []).append({
+                        "id": row["id"], "role": row["role"], "content": row["content"],
+                        "timestamp": row["created_at"].isoformat(),
+                    })
+                with self._lock:
+                    self._conn.execute("BEGIN")
+                    try:
+                        for conversation_id, messages in by_conversation.items():
+                            # Read before it was deleted or cleared; add() has
+                            # indexed anything newer
+                            if conversation_id not in self._removed:
+                                self._insert(conversation_id, messages)
+                        if len(rows) < REBUILD_BATCH:
+                            self._conn.execute(
+                                "INSERT OR REPLACE INTO index_state (key, value) VALUES ('built', '1')"
+                            )
+                        self._conn.execute("COMMIT")
+                    except BaseException:
+                        self._conn.execute("ROLLBACK")
+                        raise
+                indexed += len(rows)
+                if len(rows) < REBUILD_BATCH:
+                    break
+                last_id = rows[-1]["id"]
+        except Exception as e:
+            # Not marked built, so the next start tries again
+            print(f"✗ Error building the search index: {e}")
+            return
+        finally:
+            with self._lock:
+                self._removed = None
+        if indexed:
+            print(f"✓ Search index built ({indexed} messages)")
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+def create_search_index(db) -> Optional[SearchIndex]:
+    """The SearchIndex SEARCH_BACKEND names, or None when search is off."""
+    if SEARCH_BACKEND == "sqlite":
+        return SQLiteSearchIndex(db)
+    if SEARCH_BACKEND == "mysql":
+        return MySQLSearchIndex(db)
+    return None
@@ -0,0 +1,198 @@
+"""
+Server-Sent Events framing for /stream.
+
+Tokens are coalesced into frames instead of sent one by one: the first
+token goes out at once, later ones wait until SSE_COALESCE_MS have passed
+since the previous frame or SSE_COALESCE_BYTES are waiting. A fast model
+then costs one write (and one JSON encode) per burst rather than per token.
+
+Two framings are supported:
+
+- JSON (default): `data: {"token": "..."}` per frame, and
+  `data: {"done": true, ...}` or `data: {"error": "..."}` at the end
+- compact: text frames carry the text itself, one `data:` line per line
+  of text (clients join them with newlines, as the SSE spec says); the
+  final message is an `event: done` or `event: error` frame with the same
+  JSON body as in the JSON framing
+"""
+import asyncio
+import json
+import queue
+import re
+import threading
+import time
+from typing import AsyncIterator, Dict, Iterable, Iterator, List
+
+from config import SSE_COALESCE_MS, SSE_COALESCE_BYTES
+
+_LINE_BREAK = re.compile(r"\r\n|\r|\n")
+
+# Marks the end of the token stream read by frames()' helper thread
+_END = object()
+
+
+class _Failed:
+    """An exception raised by the token stream, passed to the reading side."""
+
+    def __init__(self, error: Exception):
+        self.error = error
+
+
+class SSEEncoder:
+    """Coalesces one response's tokens into SSE frames and keeps its full text."""
+
+    def __init__(self, compact: bool = False, interval: float = SSE_COALESCE_MS / 1000,
+                 max_bytes: int = SSE_COALESCE_BYTES):
+        self.compact = compact
+        self.interval = interval
+        self.max_bytes = max_bytes
+        self._parts: List[str] = []
+        self._pending = 0  # Parts not yet sent
+        self._pending_bytes = 0
+        self._last_frame = float("-inf")
+
+    @property
+    def text(self) -> str:
+        """Everything added so far."""
+        return "".join(self._parts)
+
+    def add(self, token: str) -> str:
+        """Buffer a token; returns a frame if one is due, else ""."""
+        if not token:
+            return ""
+        self._parts.append(token)
+        self._pending += 1
+        self._pending_bytes += len(token)
+        if (self._pending_bytes >= self.max_bytes
+                or time.monotonic() - self._last_frame >= self.interval):
+            return self.flush()
+        return ""
+
+    def flush(self) -> str:
+        """A frame of everything not yet sent ("" if nothing is waiting)."""
+        if not self._pending:
+            return ""
+        text = "".join(self._parts[-self._pending:])
+        self._pending = self._pending_bytes = 0
+        self._last_frame = time.monotonic()
+        if self.compact:
+            lines = _LINE_BREAK.split(text)
+            return "".join(f"data: {line}\n" for line in lines) + "\n"
+        return f"data: {json.dumps({'token': text})}\n\n"
+
+    def due_in(self) -> float:
+        """Seconds until waiting text should be flushed (0 if nothing waits)."""
+        if not self._pending:
+            return 0.0
+        return max(self._last_frame + self.interval - time.monotonic(), 0.0)
+
+    def frames(self, tokens: Iterable[str]) -> Iterator[str]:
+        """
+        Frames for a token stream, ending with whatever is left over.
+
+        Held text is also sent once its interval runs out: tokens are read
+        on a helper thread, so waiting for a slow one can time out. The
+        token stream is closed (from that thread) when the frames end or
+        are closed.
+        """
+        if self.interval <= 0:
+            yield from self._unbatched_frames(tokens)
+            return
+        ready: "queue.Queue" = queue.Queue()
+        stop = threading.Event()
+
+        def read() -> None:
+            try:
+                for token in tokens:
+                    ready.put(token)
+                    if stop.is_set():
+                        break  # The client went away; closing frees the generation
+            except Exception as e:
+                ready.put(_Failed(e))
+            finally:
+                close = getattr(tokens, "close", None)
+                if close is not None:
+                    close()
+                ready.put(_END)
+
+        threading.Thread(target=read, name="sse-reader", daemon=True).start()
+        try:
+            while True:
+                try:
+                    item = ready.get(timeout=self.due_in() if self._pending else None)
+                except queue.Empty:
+                    yield self.flush()
+                    continue
+                if item is _END:
+                    break
+                if isinstance(item, _Failed):
+                    raise item.error
+                frame = self.add(item)
+                if frame:
+                    yield frame
+            frame = self.flush()
+            if frame:
+                yield frame
+        finally:
+            stop.set()
+
+    def _unbatched_frames(self, tokens: Iterable[str]) -> Iterator[str]:
+        """frames() when every token is sent at once, so nothing waits on a deadline."""
+        try:
+            for token in tokens:
+                frame = self.add(token)
+                if frame:
+                    yield frame
+        finally:
+            close = getattr(tokens, "close", None)
+            if close is not None:
+                close()
+
+    async def aframes(self, tokens: AsyncIterator[str]) -> AsyncIterator[str]:
+        """Async frames(), waiting for tokens on the event loop instead of a thread."""
+        iterator = tokens.__aiter__()
+        pending = None
+        try:
+            while True:
+                if pending is None and not self._pending:
+                    # Nothing held back: no deadline, wait for the token directly
+                    try:
+                        token = await iterator.__anext__()
+                    except StopAsyncIteration:
+                        break
+                else:
+                    if pending is None:
+                        pending = asyncio.ensure_future(iterator.__anext__())
+                    timeout = self.due_in() if self._pending else None
+                    done, _ = await asyncio.wait({pending}, timeout=timeout)
+                    if not done:
+                        yield self.flush()
+                        continue
+                    next_token, pending = pending, None
+                    try:
+                        token = next_token.result()
+                    except StopAsyncIteration:
+                        break
+                frame = self.add(token)
+                if frame:
+                    yield frame
+            frame = self.flush()
+            if frame:
+                yield frame
+        finally:
+            if pending is not None:
+                pending.cancel()
+
+    def done(self, payload: Dict) -> str:
+        """The final frame of a successful response."""
+        return self._event("done", {"done": True, **payload})
+
+    def error(self, message: str) -> str:
+        """The final frame of a failed response."""
+        return self._event("error", {"error": message})
+
+    def _event(self, name: str, payload: Dict) -> str:
+        body = json.dumps(payload)
+        if self.compact:
+            return f"event: {name}\ndata: {body}\n\n"
+        return f"data: {body}\n\n"
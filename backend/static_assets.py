@@ -0,0 +1,238 @@
+"""
+In-memory static assets for the frontend.
+
+At startup every file in frontend/ is read once, given a fingerprinted name
+(`app.3f2a1b9c04.js`) and compressed with gzip, and with brotli when the
+`brotli` package is installed. Pages refer to the fingerprinted names, which
+are served with a one-year immutable Cache-Control, so a browser fetches
+each version of an asset once. index.html and the plain names are served
+with `no-cache` and an ETag, so a revalidation is a bodyless 304.
+
+Serving is a dictionary lookup: no file is opened and nothing is compressed
+per request, so static traffic holds a worker thread only for the write.
+`python static_assets.py <dir>` writes the same files (plus .gz/.br
+siblings) for a reverse proxy to serve instead.
+"""
+import gzip
+import hashlib
+import mimetypes
+import re
+import sys
+import threading
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+from config import FRONTEND_DIR, STATIC_RELOAD, STATIC_COMPRESS_MIN_BYTES
+
+# Page that refers to the other assets; served under its own name only
+INDEX_PAGE = "index.html"
+
+# Assets whose text may refer to other assets, rewritten before hashing
+TEXT_TYPES = {"text/html", "text/css", "text/javascript", "application/javascript"}
+
+# Types worth compressing (images are already compressed)
+COMPRESSIBLE_TYPES = TEXT_TYPES | {"application/json", "image/svg+xml", "text/plain"}
+
+# Fingerprinted names never change content
+IMMUTABLE = "public, max-age=31536000, immutable"
+REVALIDATE = "no-cache"
+
+# Preferred order when the client accepts several encodings
+ENCODINGS = ("br", "gzip")
+
+
+class Asset:
+    """One file, with its body in each encoding it is worth serving in."""
+
+    def __init__(self, name: str, body: bytes, content_type: str, digest: str):
+        self.name = name
+        self.content_type = _charset(content_type)
+        self.digest = digest
+        self.bodies: Dict[str, bytes] = {"identity": body}
+        if content_type in COMPRESSIBLE_TYPES and len(body) >= STATIC_COMPRESS_MIN_BYTES:
+            self._compress(body)
+
+    def _compress(self, body: bytes) -> None:
+        candidates = {"gzip": gzip.compress(body, compresslevel=9, mtime=0)}
+        if brotli is not None:
+            candidates["br"] = brotli.compress(body, quality=11)
+        for encoding, compressed in candidates.items():
+            if len(compressed) < len(body):
+                self.bodies[encoding] = compressed
+
+    def etag(self, encoding: str) -> str:
+        """Strong ETag of one encoding's body."""
+        if encoding == "identity":
+            return f'"{self.digest}"'
+        return f'"{self.digest}-{encoding}"'
+
+    def choose_encoding(self, accept_encoding: str) -> str:
+        """The best encoding of this asset the client accepts."""
+        accepted = _accepted_encodings(accept_encoding)
+        for encoding in ENCODINGS:
+            if encoding in self.bodies and encoding in accepted:
+                return encoding
+        return "identity"
+
+
+def _accepted_encodings(header: str) -> set:
+    """Codings in an Accept-Encoding header, minus any refused with q=0."""
+    accepted = set()
+    for part in header.split(","):
+        coding, _, params = part.strip().partition(";")
+        coding = coding.strip().lower()
+        match = re.search(r"q\s*=\s*([0-9.]+)", params)
+        try:
+            if match and float(match.group(1)) == 0:
+                continue
+        except ValueError:
+            continue
+        if coding:
+            accepted.add(coding)
+    if "*" in accepted:
+        accepted.update(ENCODINGS)
+    return accepted
+
+
+def _fingerprinted(name: str, digest: str) -> str:
+    path = Path(name)
+    return str(path.with_name(f"{path.stem}.{digest[:10]}{path.suffix}"))
+
+
+def _content_type(name: str) -> str:
+    content_type = mimetypes.guess_type(name)[0] or "application/octet-stream"
+    # Older mimetypes tables still map .js to application/javascript
+    return "text/javascript" if name.endswith(".js") else content_type
+
+
+def _charset(content_type: str) -> str:
+    if content_type.startswith("text/") or content_type in COMPRESSIBLE_TYPES:
+        return f"{content_type}; charset=utf-8"
+    return content_type
+
+
+class StaticAssets:
+    """Fingerprinted, precompressed copies of a directory's files, kept in memory."""
+
+    def __init__(self, directory: Path = FRONTEND_DIR, reload: bool = STATIC_RELOAD):
+        self.directory = Path(directory)
+        self.reload = reload
+        self._lock = threading.Lock()
+        self._assets: Dict[str, Tuple[Asset, str]] = {}
+        self._mtimes: Dict[str, float] = {}
+        self._load()
+
+    def _files(self) -> List[Path]:
+        return sorted(path for path in self.directory.rglob("*")
+                      if path.is_file() and not path.name.startswith("."))
+
+    def _load(self) -> None:
+        files = self._files()
+        sources = {path.relative_to(self.directory).as_posix(): path.read_bytes()
+                   for path in files}
+        renamed: Dict[str, str] = {}
+        assets: Dict[str, Tuple[Asset, str]] = {}
+
+        # Binary assets first, then text that may refer to them, then the page
+        def order(name: str) -> Tuple[int, str]:
+            if name == INDEX_PAGE:
+                return 2, name
+            return (1 if _content_type(name) in TEXT_TYPES else 0), name
+
+        for name in sorted(sources, key=order):
+            body = sources[name]
+            content_type = _content_type(name)
+            if content_type in TEXT_TYPES and renamed:
+                body = self._rewrite(body, renamed)
+            digest = hashlib.sha256(body).hexdigest()[:20]
+            asset = Asset(name, body, content_type, digest)
+            assets[name] = (asset, REVALIDATE)
+            if name != INDEX_PAGE:
+                renamed[name] = _fingerprinted(name, digest)
+                assets[renamed[name]] = (asset, IMMUTABLE)
+
+        self._assets = assets
+        self._mtimes = {str(path): path.stat().st_mtime for path in files}
+        print(f"✓ Static assets ready: {len(sources)} files from {self.directory}"
+              + ("" if brotli else " (gzip only; install brotli for br)"))
+
+    @staticmethod
+    def _rewrite(body: bytes, renamed: Dict[str, str]) -> bytes:
+        """Point references to other assets at their fingerprinted names."""
+        text = body.decode("utf-8")
+        names = "|".join(re.escape(name) for name in sorted(renamed, key=len, reverse=True))
+        pattern = re.compile(rf"(?<=[\"'(/=\s])(?:\./)?({names})(?=[\"')?#\s])")
+        return pattern.sub(lambda match: renamed[match.group(1)], text).encode("utf-8")
+
+    def _changed(self) -> bool:
+        try:
+            files = self._files()
+            return {str(path): path.stat().st_mtime for path in files} != self._mtimes
+        except OSError:
+            return True
+
+    def get(self, path: str) -> Optional[Tuple[Asset, str]]:
+        """The asset at a request path and its Cache-Control, or None."""
+        if self.reload and path in ("", INDEX_PAGE):
+            # Development: pick up edits when the page is reloaded
+            with self._lock:
+                if self._changed():
+                    self._load()
+        return self._assets.get(path or INDEX_PAGE)
+
+    def respond(self, path: str, headers) -> Optional[Tuple[bytes, int, Dict[str, str]]]:
+        """
+        Body, status and headers for a GET of `path`, or None if there is no such asset.
+
+        Args:
+            path: Request path without the leading slash ("" for the page)
+            headers: The request's headers (Accept-Encoding, If-None-Match)
+        """
+        found = self.get(path)
+        if found is None:
+            return None
+        asset, cache_control = found
+        encoding = asset.choose_encoding(headers.get("Accept-Encoding", ""))
+        etag = asset.etag(encoding)
+        response_headers = {
+            "Cache-Control": cache_control,
+            "ETag": etag,
+        }
+        if len(asset.bodies) > 1:
+            response_headers["Vary"] = "Accept-Encoding"
+        if_none_match = headers.get("If-None-Match", "")
+        if if_none_match and (if_none_match.strip() == "*" or etag in [
+                tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]):
+            return b"", 304, response_headers
+        response_headers["Content-Type"] = asset.content_type
+        if encoding != "identity":
+            response_headers["Content-Encoding"] = encoding
+        return asset.bodies[encoding], 200, response_headers
+
+    def write(self, directory: Path) -> int:
+        """Write every asset (with .gz/.br siblings) for a reverse proxy; returns the file count."""
+        directory = Path(directory)
+        written = 0
+        for key, (asset, _) in self._assets.items():
+            target = directory / key
+            target.parent.mkdir(parents=True, exist_ok=True)
+            target.write_bytes(asset.bodies["identity"])
+            written += 1
+            for encoding, suffix in (("gzip", ".gz"), ("br", ".br")):
+                if encoding in asset.bodies:
+                    target.with_name(target.name + suffix).write_bytes(asset.bodies[encoding])
+                    written += 1
+        return written
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        print("Usage: python static_assets.py <output directory>")
+        sys.exit(1)
+    count = StaticAssets(reload=False).write(Path(sys.argv[1]))
+    print(f"✓ Wrote {count} files to {sys.argv[1]}")
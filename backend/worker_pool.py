@@ -0,0 +1,431 @@
+import atexit
+import multiprocessing
+import multiprocessing.connection
+import os
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from scheduler import GenerationRequest, SchedulerFullError
+
+# How often workers report their scheduler stats
+STATS_INTERVAL = 1.0
+
+# A conversation stays on the worker holding its KV state unless that worker
+# has this many more requests in flight than the least loaded one
+AFFINITY_SLACK = 2
+
+# Conversations whose worker is remembered for routing
+AFFINITY_ENTRIES = 10000
+
+# Longest pause before restarting a worker that keeps crashing
+MAX_RESTART_DELAY = 60.0
+
+
+def physical_cores() -> List[List[int]]:
+    """
+    Usable logical CPUs grouped by physical core.
+
+    Hyper-threads share a core's execution units, so llama.cpp gains little
+    from running more than one thread per core. Falls back to one group per
+    logical CPU where the topology isn't exposed.
+    """
+    if hasattr(os, "sched_getaffinity"):
+        cpus = sorted(os.sched_getaffinity(0))
+    else:
+        cpus = list(range(os.cpu_count() or 1))
+    cores: Dict[str, List[int]] = {}
+    for cpu in cpus:
+        siblings = Path(f"/sys/devices/system/cpu/cpu{cpu}/topology/thread_siblings_list")
+        try:
+            key = siblings.read_text().strip()
+        except OSError:
+            key = str(cpu)
+        cores.setdefault(key, []).append(cpu)
+    return list(cores.values())
+
+
+def plan_workers(n_workers: int, threads: int, pin: bool) -> List[Dict]:
+    """Thread count and CPU set for each worker, splitting physical cores evenly."""
+    cores = physical_cores()
+    if threads <= 0:
+        threads = max(1, len(cores) // n_workers)
+    plans = []
+    for i in range(n_workers):
+        assigned = cores[i * threads:(i + 1) * threads]
+        cpus = sorted(cpu for core in assigned for cpu in core)
+        plans.append({
+            "threads": threads,
+            # More workers than cores: leave the rest unpinned rather than overlap
+            "cpus": cpus if pin and len(assigned) == threads else None,
+        })
+    return plans
+
+
+class RemoteRequest(GenerationRequest):
+    """Parent-side handle for a generation running in a worker process."""
+
+    def __init__(self, pool: "WorkerPool", worker: int, cache_key: Optional[str]):
+        super().__init__([], 0, 0.0, [], cache_key=cache_key)
+        self._pool = pool
+        self.worker = worker
+
+    def cancel(self) -> None:
+        if not self.cancelled and self.finish_reason is None:
+            self._pool._send(self.worker, ("cancel", self.id))
+        super().cancel()
+
+
+def _worker_main(index: int, plan: Dict, commands, results) -> None:
+    """Entry point of a model worker process."""
+    if plan["cpus"] and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, plan["cpus"])
+
+    # The pipe is this worker's alone; the lock only orders its own threads
+    send_lock = threading.Lock()
+
+    def emit(*event) -> None:
+        with send_lock:
+            results.send(event)
+
+    # Imported here so only workers load the model
+    from llm_handler import load_scheduler
+    _, scheduler = load_scheduler(Path(plan["model_path"]), n_threads=plan["threads"])
+    running: Dict[str, GenerationRequest] = {}
+    lock = threading.Lock()
+    supervisor = os.getppid()
+
+    def relay(request_id: str, request: GenerationRequest) -> None:
+        try:
+            for chunk in request.stream():
+                emit("chunk", index, request_id, chunk)
+            emit("done", index, request_id, request.finish_reason, request.timings())
+        except Exception as e:
+            emit("error", index, request_id, type(e).__name__, str(e))
+        finally:
+            with lock:
+                running.pop(request_id, None)
+
+    def report_stats() -> None:
+        while True:
+            if os.getppid() != supervisor:
+                os._exit(0)  # Orphaned: the server is gone
+            emit("stats", index, scheduler.stats())
+            time.sleep(STATS_INTERVAL)
+
+    threading.Thread(target=report_stats, daemon=True).start()
+    emit("ready", index, os.getpid())
+
+    while True:
+        command = commands.recv()
+        if command is None:
+            break
+        kind = command[0]
+        if kind == "submit":
+            _, request_id, prompt, max_tokens, temperature, stop, cache_key = command
+            try:
+                request = scheduler.submit(prompt, max_tokens, temperature, stop, cache_key)
+            except Exception as e:
+                emit("error", index, request_id, type(e).__name__, str(e))
+                continue
+            with lock:
+                running[request_id] = request
+            threading.Thread(target=relay, args=(request_id, request), daemon=True).start()
+        elif kind == "cancel":
+            with lock:
+                request = running.get(command[1])
+            if request is not None:
+                request.cancel()
+        elif kind == "forget":
+            scheduler.forget(command[1])
+
+    scheduler.close()
+
+
+def _supervise(plans: List[Dict], commands, events, go, stopping) -> None:
+    """
+    Start the workers once `go` is set, restart any that die, and forward
+    their events to the server.
+
+    Runs in its own single-threaded process so workers are always forked
+    from a process without threads, including restarts after the server
+    has started its own threads. Each worker start gets a fresh result
+    pipe that only it writes to: a worker killed mid-send (by the OOM
+    killer, say) then leaves nothing behind that could block the others
+    or its replacement, as a shared queue's write lock would.
+    """
+    ctx = multiprocessing.get_context("fork")
+    processes = [None] * len(plans)
+    results = [None] * len(plans)
+    started_at = [0.0] * len(plans)
+    failures = [0] * len(plans)
+
+    def start(index: int) -> None:
+        reader, writer = ctx.Pipe(duplex=False)
+        processes[index] = ctx.Process(
+            target=_worker_main,
+            args=(index, plans[index], commands[index], writer),
+            name=f"model-worker-{index}",
+            daemon=True
+        )
+        processes[index].start()
+        # Only the worker holds the write end now, so its exit reads as EOF
+        writer.close()
+        results[index] = reader
+        started_at[index] = time.monotonic()
+
+    def forward(index: int) -> bool:
+        """Pass one event from a worker to the server; False once its pipe is done."""
+        try:
+            events.send_bytes(results[index].recv_bytes())
+            return True
+        except (EOFError, OSError):
+            # Exited, possibly mid-message; its requests are failed on "exited"
+            results[index].close()
+            results[index] = None
+            return False
+
+    server = os.getppid()
+    while not go.wait(1.0):
+        if os.getppid() != server or stopping.is_set():
+            return
+
+    for index in range(len(plans)):
+        start(index)
+
+    while any(p.is_alive() for p in processes):
+        pipes = {conn: i for i, conn in enumerate(results) if conn is not None}
+        ready = multiprocessing.connection.wait(
+            list(pipes) + [p.sentinel for p in processes if p.is_alive()], timeout=1.0
+        )
+        for conn in ready:
+            if conn in pipes:
+                forward(pipes[conn])
+        if os.getppid() != server:
+            return  # Server killed; daemonic workers are terminated on exit
+        for index, process in enumerate(processes):
+            if process.is_alive() or stopping.is_set():
+                continue
+            # Deliver what it sent before dying, then report the exit
+            while results[index] is not None and forward(index):
+                pass
+            events.send(("exited", index, process.exitcode))
+            # Requests queued for the dead worker have already been failed
+            while commands[index].poll():
+                commands[index].recv()
+            if time.monotonic() - started_at[index] > MAX_RESTART_DELAY:
+                failures[index] = 0
+            time.sleep(min(2 ** failures[index], MAX_RESTART_DELAY))
+            failures[index] += 1
+            start(index)
+
+
+class WorkerPool:
+    """
+    Runs the model in several worker processes behind a least-loaded router.
+
+    Each worker loads the GGUF file with its own inference scheduler, thread
+    count and CPU affinity; the weights are mmap'd, so the page cache holds a
+    single copy for all of them. Requests go to the worker with the fewest
+    in flight, except that a conversation sticks to the worker that holds its
+    KV state while that worker isn't much busier than the others.
+
+    Exposes the same submit/stats/forget/close interface as
+    InferenceScheduler, so LLMHandler can use either. Create it before the
+    server starts any threads: the worker supervisor is forked from here.
+    The workers themselves load the model only once start() is called, so
+    that can wait until the model file has been downloaded.
+    """
+
+    def __init__(self, n_workers: int, threads: int, pin_cpus: bool,
+                 max_slots: int, max_queue: int, model_path: Path):
+        self.capacity = max_slots + max_queue
+        self._plans = plan_workers(n_workers, threads, pin_cpus)
+        for plan in self._plans:
+            plan["model_path"] = str(model_path)
+        ctx = multiprocessing.get_context("fork")
+        # Worker events, relayed by the supervisor
+        self._events, events_writer = ctx.Pipe(duplex=False)
+        self._closed = threading.Event()
+        # One reader per pipe, so a worker killed while waiting for a
+        # command doesn't leave a lock held for its replacement
+        pipes = [ctx.Pipe(duplex=False) for _ in range(n_workers)]
+        self._commands = [writer for _, writer in pipes]
+        self._send_locks = [threading.Lock() for _ in range(n_workers)]
+        self._go = ctx.Event()
+        self._stopping = ctx.Event()
+        self._lock = threading.Lock()
+        self._requests: Dict[str, RemoteRequest] = {}
+        self._in_flight = [0] * n_workers
+        self._affinity: "OrderedDict[str, int]" = OrderedDict()
+        self._stats: List[Dict] = [{} for _ in range(n_workers)]
+        self._pids: List[Optional[int]] = [None] * n_workers
+        self._startup = threading.Condition(self._lock)
+        self._started = False
+        self._failed = False
+
+        self._supervisor = ctx.Process(
+            target=_supervise,
+            args=(self._plans, [reader for reader, _ in pipes], events_writer,
+                  self._go, self._stopping),
+            name="model-supervisor"
+        )
+        self._supervisor.start()
+        events_writer.close()
+        self._dispatcher = threading.Thread(
+            target=self._dispatch, name="worker-pool", daemon=True
+        )
+        self._dispatcher.start()
+        atexit.register(self.close)
+
+    def start(self) -> None:
+        """Start the workers and wait until they have all loaded the model."""
+        self._go.set()
+        with self._startup:
+            self._startup.wait_for(lambda: self._failed or all(self._pids))
+            failed = self._failed
+            self._started = True
+        if failed:
+            self.close()
+            raise RuntimeError("A model worker failed to start")
+
+    def submit(self, prompt: str, max_tokens: int, temperature: float,
+               stop: List[str], cache_key: Optional[str] = None) -> GenerationRequest:
+        """Route a prompt to a worker, or raise SchedulerFullError."""
+        with self._lock:
+            worker = self._route(cache_key)
+            if self._in_flight[worker] >= self.capacity:
+                raise SchedulerFullError("Server is busy, please retry shortly")
+            request = RemoteRequest(self, worker, cache_key)
+            self._requests[request.id] = request
+            self._in_flight[worker] += 1
+            if cache_key:
+                self._affinity[cache_key] = worker
+                self._affinity.move_to_end(cache_key)
+                if len(self._affinity) > AFFINITY_ENTRIES:
+                    self._affinity.popitem(last=False)
+        self._send(worker, ("submit", request.id, prompt, max_tokens, temperature, stop, cache_key))
+        return request
+
+    def stats(self) -> Dict:
+        """Per-worker scheduler stats plus pool-wide totals."""
+        with self._lock:
+            workers = [
+                {
+                    "pid": self._pids[i],
+                    "threads": plan["threads"],
+                    "cpus": plan["cpus"],
+                    "in_flight": self._in_flight[i],
+                    **self._stats[i],
+                }
+                for i, plan in enumerate(self._plans)
+            ]
+        totals = {}
+        for key in ("queue_depth", "active_slots", "max_slots", "tokens_per_second",
+                    "submitted", "rejected", "cancelled", "completed", "failed",
+                    "generated_tokens", "prefix_reused_tokens",
+                    "drafted_tokens", "accepted_draft_tokens"):
+            totals[key] = round(sum(w.get(key, 0) for w in workers), 2)
+        return {**totals, "workers": workers}
+
+    def forget(self, cache_key: str) -> None:
+        """Drop cached KV state for a conversation."""
+        with self._lock:
+            worker = self._affinity.pop(cache_key, None)
+        if worker is not None:
+            self._send(worker, ("forget", cache_key))
+
+    def close(self) -> None:
+        """Stop all workers."""
+        if self._stopping.is_set():
+            return
+        self._stopping.set()
+        for worker in range(len(self._commands)):
+            self._send(worker, None)
+        self._supervisor.join(timeout=10)
+        if self._supervisor.is_alive():
+            self._supervisor.terminate()
+        self._closed.set()
+        self._dispatcher.join()
+
+    # ------------------------------------------------------------------ #
+    # Internals
+    # ------------------------------------------------------------------ #
+
+    def _route(self, cache_key: Optional[str]) -> int:
+        """Pick a worker (caller holds the lock)."""
+        # Skip workers that are restarting, unless none are up
+        candidates = [i for i, pid in enumerate(self._pids) if pid] or range(len(self._pids))
+        least = min(candidates, key=self._in_flight.__getitem__)
+        preferred = self._affinity.get(cache_key) if cache_key else None
+        if preferred is not None and self._pids[preferred] and \
+                self._in_flight[preferred] < self.capacity and \
+                self._in_flight[preferred] <= self._in_flight[least] + AFFINITY_SLACK:
+            return preferred
+        return least
+
+    def _send(self, worker: int, command) -> None:
+        with self._send_locks[worker]:
+            self._commands[worker].send(command)
+
+    def _dispatch(self) -> None:
+        """Deliver worker events to their requests."""
+        while True:
+            try:
+                if not self._events.poll(0.5):
+                    if self._closed.is_set():
+                        return
+                    continue
+                event = self._events.recv()
+            except (EOFError, OSError):
+                return  # Supervisor gone
+            kind, worker = event[0], event[1]
+            if kind == "chunk":
+                request = self._requests.get(event[2])
+                if request is not None:
+                    request._put(event[3])
+            elif kind == "done":
+                self._finish(event[2], event[3], timings=event[4])
+            elif kind == "error":
+                error_type = SchedulerFullError if event[3] == "SchedulerFullError" else RuntimeError
+                self._finish(event[2], "error", error_type(event[4]))
+            elif kind == "stats":
+                with self._lock:
+                    self._stats[worker] = event[2]
+            elif kind == "ready":
+                with self._startup:
+                    self._pids[worker] = event[2]
+                    self._startup.notify_all()
+                print(f"✓ Model worker {worker} ready (pid {event[2]})")
+            elif kind == "exited":
+                self._worker_exited(worker, event[2])
+
+    def _finish(self, request_id: str, reason: str, error: Optional[Exception] = None,
+                timings: Optional[Dict] = None) -> None:
+        with self._lock:
+            request = self._requests.pop(request_id, None)
+            if request is None:
+                return
+            self._in_flight[request.worker] -= 1
+        # Monotonic timestamps are system-wide, so the worker's are comparable
+        for field, value in (timings or {}).items():
+            setattr(request, field, value)
+        request.finish_reason = reason
+        request._put(error if error is not None else GenerationRequest._DONE)
+
+    def _worker_exited(self, worker: int, exitcode: int) -> None:
+        with self._startup:
+            if not self._started:
+                self._failed = True
+                self._startup.notify_all()
+                return
+            self._pids[worker] = None
+            lost = [r.id for r in self._requests.values() if r.worker == worker]
+            for key in [k for k, w in self._affinity.items() if w == worker]:
+                del self._affinity[key]
+            self._stats[worker] = {}
+        print(f"✗ Model worker {worker} exited (code {exitcode}); restarting")
+        for request_id in lost:
+            self._finish(request_id, "error", RuntimeError("Model worker crashed"))
@@ -0,0 +1,438 @@
+"""
+Load test for the chat server.
+
+By default the server runs in this process on a fake model and an
+in-memory SQLite database (see fakes.py), so results measure the request,
+prompt-building and persistence paths rather than model speed, and the
+benchmark runs offline. With --url it drives an already running server.
+
+    python benchmarks/bench.py --profile chat --concurrency 16
+    python benchmarks/bench.py --server asgi --endpoint chat --turns 2
+    python benchmarks/bench.py --url http://localhost:5000 --profile short
+"""
+import argparse
+import asyncio
+import http.client
+import json
+import logging
+import os
+import queue
+import socket
+import sys
+import threading
+import time
+from functools import partial
+from pathlib import Path
+from typing import Dict, List, Optional
+from urllib.parse import urlparse
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent / "backend"
+sys.path.insert(0, str(BACKEND_DIR))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+# Conversation-length profiles: turns sent per conversation, and messages
+# already stored in each conversation before the run
+PROFILES = {
+    "short": {"turns": 1, "history": 0},
+    "chat": {"turns": 8, "history": 0},
+    "long": {"turns": 4, "history": 200},
+}
+
+FILLER = "please explain how this part of the system works in a few sentences".split()
+
+
+def percentile(values: List[float], pct: float) -> Optional[float]:
+    """Linearly interpolated percentile of `values`, or None if empty."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = (len(ordered) - 1) * pct / 100
+    low = int(rank)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (rank - low)
+
+
+def summarize(values: List[float]) -> Dict[str, Optional[float]]:
+    """p50/p95/p99 and mean of latencies, in milliseconds."""
+    return {
+        "p50": _ms(percentile(values, 50)),
+        "p95": _ms(percentile(values, 95)),
+        "p99": _ms(percentile(values, 99)),
+        "mean": _ms(sum(values) / len(values)) if values else None,
+    }
+
+
+def _ms(seconds: Optional[float]) -> Optional[float]:
+    return round(seconds * 1000, 2) if seconds is not None else None
+
+
+def user_message(conversation: int, turn: int, words: int) -> str:
+    """A distinct message per turn, so no two prompts are the same."""
+    body = " ".join(FILLER[i % len(FILLER)] for i in range(words))
+    return f"Question {turn} in conversation {conversation}: {body}"
+
+
+class Client:
+    """Minimal HTTP client; one per virtual user."""
+
+    def __init__(self, base_url: str, timeout: float):
+        url = urlparse(base_url)
+        self.host = url.hostname
+        self.port = url.port or 80
+        self.timeout = timeout
+        self.conn = None
+
+    def _request(self, method: str, path: str, body: Optional[Dict] = None):
+        payload = json.dumps(body).encode() if body is not None else None
+        for attempt in range(2):
+            if self.conn is None:
+                self.conn = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+            try:
+                self.conn.request(method, path, body=payload,
+                                  headers={"Content-Type": "application/json"})
+                return self.conn.getresponse()
+            except (ConnectionError, http.client.HTTPException):
+                # Keep-alive connection closed by the server; reconnect once
+                self.conn.close()
+                self.conn = None
+                if attempt:
+                    raise
+
+    def json(self, method: str, path: str, body: Optional[Dict] = None):
+        response = self._request(method, path, body)
+        data = response.read()
+        return response.status, json.loads(data) if data else None
+
+    def chat(self, message: str, conversation_id: str) -> Dict:
+        started = time.perf_counter()
+        status, data = self.json("POST", "/chat",
+                                 {"message": message, "conversation_id": conversation_id})
+        result = {"status": status, "e2e": time.perf_counter() - started,
+                  "ttft": None, "gaps": [], "tokens": 0}
+        if status == 200:
+            result["tokens"] = len(data["response"].split())
+        return result
+
+    def stream(self, message: str, conversation_id: str, compact: bool = False) -> Dict:
+        started = time.perf_counter()
+        response = self._request("POST", "/stream", {"message": message,
+                                                     "conversation_id": conversation_id,
+                                                     "compact": compact})
+        result = {"status": response.status, "e2e": None, "ttft": None, "gaps": [], "tokens": 0}
+        if response.status != 200:
+            response.read()
+            result["e2e"] = time.perf_counter() - started
+            return result
+
+        last = None
+        name = None
+        data = []
+        while True:
+            line = response.readline()
+            if not line:
+                break
+            line = line.decode("utf-8").rstrip("\r\n")
+            if line.startswith("data:"):
+                data.append(line[6:] if line.startswith("data: ") else line[5:])
+                continue
+            if line.startswith("event:"):
+                name = line[6:].strip()
+                continue
+            if line or not data:
+                continue
+            # Blank line: end of one event (a frame of one or more tokens)
+            if name is None and compact:
+                event = {"token": "\n".join(data)}
+            else:
+                event = json.loads("\n".join(data))
+            name = None
+            data = []
+            if "token" in event:
+                now = time.perf_counter()
+                if last is None:
+                    result["ttft"] = now - started
+                else:
+                    result["gaps"].append(now - last)
+                last = now
+                result["tokens"] += len(event["token"].split())
+            elif "error" in event:
+                result["status"] = "error"
+            elif event.get("done"):
+                break
+        response.read()
+        result["e2e"] = time.perf_counter() - started
+        return result
+
+
+def run_load(base_url: str, args, conversation_ids: List[str]) -> Dict:
+    """Send every conversation's turns, `args.concurrency` conversations at a time."""
+    work = queue.Queue()
+    for index, cid in enumerate(conversation_ids):
+        work.put((index, cid))
+    results = []
+    results_lock = threading.Lock()
+
+    def virtual_user():
+        client = Client(base_url, args.timeout)
+        while True:
+            try:
+                index, cid = work.get_nowait()
+            except queue.Empty:
+                return
+            for turn in range(args.turns):
+                message = user_message(index, turn, args.message_words)
+                send = (partial(client.stream, compact=args.compact)
+                        if args.endpoint == "stream" else client.chat)
+                try:
+                    result = send(message, cid)
+                except (OSError, http.client.HTTPException, ValueError) as e:
+                    result = {"status": f"{type(e).__name__}", "e2e": None,
+                              "ttft": None, "gaps": [], "tokens": 0}
+                result["conversation_id"] = cid
+                result["turn"] = turn
+                with results_lock:
+                    results.append(result)
+
+    started = time.perf_counter()
+    users = [threading.Thread(target=virtual_user, daemon=True)
+             for _ in range(min(args.concurrency, len(conversation_ids)))]
+    for user in users:
+        user.start()
+    for user in users:
+        user.join()
+    return {"results": results, "elapsed": time.perf_counter() - started}
+
+
+def report(run: Dict, args, llm=None, writer=None) -> Dict:
+    """Aggregate per-request results into latency and throughput figures."""
+    results = run["results"]
+    ok = [r for r in results if r["status"] == 200]
+    tokens = sum(r["tokens"] for r in ok)
+    elapsed = run["elapsed"]
+    errors: Dict[str, int] = {}
+    for r in results:
+        if r["status"] != 200:
+            errors[str(r["status"])] = errors.get(str(r["status"]), 0) + 1
+
+    per_stream = [r["tokens"] / sum(r["gaps"]) for r in ok if r["gaps"] and sum(r["gaps"]) > 0]
+    summary = {
+        "endpoint": args.endpoint,
+        "requests": len(results),
+        "ok": len(ok),
+        "errors": errors,
+        "elapsed_s": round(elapsed, 3),
+        "requests_per_s": round(len(ok) / elapsed, 2) if elapsed else None,
+        "tokens_per_s": round(tokens / elapsed, 2) if elapsed else None,
+        "stream_tokens_per_s": round(sum(per_stream) / len(per_stream), 2) if per_stream else None,
+        "e2e_ms": summarize([r["e2e"] for r in ok]),
+        "ttft_ms": summarize([r["ttft"] for r in ok if r["ttft"] is not None]),
+        "frame_gap_ms": summarize([gap for r in ok for gap in r["gaps"]]),
+    }
+
+    if llm is not None:
+        # Time the server spent outside the (fake) model: routing, history
+        # loads, prompt building and persistence
+        overhead = []
+        for r in ok:
+            timings = llm.timings.get(r["conversation_id"], [])
+            if r["turn"] < len(timings):
+                overhead.append(max(r["e2e"] - timings[r["turn"]], 0.0))
+        summary["server_overhead_ms"] = summarize(overhead)
+    if writer is not None:
+        started = time.perf_counter()
+        flushed = writer.flush(timeout=args.timeout)
+        summary["write_drain_ms"] = _ms(time.perf_counter() - started) if flushed else None
+    return summary
+
+
+def print_report(summary: Dict) -> None:
+    print(f"\n{'='*60}")
+    print(f"📊 {summary['endpoint']}: {summary['ok']}/{summary['requests']} requests "
+          f"in {summary['elapsed_s']}s")
+    print(f"{'='*60}")
+    if summary["errors"]:
+        print(f"✗ Errors: {summary['errors']}")
+    print(f"Requests/sec:        {summary['requests_per_s']}")
+    print(f"Tokens/sec (total):  {summary['tokens_per_s']}")
+    if summary["stream_tokens_per_s"] is not None:
+        print(f"Tokens/sec (stream): {summary['stream_tokens_per_s']}")
+    print(f"\n{'latency (ms)':<22}{'p50':>10}{'p95':>10}{'p99':>10}{'mean':>10}")
+    for key, label in (("e2e_ms", "end-to-end"), ("ttft_ms", "time to first token"),
+                       ("frame_gap_ms", "between frames"),
+                       ("server_overhead_ms", "server overhead")):
+        stats = summary.get(key)
+        if stats and stats["p50"] is not None:
+            print(f"{label:<22}" + "".join(f"{stats[p]:>10.2f}" for p in ("p50", "p95", "p99", "mean")))
+    if "write_drain_ms" in summary:
+        print(f"\nWrite-behind drain:  {summary['write_drain_ms']} ms")
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_server(args):
+    """Start app.py or asgi_app.py on the fakes in a background thread."""
+    import fakes
+    from config import MAX_BATCH_SLOTS, MAX_QUEUE_DEPTH
+
+    fakes.install(
+        db_path=args.db,
+        token_rate=args.token_rate,
+        reply_tokens=args.reply_tokens,
+        prefill_rate=args.prefill_rate,
+        max_slots=MAX_BATCH_SLOTS,
+        max_queue=MAX_QUEUE_DEPTH
+    )
+    port = _free_port()
+
+    if args.server == "asgi":
+        from hypercorn.asyncio import serve
+        from hypercorn.config import Config
+        import asgi_app as module
+
+        config = Config()
+        config.bind = [f"127.0.0.1:{port}"]
+        loop = asyncio.new_event_loop()
+        stop = asyncio.Event()
+
+        def run():
+            asyncio.set_event_loop(loop)
+            loop.run_until_complete(serve(module.app, config, shutdown_trigger=stop.wait))
+
+        def shutdown():
+            loop.call_soon_threadsafe(stop.set)
+            thread.join(5)
+    else:
+        from werkzeug.serving import make_server
+        import app as module
+
+        logging.getLogger("werkzeug").setLevel(logging.ERROR)
+        server = make_server("127.0.0.1", port, module.app, threaded=True)
+        run = server.serve_forever
+
+        def shutdown():
+            server.shutdown()
+            thread.join(5)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    _wait_until_up(port)
+    return module, f"http://127.0.0.1:{port}", shutdown
+
+
+def _wait_until_up(port: int, timeout: float = 10.0) -> None:
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=1):
+                return
+        except OSError:
+            if time.monotonic() >= deadline:
+                raise RuntimeError(f"Benchmark server did not start on port {port}")
+            time.sleep(0.05)
+
+
+def prepare_conversations(base_url: str, args, module=None) -> List[str]:
+    """Create the conversations and store `args.history` messages in each."""
+    client = Client(base_url, args.timeout)
+    ids = []
+    for index in range(args.conversations):
+        status, data = client.json("POST", "/conversations")
+        if status != 200:
+            raise RuntimeError(f"Could not create conversation: HTTP {status}")
+        ids.append(data["id"])
+        if args.history and module is not None:
+            turns = []
+            for turn in range(args.history // 2):
+                turns.append(("user", user_message(index, -turn - 1, args.message_words)))
+                turns.append(("assistant", " ".join(FILLER[:args.message_words])))
+            module.conversation.add_messages(data["id"], turns)
+    if args.history and module is not None:
+        conversation = module.conversation
+        if conversation.writer:
+            conversation.writer.flush(timeout=args.timeout)
+        # Start from a cold history cache, as after a restart
+        for cid in ids:
+            conversation.cache.invalidate(cid)
+    return ids
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--url", help="Benchmark a running server instead of the fakes")
+    parser.add_argument("--server", choices=("flask", "asgi"), default="flask",
+                        help="In-process server to benchmark (default: flask)")
+    parser.add_argument("--endpoint", choices=("stream", "chat"), default="stream")
+    parser.add_argument("--compact", action="store_true", help="Ask /stream for compact frames")
+    parser.add_argument("--profile", choices=sorted(PROFILES), default="chat",
+                        help="Conversation length: turns per conversation and stored history")
+    parser.add_argument("--turns", type=int, help="Override the profile's turns per conversation")
+    parser.add_argument("--history", type=int,
+                        help="Override the profile's stored messages per conversation")
+    parser.add_argument("--concurrency", type=int, default=8, help="Concurrent clients")
+    parser.add_argument("--conversations", type=int, default=32)
+    parser.add_argument("--message-words", type=int, default=24)
+    parser.add_argument("--token-rate", type=float, default=200.0,
+                        help="Fake model decode speed, tokens/sec per request")
+    parser.add_argument("--prefill-rate", type=float, default=0.0,
+                        help="Fake prompt evaluation speed, tokens/sec (0 = instant)")
+    parser.add_argument("--reply-tokens", type=int, default=64, help="Fake answer length")
+    parser.add_argument("--db", default=":memory:", help="SQLite file for the fake database")
+    parser.add_argument("--timeout", type=float, default=120.0)
+    parser.add_argument("--json", action="store_true", help="Print the report as JSON")
+    args = parser.parse_args(argv)
+    profile = PROFILES[args.profile]
+    if args.turns is None:
+        args.turns = profile["turns"]
+    if args.history is None:
+        args.history = profile["history"]
+    if args.url and args.history:
+        parser.error("--history needs the in-process server; use --profile short or chat with --url")
+    return args
+
+
+def main(argv=None) -> None:
+    args = parse_args(argv)
+    module, shutdown = None, None
+    base_url = args.url
+    if not base_url:
+        # Keep the server's startup output out of the report
+        with open(os.devnull, "w") as devnull:
+            stdout, sys.stdout = sys.stdout, devnull
+            try:
+                module, base_url, shutdown = start_server(args)
+            finally:
+                sys.stdout = stdout
+
+    try:
+        conversation_ids = prepare_conversations(base_url, args, module)
+        run = run_load(base_url, args, conversation_ids)
+        summary = report(
+            run, args,
+            llm=module.llm if module else None,
+            writer=module.conversation.writer if module else None
+        )
+    finally:
+        if shutdown:
+            shutdown()
+
+    summary["config"] = {
+        "server": args.url or args.server,
+        "profile": args.profile,
+        "turns": args.turns,
+        "history": args.history,
+        "concurrency": args.concurrency,
+        "conversations": args.conversations,
+        "token_rate": None if args.url else args.token_rate,
+    }
+    if args.json:
+        print(json.dumps(summary, indent=2))
+    else:
+        print_report(summary)
+
+
+if __name__ == '__main__':
+    main()
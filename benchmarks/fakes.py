@@ -0,0 +1,281 @@
+"""
+Offline stand-ins for the model and MySQL, used by the benchmarks.
+
+FakeLLMHandler has LLMHandler's interface but produces deterministic text
+at a fixed token rate, so measurements reflect the server's own request,
+prompt-building and persistence paths. SQLiteDatabaseManager runs the same
+queries as DatabaseManager against SQLite (in memory by default).
+"""
+import asyncio
+import re
+import sqlite3
+import sys
+import threading
+import time
+import types
+import zlib
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime
+from functools import partial
+from typing import AsyncIterator, Dict, Iterator, List, Optional
+
+import metrics
+from scheduler import SchedulerFullError
+
+WORDS = (
+    "the model answers each question with a short and steady stream of "
+    "plain words so that every run of the benchmark sees the same text"
+).split()
+
+sqlite3.register_adapter(datetime, lambda value: value.isoformat(" "))
+sqlite3.register_converter("TIMESTAMP", lambda value: datetime.fromisoformat(value.decode()))
+
+
+class FakeLLMHandler:
+    """Deterministic model: `reply_tokens` words per answer at `token_rate` tokens/sec."""
+
+    def __init__(self, token_rate: float = 100.0, reply_tokens: int = 64,
+                 prefill_rate: float = 0.0, max_slots: int = 4, max_queue: int = 64,
+                 background: bool = False):
+        self.token_rate = token_rate
+        self.reply_tokens = reply_tokens
+        self.prefill_rate = prefill_rate
+        self.max_slots = max_slots
+        self.max_queue = max_queue
+        self.response_cache = None
+        self._slots = threading.BoundedSemaphore(max_slots)
+        self._lock = threading.Lock()
+        self._admitted = 0
+        self.generated_tokens = 0
+        self.rejected = 0
+        # Seconds from submit to last token, per conversation in request order
+        self.timings: Dict[str, List[float]] = defaultdict(list)
+
+    def _admit(self) -> None:
+        with self._lock:
+            if self._admitted >= self.max_slots + self.max_queue:
+                self.rejected += 1
+                raise SchedulerFullError("Server busy, try again shortly")
+            self._admitted += 1
+
+    def _release(self, conversation_id: Optional[str], started: float, tokens: int) -> None:
+        with self._lock:
+            self._admitted -= 1
+            self.generated_tokens += tokens
+            if conversation_id is not None:
+                self.timings[conversation_id].append(time.perf_counter() - started)
+
+    def _reply(self, prompt: str) -> List[str]:
+        seed = zlib.crc32(prompt.encode("utf-8"))
+        return [f" {WORDS[(seed + i * 7) % len(WORDS)]}" for i in range(self.reply_tokens)]
+
+    def _prefill_delay(self, prompt: str) -> float:
+        return self.count_tokens(prompt) / self.prefill_rate if self.prefill_rate > 0 else 0.0
+
+    def _tokens(self, prompt: str, conversation_id: Optional[str],
+                started: float) -> Iterator[str]:
+        sent = 0
+        self._slots.acquire()
+        try:
+            time.sleep(self._prefill_delay(prompt))
+            for token in self._reply(prompt):
+                if sent:
+                    time.sleep(1 / self.token_rate)
+                sent += 1
+                yield token
+        finally:
+            self._slots.release()
+            self._release(conversation_id, started, sent)
+
+    async def _atokens(self, prompt: str, conversation_id: Optional[str],
+                       started: float) -> AsyncIterator[str]:
+        sent = 0
+        await asyncio.to_thread(self._slots.acquire)
+        try:
+            await asyncio.sleep(self._prefill_delay(prompt))
+            for token in self._reply(prompt):
+                if sent:
+                    await asyncio.sleep(1 / self.token_rate)
+                sent += 1
+                yield token
+        finally:
+            self._slots.release()
+            self._release(conversation_id, started, sent)
+
+    def generate(self, prompt: str, stream: bool = False,
+                 conversation_id: Optional[str] = None,
+                 model: Optional[str] = None,
+                 use_cache: bool = True) -> str | Iterator[str]:
+        self._admit()
+        tokens = self._tokens(prompt, conversation_id, time.perf_counter())
+        return tokens if stream else "".join(tokens).strip()
+
+    async def stream_async(self, prompt: str, conversation_id: Optional[str] = None,
+                           model: Optional[str] = None) -> AsyncIterator[str]:
+        self._admit()
+        return self._atokens(prompt, conversation_id, time.perf_counter())
+
+    def count_tokens(self, text: str) -> int:
+        return len(re.findall(r"\w+|[^\w\s]", text))
+
+    def summarize(self, summary: str, transcript: str) -> str:
+        return f"{summary} {transcript[:200]}".strip()
+
+    def is_loaded(self) -> bool:
+        return True
+
+    def status(self) -> Dict:
+        return {"state": "ready", "progress": 1.0, "error": None}
+
+    def model_names(self) -> List[str]:
+        return ["default"]
+
+    def forget_conversation(self, conversation_id: str) -> None:
+        with self._lock:
+            self.timings.pop(conversation_id, None)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "queue_depth": max(self._admitted - self.max_slots, 0),
+                "active_slots": min(self._admitted, self.max_slots),
+                "max_slots": self.max_slots,
+                "generated_tokens": self.generated_tokens,
+                "rejected": self.rejected,
+            }
+
+
+class _Cursor:
+    """DB-API cursor translating DatabaseManager's MySQL dialect to SQLite."""
+
+    def __init__(self, cursor: sqlite3.Cursor):
+        self._cursor = cursor
+
+    @staticmethod
+    def _translate(query: str) -> str:
+        query = query.replace("%s", "?").replace(" FOR UPDATE", "")
+        return query.replace("INSERT IGNORE", "INSERT OR IGNORE")
+
+    def execute(self, query, params=()):
+        self._cursor.execute(self._translate(query), params or ())
+
+    def executemany(self, query, rows):
+        self._cursor.executemany(self._translate(query), rows)
+
+    def fetchone(self):
+        return self._cursor.fetchone()
+
+    def fetchall(self):
+        return self._cursor.fetchall()
+
+    @property
+    def lastrowid(self):
+        return self._cursor.lastrowid
+
+
+def _dict_row(cursor, row) -> Dict:
+    return {column[0]: value for column, value in zip(cursor.description, row)}
+
+
+class SQLiteDatabaseManager:
+    """DatabaseManager over one SQLite connection, serialized by a lock."""
+
+    def __init__(self, path: str = ":memory:"):
+        self._conn = sqlite3.connect(
+            path, check_same_thread=False, isolation_level=None,
+            detect_types=sqlite3.PARSE_DECLTYPES
+        )
+        self._conn.row_factory = _dict_row
+        self._conn.execute("PRAGMA foreign_keys = ON")
+        self._lock = threading.RLock()
+        self._create_tables()
+
+    def _create_tables(self):
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS conversations (
+                id TEXT PRIMARY KEY,
+                title TEXT,
+                preview TEXT NULL,
+                history TEXT,
+                message_count INTEGER NOT NULL DEFAULT 0,
+                summary TEXT NULL,
+                summary_count INTEGER NOT NULL DEFAULT 0,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            );
+            CREATE INDEX IF NOT EXISTS idx_conversations_updated
+                ON conversations (updated_at, id);
+            CREATE TABLE IF NOT EXISTS messages (
+                id TEXT PRIMARY KEY,
+                conversation_id TEXT NOT NULL
+                    REFERENCES conversations(id) ON DELETE CASCADE,
+                seq INTEGER NOT NULL,
+                role TEXT NOT NULL,
+                content TEXT NOT NULL,
+                created_at TIMESTAMP NOT NULL,
+                token_count INTEGER NULL,
+                UNIQUE (conversation_id, seq)
+            );
+        """)
+
+    def migrate(self) -> bool:
+        return True
+
+    def missing_columns(self) -> Optional[List[str]]:
+        return []
+
+    def check(self) -> Optional[str]:
+        return None
+
+    @staticmethod
+    def is_transient(error: Exception) -> bool:
+        return isinstance(error, sqlite3.OperationalError)
+
+    @contextmanager
+    def transaction(self):
+        """Run several statements atomically; yields a dictionary cursor."""
+        with metrics.DB_QUERY_SECONDS.time(operation="transaction"), self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield _Cursor(self._conn.cursor())
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def execute_query(self, query, params=None):
+        """Execute a query (INSERT, UPDATE, DELETE)."""
+        with metrics.DB_QUERY_SECONDS.time(operation="execute_query"), self._lock:
+            cursor = _Cursor(self._conn.cursor())
+            cursor.execute(query, params)
+            return cursor.lastrowid
+
+    def fetch_all(self, query, params=None):
+        """Fetch all results (SELECT)."""
+        with metrics.DB_QUERY_SECONDS.time(operation="fetch_all"), self._lock:
+            cursor = _Cursor(self._conn.cursor())
+            cursor.execute(query, params)
+            return cursor.fetchall()
+
+    def fetch_one(self, query, params=None):
+        """Fetch one result (SELECT)."""
+        with metrics.DB_QUERY_SECONDS.time(operation="fetch_one"), self._lock:
+            cursor = _Cursor(self._conn.cursor())
+            cursor.execute(query, params)
+            return cursor.fetchone()
+
+
+def install(db_path: str = ":memory:", **llm_options) -> None:
+    """
+    Make `import llm_handler` and `import database` resolve to the fakes.
+
+    Call before importing app or asgi_app; the LLMHandler() and
+    DatabaseManager() their ChatAPI builds are then the fakes, with these options.
+    """
+    llm_handler = types.ModuleType("llm_handler")
+    llm_handler.LLMHandler = partial(FakeLLMHandler, **llm_options)
+    database = types.ModuleType("database")
+    database.DatabaseManager = partial(SQLiteDatabaseManager, db_path)
+    sys.modules["llm_handler"] = llm_handler
+    sys.modules["database"] = database
@@ -7,12 +7,14 @@ const newChatBtn = document.getElementById('newChatBtn');
 const toggleSidebar = document.getElementById('toggleSidebar');
 const sidebar = document.getElementById('sidebar');
 const historyList = document.getElementById('historyList');
+const searchInput = document.getElementById('searchInput');
 const charCount = document.getElementById('charCount');
 const statusEl = document.getElementById('status');
 
 // State
 let isGenerating = false;
 let currentConversationId = null;
+let searchTimer = null;
 
 // Initialize
 document.addEventListener('DOMContentLoaded', () => {
@@ -36,6 +38,15 @@ function setupEventListeners() {
         sidebar.classList.toggle('collapsed');
     });
 
+    searchInput.addEventListener('input', () => {
+        // Search once typing pauses
+        clearTimeout(searchTimer);
+        searchTimer = setTimeout(() => {
+            const query = searchInput.value.trim();
+            query ? searchConversations(query) : loadConversations();
+        }, 250);
+    });
+
     messageInput.addEventListener('input', (e) => {
         updateCharCount();
         autoResize(e.target);
@@ -67,14 +78,26 @@ function updateCharCount() {
     }
 }
 
-// Check server health
-async function checkServerHealth() {
+// Readiness polling backoff (ms)
+const HEALTH_POLL_MIN = 1000;
+const HEALTH_POLL_MAX = 30000;
+
+// Check server health, polling /health/ready until the model has loaded
+async function checkServerHealth(delay = HEALTH_POLL_MIN) {
     try {
-        const response = await fetch('/health');
+        const response = await fetch('/health/ready');
         const data = await response.json();
 
-        if (data.status === 'healthy' && data.model_loaded) {
+        if (response.ok && data.status === 'ready') {
             setStatus('Ready', 'ready');
+            return;
+        }
+
+        const model = data.model || {};
+        if (model.state === 'failed') {
+            setStatus('Model failed to load', 'error');
+        } else if (model.state === 'downloading' && model.progress) {
+            setStatus(`Downloading model... ${Math.round(model.progress * 100)}%`, 'loading');
         } else {
             setStatus('Model loading...', 'loading');
         }
@@ -82,17 +105,25 @@ async function checkServerHealth() {
         setStatus('Server offline', 'error');
         console.error('Health check failed:', error);
     }
+
+    setTimeout(() => checkServerHealth(Math.min(delay * 2, HEALTH_POLL_MAX)), delay);
 }
 
-// Load conversations
-async function loadConversations() {
+// Load conversations (a page at a time; "Load more" fetches the next)
+async function loadConversations(cursor = null) {
     try {
-        const response = await fetch('/conversations');
-        const conversations = await response.json();
+        const url = cursor ? `/conversations?cursor=${encodeURIComponent(cursor)}` : '/conversations';
+        const response = await fetch(url);
+        const page = await response.json();
+        const conversations = page.conversations;
 
-        historyList.innerHTML = '';
+        if (cursor) {
+            historyList.querySelector('.history-more')?.remove();
+        } else {
+            historyList.innerHTML = '';
+        }
 
-        if (conversations.length === 0) {
+        if (!cursor && conversations.length === 0) {
             historyList.innerHTML = '<p class="history-empty">No conversations yet</p>';
             return;
         }
@@ -102,6 +133,7 @@ async function loadConversations() {
             item.className = 'history-item';
             if (conv.id === currentConversationId) item.classList.add('active');
             item.textContent = conv.title || 'New Chat';
+            if (conv.preview) item.title = conv.preview;
             item.onclick = () => loadConversation(conv.id);
 
             // Allow deleting with right click
@@ -114,11 +146,61 @@ async function loadConversations() {
 
             historyList.appendChild(item);
         });
+
+        if (page.next_cursor) {
+            const more = document.createElement('button');
+            more.className = 'history-more';
+            more.textContent = 'Load more';
+            more.onclick = () => loadConversations(page.next_cursor);
+            historyList.appendChild(more);
+        }
     } catch (error) {
         console.error('Error loading conversations:', error);
     }
 }
 
+// Search messages in all conversations
+async function searchConversations(query) {
+    try {
+        const response = await fetch(`/search?q=${encodeURIComponent(query)}`);
+        const page = await response.json();
+        if (!response.ok) throw new Error(page.error);
+
+        // Ignore results for a query that has since been changed
+        if (searchInput.value.trim() !== query) return;
+
+        historyList.innerHTML = '';
+        if (page.results.length === 0) {
+            historyList.innerHTML = '<p class="history-empty">No matches</p>';
+            return;
+        }
+
+        page.results.forEach(hit => {
+            const item = document.createElement('div');
+            item.className = 'history-item';
+            if (hit.conversation_id === currentConversationId) item.classList.add('active');
+            item.textContent = hit.title || 'New Chat';
+            item.onclick = () => loadConversation(hit.conversation_id);
+
+            const snippet = document.createElement('div');
+            snippet.className = 'history-snippet';
+            snippet.textContent = hit.snippet;
+            item.appendChild(snippet);
+
+            historyList.appendChild(item);
+        });
+
+        if (page.truncated) {
+            const note = document.createElement('p');
+            note.className = 'history-empty';
+            note.textContent = 'Only the most recent matches are shown';
+            historyList.appendChild(note);
+        }
+    } catch (error) {
+        console.error('Error searching conversations:', error);
+    }
+}
+
 // Create new chat
 async function createNewChat() {
     try {
@@ -279,7 +361,8 @@ async function streamResponse(message, typingId) {
         },
         body: JSON.stringify({
             message,
-            conversation_id: currentConversationId
+            conversation_id: currentConversationId,
+            compact: true
         })
     });
 
@@ -294,9 +377,10 @@ async function streamResponse(message, typingId) {
     const messageId = addMessage('', 'assistant');
     const messageContent = document.querySelector(`[data-id="${messageId}"] .message-content`);
 
-    // Read the stream
+    // Read the stream; events can be split across (or share) reads
     const reader = response.body.getReader();
     const decoder = new TextDecoder();
+    let buffer = '';
     let fullText = '';
 
     while (true) {
@@ -304,28 +388,53 @@ async function streamResponse(message, typingId) {
 
         if (done) break;
 
-        const chunk = decoder.decode(value);
-        const lines = chunk.split('\n');
-
-        for (const line of lines) {
-            if (line.startsWith('data: ')) {
-                const data = JSON.parse(line.slice(6));
-
-                if (data.token) {
-                    fullText += data.token;
-                    messageContent.textContent = fullText;
-                    scrollToBottom();
-                } else if (data.done) {
-                    // Stream complete
-                    return;
-                } else if (data.error) {
-                    throw new Error(data.error);
-                }
+        buffer += decoder.decode(value, { stream: true });
+        const events = buffer.split('\n\n');
+        buffer = events.pop();
+
+        for (const raw of events) {
+            const event = parseEvent(raw);
+
+            if (event.name === 'message') {
+                // Compact framing: the data is the text itself
+                fullText += event.data;
+                messageContent.textContent = fullText;
+                scrollToBottom();
+                continue;
+            }
+
+            // 'done' and 'error' events carry JSON
+            const data = JSON.parse(event.data);
+            if (data.done) {
+                // Stream complete
+                return;
+            } else if (data.error) {
+                throw new Error(data.error);
             }
         }
     }
 }
 
+// Parse one Server-Sent Event into its name ('message' if it has none)
+// and its data lines joined with newlines
+function parseEvent(raw) {
+    let name = null;
+    const data = [];
+
+    for (const line of raw.split('\n')) {
+        const colon = line.indexOf(':');
+        if (colon <= 0) continue;
+        const field = line.slice(0, colon);
+        let value = line.slice(colon + 1);
+        if (value.startsWith(' ')) value = value.slice(1);
+
+        if (field === 'event') name = value;
+        else if (field === 'data') data.push(value);
+    }
+
+    return { name: name || 'message', data: data.join('\n') };
+}
+
 // Add message to chat
 function addMessage(text, role, timestamp = null) {
     const messageId = `msg-${Date.now()}-${Math.random()}`;
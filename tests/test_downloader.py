@@ -0,0 +1,168 @@
+"""
+Tests for backend/downloader.py against a local http.server stand-in.
+
+Run from the repository root:
+    python -m pytest -q tests
+"""
+import hashlib
+import http.server
+import json
+import os
+import sys
+import tempfile
+import threading
+import unittest
+from pathlib import Path
+from unittest import mock
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+import downloader  # noqa: E402
+
+DATA = os.urandom(250_000)
+CHUNK = 100_000
+ETAG = '"model-v1"'
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    """Serves DATA with Range support; `server.cut` ranges are sent half-finished once."""
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        rng = self.headers.get("Range")
+        with server.lock:
+            server.ranges.append(rng)
+        if rng:
+            start, end = rng.split("=", 1)[1].split("-")
+            start, end = int(start), (int(end) if end else len(DATA) - 1)
+            body = DATA[start:end + 1]
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{len(DATA)}")
+        else:
+            body = DATA
+            self.send_response(200)
+        self.send_header("ETag", ETAG)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        with server.lock:
+            cut = rng in server.cut
+            server.cut.discard(rng)
+        if cut:
+            self.wfile.write(body[:len(body) // 2])
+            self.wfile.flush()
+            self.close_connection = True
+            return
+        self.wfile.write(body)
+
+
+class DownloadTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+        cls.server.lock = threading.Lock()
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.url = f"http://127.0.0.1:{cls.server.server_port}/model.gguf"
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.server.ranges = []
+        self.server.cut = set()
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.dest = Path(tmp.name) / "model.gguf"
+        self.part = self.dest.with_name("model.gguf.part")
+        self.state = self.dest.with_name("model.gguf.part.json")
+        sleep = mock.patch.object(downloader.time, "sleep")
+        sleep.start()
+        self.addCleanup(sleep.stop)
+
+    def chunk_ranges(self):
+        """Range headers of the chunk requests (the size probe excluded)."""
+        return sorted(r for r in self.server.ranges if r != "bytes=0-0")
+
+    def test_splits_into_ranges(self):
+        downloader.download(self.url, self.dest, chunk_size=CHUNK)
+
+        self.assertEqual(self.dest.read_bytes(), DATA)
+        self.assertEqual(self.chunk_ranges(), [
+            "bytes=0-99999", "bytes=100000-199999", "bytes=200000-249999",
+        ])
+        self.assertFalse(self.part.exists())
+        self.assertFalse(self.state.exists())
+
+    def test_resumes_from_part_file(self):
+        # Chunk 1 is already on disk from an interrupted attempt
+        with open(self.part, "wb") as f:
+            f.truncate(len(DATA))
+            f.seek(CHUNK)
+            f.write(DATA[CHUNK:2 * CHUNK])
+        self.state.write_text(json.dumps({
+            "source": self.url, "size": len(DATA), "validator": ETAG,
+            "chunk_size": CHUNK, "done": [1],
+        }))
+
+        downloader.download(self.url, self.dest, chunk_size=CHUNK)
+
+        self.assertEqual(self.dest.read_bytes(), DATA)
+        self.assertEqual(self.chunk_ranges(), ["bytes=0-99999", "bytes=200000-249999"])
+
+    def test_restarts_when_the_file_changed(self):
+        self.part.write_bytes(b"\0" * len(DATA))
+        self.state.write_text(json.dumps({
+            "source": self.url, "size": len(DATA), "validator": '"model-v0"',
+            "chunk_size": CHUNK, "done": [0, 1],
+        }))
+
+        downloader.download(self.url, self.dest, chunk_size=CHUNK)
+
+        self.assertEqual(self.dest.read_bytes(), DATA)
+        self.assertEqual(len(self.chunk_ranges()), 3)
+
+    def test_retries_a_truncated_chunk(self):
+        self.server.cut = {"bytes=100000-199999"}
+
+        downloader.download(self.url, self.dest, chunk_size=CHUNK)
+
+        self.assertEqual(self.dest.read_bytes(), DATA)
+        self.assertEqual(self.server.ranges.count("bytes=100000-199999"), 2)
+
+    def test_gives_up_after_retries_and_keeps_finished_chunks(self):
+        with mock.patch.object(downloader, "RETRIES", 1):
+            self.server.cut = {"bytes=200000-249999"}
+            with self.assertRaises(downloader.DownloadError):
+                downloader.download(self.url, self.dest, chunk_size=CHUNK, connections=1)
+
+        self.assertFalse(self.dest.exists())
+        self.assertEqual(json.loads(self.state.read_text())["done"], [0, 1])
+
+    def test_bad_checksum_keeps_the_old_file(self):
+        self.dest.write_bytes(b"previous model")
+
+        with self.assertRaises(downloader.DownloadError):
+            downloader.download(self.url, self.dest, sha256="0" * 64, chunk_size=CHUNK)
+
+        self.assertEqual(self.dest.read_bytes(), b"previous model")
+        self.assertFalse(self.part.exists())
+        self.assertFalse(self.state.exists())
+
+    def test_good_checksum_replaces_the_old_file(self):
+        self.dest.write_bytes(b"previous model")
+
+        downloader.download(self.url, self.dest, sha256=hashlib.sha256(DATA).hexdigest(),
+                            chunk_size=CHUNK)
+
+        self.assertEqual(self.dest.read_bytes(), DATA)
+
+
+if __name__ == "__main__":
+    unittest.main()